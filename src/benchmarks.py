@@ -0,0 +1,854 @@
+from compact_directory import CompactDirectory
+from contextlib import contextmanager
+from crawl_queue import CrawlQueue
+from crawl_state import CrawlStateStore
+from description_vectors import DescriptionVectors
+from directory_index import DirectoryIndex
+from dom_profile_scraper import DomPageScraper
+from extraction_pool import ExtractionPool, extract_page
+from fetch_engine import AsyncFetchEngine, PolitenessController
+from get_therapist_directory import TherapistDirectory
+from get_therapist_profile import TherapistPageScraper
+from get_therapist_urls import TherapistURLScraper
+from orchestrator import CrawlOrchestrator
+from page_cache import PageCache
+from pipeline_metrics import PipelineMetrics
+from snapshot_diff import SnapshotDiff
+from stand_in_server import StandInServer
+from utility import DirectoryBuilder, KeywordMatcher, TextProcessing
+import argparse
+import ast
+import collections
+import datetime
+import glob
+import gzip
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import platform
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+
+# offline benchmarks, no live requests: extraction, cleaning, storage, URL discovery and a whole directory build
+# against a local StandInServer. run from src/ (same as main.py): python benchmarks.py. results go to a JSON file
+# (see run_benchmarks) so two commits can be compared w/ --compare
+#
+# the pages in benchmark_data/ are synthetic: hand-written in the layout the html2text regexes expect (the footer is
+# padded so the [0:-540] trim lands in it), not captured from psychology today. they're fine for comparing two
+# implementations on the same input, not as evidence that either one parses the live site
+FIXTURE_PAGES = '../benchmark_data/profile_pages/*.html'
+SEARCH_PAGES = '../benchmark_data/search_pages'  # {gender}_page_1.html + no_results.html
+GENDERS = ['female', 'male', 'non-binary']
+
+
+def load_page_texts():
+    # synthetic profile pages -> page text, same as what the scraper sees after html2text
+    return [TherapistPageScraper.html_to_text(open(path, encoding='utf-8').read())
+            for path in sorted(glob.glob(FIXTURE_PAGES))]
+
+
+def load_fixture_site(state='benchmark'):
+    # path -> html for a stand-in psychology today: each gender's synthetic results page, the no results page after
+    # it, and a profile page behind every therapist URL the results pages link to. there are only 5 synthetic
+    # profiles for 60 URLs, so each URL gets one of them w/ a line of its own added to the personal statement: no
+    # two URLs serve the same page, but every other field still repeats across the site
+    profile_pages = [open(path, encoding='utf-8').read() for path in sorted(glob.glob(FIXTURE_PAGES))]
+    no_results = open(f'{SEARCH_PAGES}/no_results.html', encoding='utf-8').read()
+    pages = {}
+    for gender in GENDERS:
+        results_page = open(f'{SEARCH_PAGES}/{gender}_page_1.html', encoding='utf-8').read()
+        pages[f'/us/therapists/{state}?category={gender}&page=1'] = results_page
+        pages[f'/us/therapists/{state}?category={gender}&page=2'] = no_results
+        for i, profile_path in enumerate(TherapistURLScraper.return_urls(results_page, '')):
+            pages[profile_path] = profile_pages[i % len(profile_pages)].replace(
+                '</section>', f'<p>Profile {profile_path.rsplit("/", 1)[-1]} of the benchmark site.</p></section>', 1)
+    return pages
+
+
+def get_fixture_url_df(site_pages, base_url, state='benchmark'):
+    # ['Gender', 'URL'] for every profile the fixture site's results pages link to, same as discovery finds
+    url_rows = [(gender, url) for gender in GENDERS for url in TherapistURLScraper.return_urls(
+        site_pages[f'/us/therapists/{state}?category={gender}&page=1'], base_url)]
+    return pd.DataFrame(url_rows, columns=['Gender', 'URL']).drop_duplicates(subset=['URL'])
+
+
+@contextmanager
+def offline_workspace():
+    # crawls write to ../scraped_data, so they run from the src/ of a throwaway copy of the repo layout
+    # (reference_data/ is linked in), never touching the real scraped_data/
+    original_dir, reference_data = os.getcwd(), os.path.abspath('../reference_data')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for folder in ('src', 'scraped_data'):
+            os.makedirs(os.path.join(temp_dir, folder))
+        os.symlink(reference_data, os.path.join(temp_dir, 'reference_data'))
+        os.chdir(os.path.join(temp_dir, 'src'))
+        try:
+            yield temp_dir
+        finally:
+            os.chdir(original_dir)
+
+
+def time_per_page(func, page_texts, runs):
+    # average seconds per page over runs passes through the fixture pages
+    start = time.perf_counter()
+    for _ in range(runs):
+        for page_text in page_texts:
+            func(page_text)
+    return (time.perf_counter() - start) / (runs * len(page_texts))
+
+
+def legacy_keyword_scan(page_text):
+    # issues / age / lgbtq / veteran the way they were pulled before KeywordMatcher: one scan per issue + 3 more
+    issues = set()
+    for val in TextProcessing.get_reference_data('../reference_data/issues.txt'):
+        if re.search(rf'\b{val}\b', page_text, re.DOTALL):
+            issues.add(val)
+    ages = set(re.findall(TextProcessing.get_field_regex_pattern('age'), page_text))
+    lgbtq = re.search(TextProcessing.get_field_regex_pattern('lgbtq_status'), page_text, re.DOTALL)
+    veteran = re.search(TextProcessing.get_field_regex_pattern('veteran_status'), page_text, re.DOTALL)
+    return {'issues': issues, 'age': ages, 'lgbtq_status': bool(lgbtq), 'veteran_status': bool(veteran)}
+
+
+def legacy_split_clean_and_failures(therapist_profile_df, duplicated_urls):
+    # DirectoryBuilder.split_clean_and_failures before it was vectorized: two row-wise applies, five concats, applymap
+    therapist_profile_df = therapist_profile_df.fillna('N/A')
+    failures = pd.DataFrame()
+    mask1 = therapist_profile_df['therapist_url'].isin(duplicated_urls)
+    mask2 = ~therapist_profile_df.apply(lambda row: 'program failure' in row.values, axis=1)
+    mask3 = therapist_profile_df['therapist_name'].notna()
+    mask4 = therapist_profile_df['zipcode'].str.isdigit() | therapist_profile_df['zipcode'].isna()
+    mask5 = ~therapist_profile_df.apply(lambda row: 'failed scrape' in row.values, axis=1)
+    for mask in [mask1, ~mask2, ~mask3, ~mask4, ~mask5]:
+        failures = pd.concat([failures, therapist_profile_df[mask]])
+    therapist_profile_df = therapist_profile_df[~mask1 & mask2 & mask3 & mask4 & mask5]
+    therapist_profile_df = therapist_profile_df.map(lambda x: x.strip() if isinstance(x, str) else x)
+    return therapist_profile_df, failures
+
+
+def build_synthetic_directory(rows=100000):
+    # raw records file as the cleaner reads it (every value a string), made from the fixture pages. about 1% each of
+    # duplicate URLs, program failures, failed scrapes and bad zipcodes, some rows w/ more than one problem
+    records = [TherapistPageScraper.parse(page_text, 'url', 'female') for page_text in load_page_texts()]
+    directory_df = pd.DataFrame([records[i % len(records)] for i in range(rows)],
+                                columns=DirectoryBuilder.get_therapist_profile_cols()).astype(str)
+    directory_df['therapist_url'] = [f'https://www.psychologytoday.com/us/therapists/{i}' for i in range(rows)]
+    directory_df['description'] = ' ' + directory_df['description'] + ' '  # something for the strip to do
+    directory_df.loc[directory_df.index % 97 == 0, 'therapist_url'] = directory_df['therapist_url'].iloc[0]
+    program_failures = directory_df.index % 101 == 1
+    directory_df.loc[program_failures, directory_df.columns[1:]] = 'program failure'
+    directory_df.loc[directory_df.index % 89 == 2, 'insurance'] = 'failed scrape'
+    directory_df.loc[directory_df.index % 83 == 3, 'zipcode'] = '2760l'
+    directory_df.loc[directory_df.index % (89 * 83) == 2 + 89 * 3, 'zipcode'] = 'N/A'
+    return directory_df
+
+
+def benchmark_cleaning(rows=100000):
+    directory_df = build_synthetic_directory(rows)
+    duplicated_urls = set(directory_df.loc[directory_df.duplicated(subset='therapist_url'), 'therapist_url'])
+    start = time.perf_counter()
+    legacy_clean, legacy_failures = legacy_split_clean_and_failures(directory_df, duplicated_urls)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    clean, failures = DirectoryBuilder.split_clean_and_failures(directory_df, duplicated_urls)
+    vectorized_time = time.perf_counter() - start
+    if not clean.equals(legacy_clean) or set(failures.index) != set(legacy_failures.index):
+        raise AssertionError('vectorized cleaner disagrees with the legacy cleaner')
+    with offline_workspace():  # the whole in-memory clean, incl. finding duplicates and writing the removed rows
+        start = time.perf_counter()
+        DirectoryBuilder.clean_therapist_profile_dataframe(directory_df, 'benchmark')
+        clean_dataframe_time = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'legacy_clean_s': legacy_time,
+        'vectorized_clean_s': vectorized_time,
+        'legacy_failure_rows': legacy_failures.shape[0],
+        'failure_rows': failures.shape[0],
+        'speedup': legacy_time / vectorized_time,
+        'clean_dataframe_s': clean_dataframe_time,
+        'clean_dataframe_rows_per_s': rows / clean_dataframe_time
+    }
+
+
+def load_directory_csv(csv_path):
+    # how the directory CSV had to be loaded before it could be filtered: read it, then re-parse every set column
+    directory_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    for field in CompactDirectory.multi_valued_cols:
+        directory_df[field] = directory_df[field].map(lambda val: ast.literal_eval(val) if val.startswith('{') else val)
+    return directory_df
+
+
+def benchmark_storage(rows=100000):
+    # directory CSV vs CompactDirectory Parquet: file size, load time, memory. the synthetic rows cycle through the
+    # 5 fixture profiles, so Parquet compresses them far better than it would a real directory (same descriptions
+    # over and over). the load times are comparable between commits, the sizes / ratios aren't representative
+    directory_df, _ = DirectoryBuilder.split_clean_and_failures(build_synthetic_directory(rows), set())
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_path, parquet_path = os.path.join(temp_dir, 'directory.csv'), os.path.join(temp_dir, 'directory.parquet')
+        directory_df.to_csv(csv_path, index=False)
+        CompactDirectory.from_csv(csv_path).save(parquet_path)
+
+        start = time.perf_counter()
+        csv_df = load_directory_csv(csv_path)
+        csv_load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        compact = CompactDirectory.load(parquet_path)
+        parquet_load_time = time.perf_counter() - start
+
+        results = {
+            'rows': directory_df.shape[0],
+            'csv_mb': os.path.getsize(csv_path) / 1e6,
+            'parquet_mb': os.path.getsize(parquet_path) / 1e6,
+            'csv_load_s': csv_load_time,
+            'parquet_load_s': parquet_load_time,
+            'csv_memory_mb': csv_df.memory_usage(deep=True).sum() / 1e6,
+            'compact_memory_mb': compact.directory_df.memory_usage(deep=True).sum() / 1e6,
+            'set_columns_csv_memory_mb': csv_df[list(CompactDirectory.multi_valued_cols)].memory_usage(
+                deep=True).sum() / 1e6,
+            'set_columns_compact_memory_mb': compact.directory_df[list(CompactDirectory.multi_valued_cols)]
+            .memory_usage(deep=True).sum() / 1e6
+        }
+    if not compact.to_frame().equals(csv_df):
+        raise AssertionError('Parquet round trip changed the directory')
+    return results
+
+
+def benchmark_directory_index(rows=100000, repeats=100, limit=20):
+    """
+    DirectoryIndex build time and count / query latency on a synthetic directory. the fixture profiles all share a
+    gender and 5 zipcodes, so those are drawn at random per row here to give the gender / zipcode bitmaps some
+    spread. every query's count and matches have to equal a plain pandas filter over the same directory, or this raises
+    """
+    directory_df, _ = DirectoryBuilder.split_clean_and_failures(build_synthetic_directory(rows), set())
+    rng = np.random.default_rng(0)
+    directory_df['therapist_gender'] = rng.choice(GENDERS, directory_df.shape[0])
+    directory_df['zipcode'] = [f'{zipcode:05d}' for zipcode in rng.integers(27000, 29000, directory_df.shape[0])]
+    filter_sets = {
+        'gender': {'therapist_gender': 'female'},
+        'zipcode_prefix': {'zipcode': '27'},
+        'insurance_online': {'insurance': 'Aetna', 'online': True},
+        'all': {'therapist_gender': 'female', 'zipcode': '275', 'insurance': 'Aetna',
+                'issues_covered': ['Anxiety', 'Depression'], 'in_person': True}
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parquet_path = os.path.join(temp_dir, 'directory.parquet')
+        compact = CompactDirectory.from_frame(directory_df)
+        compact.save(parquet_path)
+        start = time.perf_counter()
+        directory_index = DirectoryIndex.from_directory(parquet_path)
+        results = {'rows': directory_index.row_count, 'build_s': time.perf_counter() - start}
+
+    directory_df = compact.to_frame()
+    for name, filters in filter_sets.items():
+        start = time.perf_counter()
+        for _ in range(repeats):
+            count = directory_index.count(**filters)
+        results[f'{name}_count_us'] = (time.perf_counter() - start) / repeats * 1e6
+        start = time.perf_counter()
+        for _ in range(repeats):
+            matches = directory_index.query(limit=limit, **filters)
+        results[f'{name}_query_us'] = (time.perf_counter() - start) / repeats * 1e6
+        results[f'{name}_matches'] = count
+
+        expected = pd.Series(True, index=directory_df.index)
+        for field, vals in filters.items():
+            for val in (vals if isinstance(vals, list) else [vals]):
+                if field == 'zipcode':
+                    expected &= directory_df[field].str.startswith(val)
+                elif field in DirectoryIndex.flag_cols:
+                    expected &= directory_df[field] == 'Y'
+                elif field in CompactDirectory.multi_valued_cols:
+                    expected &= directory_df[field].map(lambda values: val in values)
+                else:
+                    expected &= directory_df[field] == val
+        if count != expected.sum() or \
+                matches['therapist_url'].tolist() != directory_df.loc[expected, 'therapist_url'].head(limit).tolist():
+            raise AssertionError(f'index query {name} disagrees with filtering the directory')
+    return results
+
+
+def benchmark_description_vectors(rows=100000, queries=20, k=10):
+    """
+    vectorizing a directory's descriptions and top-k similarity search over the memory-mapped vectors. the
+    descriptions are the fixture pages' w/ a random third of the words dropped, so no two are the same. every
+    query's results have to match a brute force search over the whole matrix, or this raises
+    """
+    directory_df = build_synthetic_directory(rows)
+    rng = np.random.default_rng(0)
+    directory_df['description'] = [' '.join(word for word in description.split() if rng.random() > 1 / 3)
+                                   for description in directory_df['description']]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory_path = os.path.join(temp_dir, 'directory.csv')
+        directory_df.to_csv(directory_path, index=False)
+        start = time.perf_counter()
+        description_vectors = DescriptionVectors.build(directory_path)
+        build_time = time.perf_counter() - start
+
+        query_urls = directory_df['therapist_url'].sample(queries, random_state=0).tolist()
+        start = time.perf_counter()
+        results = [description_vectors.similar(query_url, k=k) for query_url in query_urls]
+        query_time = (time.perf_counter() - start) / queries
+
+        vectors = np.array(description_vectors.vectors)
+        for query_url, result in zip(query_urls, results):
+            row = description_vectors.get_row(query_url)
+            scores = vectors @ vectors[row]
+            scores[row] = -np.inf
+            expected = np.sort(scores[scores > 0])[::-1][:k]
+            if not np.allclose(expected, [similarity for _, similarity in result], atol=1e-6):
+                raise AssertionError(f'top {k} for {query_url} differs from a brute force search')
+        vectors_mb = os.path.getsize(os.path.join(DescriptionVectors.get_vectors_dir(directory_path),
+                                                  'vectors.npy')) / 2 ** 20
+        del vectors, description_vectors  # the memory maps have to be closed before the temp dir goes
+    return {
+        'rows': rows,
+        'build_s': build_time,
+        'descriptions_per_s': rows / build_time,
+        'vectors_mb': vectors_mb,
+        'similar_query_ms': query_time * 1000
+    }
+
+
+def benchmark_snapshot_diff(rows=100000):
+    """
+    changelog between two snapshots of a directory vs keeping the second one: 2% of therapists removed, 3% added,
+    a phone number / insurance changed for 2.5%, and every set field reshuffled (not a change). the changelog has
+    to hold exactly those counts, and applying it to the base has to give back the new snapshot, or this raises
+    """
+    base_df = build_synthetic_directory(rows).drop_duplicates(subset='therapist_url')
+    new_df = base_df.drop(base_df.index[::50])
+    new_df['issues_covered'] = [val if not val.startswith('{') else '{' + ', '.join(
+        repr(item) for item in sorted(ast.literal_eval(val), reverse=True)) + '}' for val in new_df['issues_covered']]
+    changed = new_df.index[3::40]
+    new_df.loc[changed, 'phone_number'] = '(919) 555-0000'
+    new_df.loc[changed[::2], 'insurance'] = "{'Aetna'}"
+    added_df = base_df.iloc[:rows // 33].assign(therapist_url=lambda df: df['therapist_url'] + '-new')
+    new_df = pd.concat([new_df, added_df])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_path, new_path = os.path.join(temp_dir, 'base.csv'), os.path.join(temp_dir, 'new.csv')
+        changelog_path, output_path = os.path.join(temp_dir, 'changes.jsonl.gz'), os.path.join(temp_dir, 'out.csv')
+        base_df.to_csv(base_path, index=False)
+        new_df.to_csv(new_path, index=False)
+
+        start = time.perf_counter()
+        summary = SnapshotDiff().diff(base_path, new_path, changelog_path)
+        diff_time = time.perf_counter() - start
+        start = time.perf_counter()
+        SnapshotDiff().apply(base_path, changelog_path, output_path)
+        apply_time = time.perf_counter() - start
+        expected = {'added': added_df.shape[0], 'removed': len(base_df.index[::50]),
+                    'changed': len(changed.difference(base_df.index[::50]))}
+        if {count: summary[count] for count in expected} != expected:
+            raise AssertionError(f'changelog counts {summary} != {expected}')
+
+        output_df, new_df = (load_directory_csv(path).set_index('therapist_url').sort_index()
+                             for path in (output_path, new_path))
+        if not output_df.equals(new_df):
+            raise AssertionError('applying the changelog to the base did not give back the new snapshot')
+        results = {
+            'rows': new_df.shape[0],
+            'snapshot_mb': os.path.getsize(new_path) / 1e6,
+            'changelog_mb': os.path.getsize(changelog_path) / 1e6,
+            'diff_s': diff_time,
+            'diff_rows_per_s': (summary['base_rows'] + summary['new_rows']) / diff_time,
+            'apply_s': apply_time
+        }
+    return results
+
+
+def benchmark_keyword_matching(runs=200):
+    page_texts = load_page_texts()
+    matcher = KeywordMatcher.get_matcher()
+    results = {
+        'legacy_keyword_scan_ms': time_per_page(legacy_keyword_scan, page_texts, runs) * 1000,
+        'keyword_matcher_ms': time_per_page(matcher.scan, page_texts, runs) * 1000,
+        'full_parse_ms': time_per_page(lambda text: TherapistPageScraper.parse(text, 'url', 'gender'),
+                                       page_texts, runs) * 1000
+    }
+    results['speedup'] = results['legacy_keyword_scan_ms'] / results['keyword_matcher_ms']
+    return results
+
+
+def benchmark_extraction(runs=20, workers=None):
+    # html -> record (html2text + every field), pages/sec on one core and across an ExtractionPool
+    pages = [('url', 'female', open(path, encoding='utf-8').read()) for path in sorted(glob.glob(FIXTURE_PAGES))]
+    start = time.perf_counter()
+    for _ in range(runs):
+        for page in pages:
+            extract_page(*page)
+    one_core_time = time.perf_counter() - start
+
+    with ExtractionPool(max_workers=workers) as extraction_pool:
+        start = time.perf_counter()
+        records = sum(len(batch) for batch in extraction_pool.map_batches(pages * runs))
+        pool_time = time.perf_counter() - start
+        pool_workers = extraction_pool.max_workers
+    return {
+        'pages': len(pages) * runs,
+        'pages_per_s_one_core': len(pages) * runs / one_core_time,
+        'pool_workers': pool_workers,
+        'pool_pages_per_s': records / pool_time,
+        'pool_pages_per_s_per_core': records / pool_time / pool_workers
+    }
+
+
+def benchmark_dom_extraction(runs=20):
+    """
+    html -> record w/ the 'dom' backend (DomPageScraper) vs the html2text one, per page on one core. every fixture
+    page has to come out of both w/ the same record, and a page w/o one of the required nodes has to be a failed
+    scrape, or this raises. the selectors were written against these synthetic pages, so agreeing here says nothing
+    about the live site (see DomPageScraper.check_pages for that)
+    """
+    pages = [(path, open(path, encoding='utf-8').read()) for path in sorted(glob.glob(FIXTURE_PAGES))]
+    summary = DomPageScraper.check_pages((path, 'female', page_html, None) for path, page_html in pages)
+    if summary['mismatches']:
+        raise AssertionError(f'DOM backend disagrees w/ html2text on the fixture pages: {summary["mismatches"]}')
+
+    # the required nodes' elements, renamed so the selectors miss them
+    required_nodes = {'therapist_name': 'profile-title', 'address': 'address',
+                      'description': 'profile-personal-statement'}
+    for field, class_name in required_nodes.items():
+        dom_record = DomPageScraper.parse(pages[0][1].replace(f'"{class_name}"', '"renamed"'), 'url', 'female')
+        if dom_record[field] != 'failed scrape':
+            raise AssertionError(f'DOM backend gave {dom_record[field]!r} for {field} w/o its node')
+
+    page_htmls = [page_html for _, page_html in pages]
+    results = {
+        'html2text_ms': time_per_page(lambda page_html: extract_page('url', 'female', page_html), page_htmls,
+                                      runs) * 1000,
+        'dom_ms': time_per_page(lambda page_html: extract_page('url', 'female', page_html, backend='dom'),
+                                page_htmls, runs) * 1000
+    }
+    results['speedup'] = results['html2text_ms'] / results['dom_ms']
+    return results
+
+
+def benchmark_discovery(runs=200, latency=0.05):
+    # parsing a results page, then discovery over the stand-in (60 therapists, 3 genders, then no results pages)
+    results_pages = [open(f'{SEARCH_PAGES}/{gender}_page_1.html', encoding='utf-8').read() for gender in GENDERS]
+    start = time.perf_counter()
+    for _ in range(runs):
+        for results_page in results_pages:
+            TherapistURLScraper.return_urls(results_page)
+    parse_time = time.perf_counter() - start
+
+    site_pages = load_fixture_site()  # before switching to the workspace, fixture paths are relative to src/
+    with offline_workspace(), StandInServer(site_pages, latency=latency, seed=0) as stand_in:
+        start = time.perf_counter()
+        url_scraper = TherapistURLScraper('benchmark', 250, 100, requests_per_second=100, base_url=stand_in.url(''))
+        discovery_time = time.perf_counter() - start
+    if len(stand_in.request_log) != 2 * len(GENDERS):  # each gender's results page, then its no results page
+        raise AssertionError(f'discovery sent {len(stand_in.request_log)} requests, expected {2 * len(GENDERS)}')
+    return {
+        'results_pages_parsed_per_s': len(results_pages) * runs / parse_time,
+        'server_latency_s': latency,
+        'discovery_requests': len(stand_in.request_log),
+        'discovery_urls': url_scraper.url_df.shape[0],
+        'discovery_s': discovery_time
+    }
+
+
+def benchmark_directory_build(requests_per_second=20, latency=0.05, error_rate=0.03, throttle_rate=0.03):
+    """
+    discovery + TherapistDirectory end to end against a stand-in that enforces requests_per_second the way the
+    real site does (429s past it), and answers some requests w/ 503s / 429s anyway. the crawl's budget is the same
+    requests_per_second, so rate_limited_429s should stay 0. stage_s is where the time went (PipelineMetrics)
+    """
+    PipelineMetrics.reset_metrics()
+    site_pages = load_fixture_site()
+    with offline_workspace(), StandInServer(site_pages, latency=latency, error_rate=error_rate,
+                                            throttle_rate=throttle_rate, max_requests_per_second=requests_per_second,
+                                            seed=0) as stand_in:
+        start = time.perf_counter()
+        url_df = TherapistURLScraper('benchmark', 250, 100, requests_per_second=requests_per_second,
+                                     base_url=stand_in.url('')).url_df
+        therapist_directory = TherapistDirectory('benchmark', url_df, requests_per_second=requests_per_second,
+                                                 retry_backoff=0.5, metrics_format=None)
+        build_time = time.perf_counter() - start
+        directory_rows = pd.read_csv(therapist_directory.directory_path).shape[0]
+    request_times = [request_time for request_time, _ in stand_in.request_log]
+    metrics = PipelineMetrics.get_metrics().snapshot()
+    return {
+        'requests_per_s_budget': requests_per_second,
+        'requests': len(request_times),
+        'requests_per_s': (len(request_times) - 1) / (request_times[-1] - request_times[0]),
+        'rate_limited_429s': stand_in.rate_limited,
+        'injected_failures': stand_in.status_counts[503] + stand_in.status_counts[429] - stand_in.rate_limited,
+        'retries': metrics['counters'].get('retries', 0),
+        'directory_rows': directory_rows,
+        'build_s': build_time,
+        'profiles_per_s': url_df.shape[0] / build_time,
+        'stage_s': {stage: histogram['sum'] for stage, histogram in metrics['histograms'].items()}
+    }
+
+
+def benchmark_incremental(requests_per_second=100):
+    """
+    a full crawl of a stand-in that sends ETag / Last-Modified, then an incremental one (conditional requests) of
+    the same, unchanged site. the second crawl has to send one request per profile, get a 304 for every one of
+    them, reuse every record from the page cache w/o parsing a page, and write the same directory, or this raises
+    """
+    site_pages = load_fixture_site()
+    with offline_workspace(), StandInServer(site_pages, send_validators=True, seed=0) as stand_in:
+        url_df = get_fixture_url_df(site_pages, stand_in.url(''))
+        start = time.perf_counter()
+        full_crawl = TherapistDirectory('benchmark', url_df, requests_per_second=requests_per_second,
+                                        parse_processes=1, metrics_format=None)
+        full_time = time.perf_counter() - start
+        full_requests, full_not_modified = len(stand_in.request_log), stand_in.status_counts[304]
+
+        PipelineMetrics.reset_metrics()
+        start = time.perf_counter()
+        incremental_crawl = TherapistDirectory('benchmark', url_df, requests_per_second=requests_per_second,
+                                               parse_processes=1, incremental=True, metrics_format=None)
+        incremental_time = time.perf_counter() - start
+        pages_parsed = PipelineMetrics.get_metrics().snapshot()['histograms'].get('extract_page', {}).get('count', 0)
+        full_df, incremental_df = (load_directory_csv(directory.directory_path).set_index('therapist_url').sort_index()
+                                   for directory in (full_crawl, incremental_crawl))
+
+    incremental_requests = len(stand_in.request_log) - full_requests
+    not_modified = stand_in.status_counts[304] - full_not_modified
+    if incremental_requests != url_df.shape[0] or not_modified != url_df.shape[0]:
+        raise AssertionError(f'incremental crawl: {incremental_requests} requests, {not_modified} 304s for '
+                             f'{url_df.shape[0]} unchanged profiles')
+    if pages_parsed or incremental_crawl.unchanged_profiles != url_df.shape[0]:
+        raise AssertionError(f'incremental crawl parsed {pages_parsed} pages, reused '
+                             f'{incremental_crawl.unchanged_profiles} records')
+    if not incremental_df.equals(full_df):
+        raise AssertionError('incremental crawl wrote a different directory')
+    return {
+        'profiles': url_df.shape[0],
+        'full_crawl_s': full_time,
+        'incremental_requests': incremental_requests,
+        'incremental_304s': not_modified,
+        'incremental_pages_parsed': pages_parsed,
+        'incremental_records_reused': incremental_crawl.unchanged_profiles,
+        'incremental_crawl_s': incremental_time
+    }
+
+
+def benchmark_reparse(cache_pages=20, reparses=3):
+    """
+    TherapistDirectory.reparse from a crawl's page cache: back to back reparses (from the cached page text, and
+    from the html) each have to get their own directory file, match the crawl's directory and make no requests.
+    then the site's pages go through a PageCache capped at about cache_pages pages, stored alternately by two
+    instances of it (like two crawl workers sharing a state's cache). it has to stay under its cap after every
+    store, keep the newest pages, and hold exactly the objects its index says it does. raises if not
+    """
+    site_pages = load_fixture_site()
+    with offline_workspace() as workspace, StandInServer(site_pages, seed=0) as stand_in:
+        url_df = get_fixture_url_df(site_pages, stand_in.url(''))
+        crawl_path = TherapistDirectory('benchmark', url_df, requests_per_second=100, parse_processes=1,
+                                        metrics_format=None).directory_path
+        crawl_requests = len(stand_in.request_log)
+        start = time.perf_counter()
+        reparse_paths = [TherapistDirectory.reparse('benchmark', parse_processes=1, from_html=i % 2 == 1)
+                         for i in range(reparses)]
+        reparse_time = (time.perf_counter() - start) / reparses
+        if len(stand_in.request_log) != crawl_requests:
+            raise AssertionError('reparse made requests')
+        if len(set(reparse_paths)) != reparses:
+            raise AssertionError(f'{reparses} reparses wrote to {len(set(reparse_paths))} directory files')
+        crawl_df = load_directory_csv(crawl_path).set_index('therapist_url').sort_index()
+        for reparse_path in reparse_paths:
+            if not load_directory_csv(reparse_path).set_index('therapist_url').sort_index().equals(crawl_df):
+                raise AssertionError(f'{os.path.basename(reparse_path)} differs from the crawl\'s directory')
+
+        # eviction: pages stored oldest first, the cap is about cache_pages of them
+        profile_pages = [(url, gender, site_pages[url.replace(stand_in.url(''), '')])
+                         for gender, url in url_df[['Gender', 'URL']].values]
+        page_bytes = sum(len(gzip.compress(page_html.encode('utf-8'))) for _, _, page_html in profile_pages)
+        max_bytes = page_bytes / len(profile_pages) * cache_pages
+        page_caches = [PageCache(os.path.join(workspace, 'eviction_cache'), max_bytes=max_bytes) for _ in range(2)]
+        start = time.perf_counter()
+        for i, (url, gender, page_html) in enumerate(profile_pages):
+            page_caches[i % 2].store(url, gender, page_html)
+            cache_bytes = page_caches[i % 2].get_total_bytes()  # both instances' pages
+            if cache_bytes > max_bytes or page_caches[i % 2].total_bytes != cache_bytes:
+                raise AssertionError(f'page cache at {cache_bytes} bytes ({page_caches[i % 2].total_bytes} by its own '
+                                     f'count), over its {max_bytes:.0f} cap')
+        store_time = (time.perf_counter() - start) / len(profile_pages)
+        page_caches[1].close()
+        page_cache = page_caches[0]
+        page_cache.total_bytes = page_cache.get_total_bytes()
+        cached_urls = [url for url, _, _, _ in page_cache.iter_pages()]
+        if not cached_urls or cached_urls != [url for url, _, _ in profile_pages[-len(cached_urls):]]:
+            raise AssertionError('eviction kept something other than the newest pages')
+        object_paths = glob.glob(os.path.join(page_cache.cache_dir, 'objects', '*', '*.gz'))
+        indexed_bytes = page_cache.connection.execute('SELECT SUM(size_bytes) FROM objects').fetchone()[0]
+        if not page_cache.total_bytes == indexed_bytes == sum(os.path.getsize(path) for path in object_paths):
+            raise AssertionError('evicted page objects left behind, or the cache lost count of its size')
+        page_cache.close()
+    return {
+        'profiles': url_df.shape[0],
+        'reparse_s': reparse_time,
+        'reparse_profiles_per_s': url_df.shape[0] / reparse_time,
+        'cache_max_kb': max_bytes / 1000,
+        'cache_pages_kept': len(cached_urls),
+        'cache_store_ms': store_time * 1000
+    }
+
+
+def run_crawl_process(*args, **kwargs):
+    # process target for a crawl that gets killed. its own process group, so the kill takes its extraction workers
+    os.setpgrp()
+    TherapistDirectory(*args, **kwargs)
+
+
+def run_crawl_killed_after_clean(*args, **kwargs):
+    # process target for a crawl that dies right after its clean directory is written (raw file already removed)
+    TherapistDirectory.save_compact_directory = staticmethod(lambda directory_path: os.kill(os.getpid(),
+                                                                                           signal.SIGKILL))
+    TherapistDirectory(*args, **kwargs)
+
+
+def benchmark_resume(requests_per_second=20, kill_after=20):
+    """
+    a crawl killed outright (SIGKILL, nothing gets to clean up) after kill_after profile requests, then resumed w/
+    TherapistDirectory(..., resume=True). no profile may be requested twice across the two runs, and the resumed
+    run's directory has to have every profile, or this raises. then a second crawl dies after writing its clean
+    directory but before the Parquet copy / vectors: resuming it has to send no requests, leave the directory as it
+    was and write the rest
+    """
+    site_pages = load_fixture_site()
+    with offline_workspace(), StandInServer(site_pages, seed=0) as stand_in:
+        url_df = get_fixture_url_df(site_pages, stand_in.url(''))
+        crawl = multiprocessing.Process(target=run_crawl_process, args=('benchmark', url_df),
+                                        kwargs={'requests_per_second': requests_per_second, 'parse_processes': 1,
+                                                'metrics_format': None})
+        crawl.start()
+        while len(stand_in.request_log) < kill_after and crawl.is_alive():
+            time.sleep(0.005)
+        time.sleep(0.5 / requests_per_second)  # halfway to the next request, so none is cut off mid-response
+        os.killpg(crawl.pid, signal.SIGKILL)
+        crawl.join()
+        requests_before_kill = len(stand_in.request_log)
+        crawl_state = CrawlStateStore(CrawlStateStore.get_db_path('benchmark'))
+        status_counts = crawl_state.get_status_counts()
+        crawl_state.close()
+
+        start = time.perf_counter()
+        therapist_directory = TherapistDirectory('benchmark', resume=True, requests_per_second=requests_per_second,
+                                                 parse_processes=1, metrics_format=None)
+        resume_time = time.perf_counter() - start
+        directory_urls = set(pd.read_csv(therapist_directory.directory_path)['therapist_url'])
+        requests_after_resume = len(stand_in.request_log)
+
+        crawl = multiprocessing.Process(target=run_crawl_killed_after_clean, args=('benchmark', url_df),
+                                        kwargs={'requests_per_second': requests_per_second, 'parse_processes': 1,
+                                                'metrics_format': None})
+        crawl.start()
+        crawl.join()
+        requests_before_clean_kill = len(stand_in.request_log)
+        crawl_state = CrawlStateStore(CrawlStateStore.get_db_path('benchmark'))
+        cleaned_run = crawl_state.get_unfinished_run()
+        crawl_state.close()
+        cleaned_df = load_directory_csv(cleaned_run['directory_path'])
+        TherapistDirectory('benchmark', resume=True, requests_per_second=requests_per_second, parse_processes=1,
+                           metrics_format=None)
+        crawl_state = CrawlStateStore(CrawlStateStore.get_db_path('benchmark'))
+        unfinished_run = crawl_state.get_unfinished_run()
+        crawl_state.close()
+        if crawl.exitcode != -signal.SIGKILL:
+            raise AssertionError(f'the second crawl was not killed after its clean (exit code {crawl.exitcode})')
+        if len(stand_in.request_log) != requests_before_clean_kill or unfinished_run is not None:
+            raise AssertionError('resuming after the clean sent requests, or left the run unfinished')
+        if not load_directory_csv(cleaned_run['directory_path']).equals(cleaned_df) or \
+                len(cleaned_df) != url_df.shape[0]:
+            raise AssertionError(f'resuming after the clean rewrote the directory ({len(cleaned_df)} rows before)')
+        if not os.path.exists(CompactDirectory.get_parquet_path(cleaned_run['directory_path'])) or \
+                not os.path.isdir(DescriptionVectors.get_vectors_dir(cleaned_run['directory_path'])):
+            raise AssertionError('resuming after the clean did not write the Parquet copy / description vectors')
+        if not cleaned_run['cleaned']:
+            raise AssertionError('the crawl state did not record the clean')
+
+    if not kill_after <= requests_before_kill < url_df.shape[0]:
+        raise AssertionError(f'the crawl was not interrupted partway ({requests_before_kill} requests before the kill)')
+    refetched = [path for path, count in collections.Counter(
+        path for _, path in stand_in.request_log[:requests_after_resume]).items() if count > 1]
+    if refetched:
+        raise AssertionError(f'{len(refetched)} profiles requested again after resuming, e.g. {refetched[0]}')
+    missing_urls = set(url_df['URL']) - directory_urls
+    if missing_urls:
+        raise AssertionError(f'{len(missing_urls)} profiles missing from the resumed directory')
+    return {
+        'profiles': url_df.shape[0],
+        'requests_before_kill': requests_before_kill,
+        'fetched_not_written_at_kill': status_counts.get('fetched', 0),
+        'requests_after_resume': requests_after_resume - requests_before_kill,
+        'refetched_profiles': len(refetched),
+        'directory_rows': len(directory_urls),
+        'resume_s': resume_time,
+        'requests_after_resume_past_clean': len(stand_in.request_log) - requests_before_clean_kill
+    }
+
+
+def benchmark_orchestrator(workers=2, requests_per_second=20, shard_size=20):
+    """
+    CrawlOrchestrator w/ worker processes against a stand-in, for the fixture state and one whose results pages
+    are all empty. both states have to get merged: the fixture state's directory w/ every profile, requested once
+    each, the empty state's w/ no rows. raises if not. stand_in_429s counts requests over requests_per_second, which
+    the workers' shared budget should keep at 0
+    """
+    site_pages = load_fixture_site()
+    no_results = open(f'{SEARCH_PAGES}/no_results.html', encoding='utf-8').read()
+    site_pages.update({f'/us/therapists/empty?category={gender}&page=1': no_results for gender in GENDERS})
+    with offline_workspace() as workspace, StandInServer(site_pages, max_requests_per_second=requests_per_second,
+                                                         seed=0) as stand_in:
+        url_df = get_fixture_url_df(site_pages, stand_in.url(''))
+        queue_path = os.path.join(workspace, 'scraped_data', 'crawl_queue.sqlite')
+        start = time.perf_counter()
+        directory_paths = CrawlOrchestrator(['benchmark', 'empty'], workers, requests_per_second, shard_size,
+                                            metrics_format=None, queue_path=queue_path, base_url=stand_in.url(''),
+                                            poll_interval=0.2).run()
+        crawl_time = time.perf_counter() - start
+        directory_urls = {state: pd.read_csv(directory_path)['therapist_url'].tolist()
+                          for state, directory_path in directory_paths.items()}
+        crawl_queue = CrawlQueue(queue_path)
+        status_counts = crawl_queue.get_status_counts()
+        crawl_queue.close()
+
+    if set(directory_paths) != {'benchmark', 'empty'}:
+        raise AssertionError(f'only {sorted(directory_paths)} merged, shards: {status_counts}')
+    if directory_urls['empty'] or sorted(directory_urls['benchmark']) != sorted(url_df['URL']):
+        raise AssertionError(f'merged directories have {len(directory_urls["benchmark"])} / '
+                             f'{len(directory_urls["empty"])} rows for {url_df.shape[0]} / 0 profiles')
+    refetched = [path for path, count in collections.Counter(path for _, path in stand_in.request_log).items()
+                 if count > 1]
+    if refetched:
+        raise AssertionError(f'{len(refetched)} pages requested more than once, e.g. {refetched[0]}')
+    request_times = [request_time for request_time, _ in stand_in.request_log]
+    return {
+        'workers': workers,
+        'profiles': url_df.shape[0],
+        'shards': status_counts,
+        'requests': len(request_times),
+        'requests_per_s_budget': requests_per_second,
+        'requests_per_s': (len(request_times) - 1) / (request_times[-1] - request_times[0]),
+        'stand_in_429s': stand_in.rate_limited,
+        'crawl_s': crawl_time
+    }
+
+
+def benchmark_politeness(pages=400, server_rate=20, latency=0.02, outage=3):
+    """
+    PolitenessController against a stand-in that enforces server_rate (429 + Retry-After past it):
+    - aimd: starts at a quarter of server_rate and is allowed up to twice it, so it has to find the limit itself
+    - outage: at server_rate, the stand-in answers everything w/ a 503 for outage seconds partway through. the
+        circuit breaker should hold requests back until it's over instead of spending every URL's retries on it
+    every page has to come back w/ a 200 in both
+    """
+    page_html = open(sorted(glob.glob(FIXTURE_PAGES))[0], encoding='utf-8').read()
+    site_pages = {f'/us/therapists/benchmark-{i}': page_html for i in range(pages)}
+    results = {}
+    with StandInServer(site_pages, latency=latency, max_requests_per_second=server_rate, seed=0) as stand_in:
+        politeness = PolitenessController(server_rate / 4, max_requests_per_second=server_rate * 2,
+                                          increase_step=server_rate / 200)
+        statuses, start = [], time.perf_counter()
+        AsyncFetchEngine(rate_limiter=politeness, retry_backoff=0.2).run(
+            [stand_in.url(path) for path in site_pages], lambda page: statuses.append(page['status']))
+        aimd_time = time.perf_counter() - start
+    if statuses.count(200) != pages:
+        raise AssertionError(f'aimd: only {statuses.count(200)} of {pages} pages fetched')
+    results.update({
+        'server_requests_per_s': server_rate,
+        'aimd_requests_per_s': len(stand_in.request_log) / aimd_time,
+        'aimd_pages_per_s': pages / aimd_time,
+        'aimd_rate_limited_429s': stand_in.rate_limited,
+        'aimd_rate_decreases': politeness.rate_decreases,
+        'aimd_final_requests_per_s': politeness.rate
+    })
+
+    outage_pages = dict(list(site_pages.items())[:server_rate * (outage + 6)])
+    with StandInServer(outage_pages, latency=latency, seed=0) as stand_in:
+        politeness = PolitenessController(server_rate, cooldown=0.5, max_cooldown=2)
+        fetch_engine = AsyncFetchEngine(rate_limiter=politeness, max_attempts=20, retry_backoff=0.1, max_backoff=0.5)
+        outage_timer = threading.Timer(2, stand_in.start_outage, args=(outage,))
+        statuses, start = [], time.perf_counter()
+        outage_timer.start()
+        fetch_engine.run([stand_in.url(path) for path in outage_pages], lambda page: statuses.append(page['status']))
+        outage_time = time.perf_counter() - start
+    outage_requests = sum(stand_in.outage_until - outage <= request_time < stand_in.outage_until
+                          for request_time, _ in stand_in.request_log)
+    if statuses.count(200) != len(outage_pages):
+        raise AssertionError(f'outage: only {statuses.count(200)} of {len(outage_pages)} pages fetched')
+    results.update({
+        'outage_s': outage,
+        'outage_requests': outage_requests,
+        'outage_requests_at_full_rate': outage * server_rate,
+        'outage_circuit_breaker_opens': politeness.breaker_opens,
+        'outage_pages_per_s': len(outage_pages) / outage_time
+    })
+    return results
+
+
+BENCHMARKS = {
+    'keyword_matching': benchmark_keyword_matching,
+    'extraction': benchmark_extraction,
+    'dom_extraction': benchmark_dom_extraction,
+    'cleaning': benchmark_cleaning,
+    'storage': benchmark_storage,
+    'directory_index': benchmark_directory_index,
+    'description_vectors': benchmark_description_vectors,
+    'snapshot_diff': benchmark_snapshot_diff,
+    'discovery': benchmark_discovery,
+    'directory_build': benchmark_directory_build,
+    'incremental': benchmark_incremental,
+    'resume': benchmark_resume,
+    'orchestrator': benchmark_orchestrator,
+    'reparse': benchmark_reparse,
+    'politeness': benchmark_politeness
+}
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmarks(names=None, output_path=None):
+    # runs the named benchmarks (all by default) and writes them w/ the commit / machine they ran on to output_path
+    results = {'commit': get_commit(), 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'cpu_count': os.cpu_count(), 'benchmarks': {}}
+    for name in names or BENCHMARKS:
+        results['benchmarks'][name] = BENCHMARKS[name]()
+        for metric, val in results['benchmarks'][name].items():
+            print(f'{name}.{metric}: {val:.3f}' if isinstance(val, float) else f'{name}.{metric}: {val}')
+    output_path = output_path or f'../benchmark_results/{datetime.datetime.now().date()}_{results["commit"]}.json'
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f'results written to {output_path}')
+    return results
+
+
+def compare_results(old, new):
+    # new / old for every number both runs have. times going up or rates going down is a regression
+    for name, metrics in new['benchmarks'].items():
+        for metric, val in metrics.items():
+            old_val = old['benchmarks'].get(name, {}).get(metric)
+            if isinstance(val, (int, float)) and isinstance(old_val, (int, float)) and old_val:
+                print(f'{name}.{metric}: {old_val:.3f} ({old["commit"]}) -> {val:.3f} ({new["commit"]}) '
+                      f'{val / old_val:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks, results written to a JSON file')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--output', help='results file (default: ../benchmark_results/<date>_<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(args.only, args.output)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as old_file:
+            compare_results(json.load(old_file), benchmark_results)
@@ -0,0 +1,155 @@
+from record_sink import RecordSink
+from utility import DirectoryBuilder, TextProcessing
+import ast
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class CompactDirectory:
+    """
+    Parameters:
+    - directory_df (DataFrame): the directory in compact form (see from_frame): multi-valued columns hold bitmasks,
+        the low-cardinality columns are categoricals
+    - vocabularies (dict): field -> list of values. bit i of a field's bitmask == vocabularies[field][i]
+
+    Typed, compact form of the clean directory. The multi-valued fields (insurance, issues, therapy types, ...) are
+    sets in a record and "{'a', 'b'}" strings in the CSV; here each one is a multi-hot bitmask against its closed
+    vocabulary in reference_data/ (an int in memory, a fixed width bitset in the Parquet file), so they never
+    need re-parsing to be filtered on (see has). Gender, availability, zipcode and the Y / N/A flags are categoricals.
+    save / load round trip through Parquet; to_frame gives back the DirectoryBuilder layout
+    """
+    # field -> reference file its values come from. ages don't have one, they're the groups the keyword scan matches
+    multi_valued_cols = {
+        'ages_covered': None,
+        'issues_covered': '../reference_data/issues.txt',
+        'therapy_types': '../reference_data/therapy_types.txt',
+        'insurance': '../reference_data/insurance.txt',
+        'languages_spoken': '../reference_data/languages.txt',
+        'ethnicities_served': '../reference_data/ethnicities.txt',
+        'faiths_served': '../reference_data/faith.txt'
+    }
+    age_groups = ['Toddler', 'Children (6 to 10)', 'Preteen', 'Teen', 'Adults', 'Elders (65+)']
+    categorical_cols = ['therapist_gender', 'available', 'in_person', 'online', 'zipcode', 'lgbtq_status',
+                        'veteran_status']
+
+    def __init__(self, directory_df, vocabularies):
+        self.directory_df, self.vocabularies = directory_df, vocabularies
+        self.value_bits = {field: {val: 1 << i for i, val in enumerate(vocabulary)}
+                           for field, vocabulary in vocabularies.items()}
+
+    @classmethod
+    def get_vocabularies(cls):
+        # sorted so bit positions don't depend on set order. saved with the data, so a later edit to a reference
+        # file can't change what an existing file decodes to
+        vocabularies = {}
+        for field, ref_file in cls.multi_valued_cols.items():
+            values = cls.age_groups if ref_file is None else TextProcessing.get_reference_data(ref_file)
+            vocabularies[field] = sorted(val for val in values if val)
+        return vocabularies
+
+    @classmethod
+    def from_frame(cls, directory_df, vocabularies=None):
+        """directory frame as DirectoryBuilder writes it (set columns as sets or as "{'a', 'b'}" strings, 'N/A' for
+        none) -> CompactDirectory"""
+        compact = cls(None, vocabularies or cls.get_vocabularies())
+        directory_df = directory_df.reset_index(drop=True)
+        compact.directory_df = directory_df.assign(**{
+            field: compact.encode_column(directory_df[field], field) for field in cls.multi_valued_cols})
+        compact.directory_df = compact.directory_df.astype({col: 'category' for col in cls.categorical_cols})
+        return compact
+
+    @classmethod
+    def from_csv(cls, csv_path, chunksize=10000):
+        # directory CSV -> CompactDirectory, chunk by chunk so the string form is never all in memory at once
+        vocabularies = cls.get_vocabularies()
+        chunks = [cls.from_frame(chunk, vocabularies).directory_df
+                  for chunk in RecordSink.read_chunks(csv_path, chunksize)]
+        directory_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(
+            columns=DirectoryBuilder.get_therapist_profile_cols())
+        # categories differ chunk to chunk, so the concat falls back to object
+        return cls(directory_df.astype({col: 'category' for col in cls.categorical_cols}), vocabularies)
+
+    def encode_column(self, column, field):
+        # each distinct value is only parsed once; directories repeat the same sets a lot (ages, insurance)
+        keys = column.map(lambda val: val if isinstance(val, str) else frozenset(val))
+        codes, uniques = pd.factorize(keys)
+        bitmasks = np.array([self.encode_value(val, field) for val in uniques] + [0], dtype=object)
+        return pd.Series(bitmasks[codes], index=column.index, name=field)  # code -1 (NaN) -> last slot, no values
+
+    def encode_value(self, val, field):
+        if isinstance(val, str):
+            val = ast.literal_eval(val) if val.startswith('{') else ()  # 'N/A' / '' == no values
+        bitmask = 0
+        for item in val:
+            if item not in self.value_bits[field]:
+                self.add_value(item, field)
+            bitmask |= self.value_bits[field][item]
+        return bitmask
+
+    def add_value(self, val, field):
+        # values are matched against the reference files, so this one was scraped before the file was edited. it
+        # gets the next free bit rather than failing the save; the vocabulary is saved w/ the data, so it decodes
+        # the same later. from_csv's chunks share vocabularies, so they all see it
+        logging.info(f'$|$ Function: Compact Directory | Field: {field} | Value: {val!r} | '
+                     f'Error: not in the vocabulary, added as bit {len(self.vocabularies[field])}')
+        self.value_bits[field][val] = 1 << len(self.vocabularies[field])
+        self.vocabularies[field].append(val)
+
+    def decode_value(self, bitmask, field):
+        # bitmask -> set of values, 'N/A' for none (same as the scraper)
+        if not bitmask:
+            return 'N/A'
+        return {val for val, bit in self.value_bits[field].items() if bitmask & bit}
+
+    def to_frame(self):
+        # back to the DirectoryBuilder layout: sets, 'N/A' for none, plain object columns
+        directory_df = self.directory_df.astype({col: object for col in self.categorical_cols})
+        return directory_df.assign(**{
+            field: [self.decode_value(bitmask, field) for bitmask in directory_df[field]]
+            for field in self.multi_valued_cols})
+
+    def has(self, field, val):
+        # boolean mask of the therapists whose field includes val, e.g. has('insurance', 'Aetna')
+        bit = self.value_bits[field][val]
+        return (self.directory_df[field].to_numpy() & bit).astype(bool)
+
+    def get_value_matrix(self, field):
+        # rows x vocabulary boolean matrix of a field: column i == has(field, vocabularies[field][i]), all at once
+        width = self.get_bitset_width(field)
+        bitsets = b''.join(bitmask.to_bytes(width, 'little') for bitmask in self.directory_df[field])
+        bits = np.unpackbits(np.frombuffer(bitsets, dtype=np.uint8).reshape(-1, width), axis=1, bitorder='little')
+        return bits[:, :len(self.vocabularies[field])].astype(bool)
+
+    def get_bitset_width(self, field):
+        # bytes per row in the Parquet file
+        return (len(self.vocabularies[field]) + 7) // 8
+
+    def save(self, path):
+        columns = {}
+        for col in self.directory_df.columns:
+            if col in self.multi_valued_cols:  # little endian bitset, bit i == vocabularies[col][i]
+                width = self.get_bitset_width(col)
+                columns[col] = pa.array([bitmask.to_bytes(width, 'little') for bitmask in self.directory_df[col]],
+                                        type=pa.binary(width))
+            else:
+                columns[col] = pa.Array.from_pandas(self.directory_df[col])
+        table = pa.table(columns).replace_schema_metadata({'vocabularies': json.dumps(self.vocabularies)})
+        pq.write_table(table, path, compression='zstd')
+
+    @classmethod
+    def load(cls, path):
+        table = pq.read_table(path)
+        vocabularies = json.loads(table.schema.metadata[b'vocabularies'])
+        directory_df = table.drop_columns(list(vocabularies)).to_pandas()
+        for field in vocabularies:
+            directory_df[field] = np.array([int.from_bytes(bitset, 'little')
+                                            for bitset in table.column(field).to_pylist()], dtype=object)
+        return cls(directory_df[table.column_names], vocabularies)
+
+    @staticmethod
+    def get_parquet_path(csv_path):
+        return csv_path[:-len('.csv')] + '.parquet' if csv_path.endswith('.csv') else csv_path + '.parquet'
@@ -0,0 +1,227 @@
+from contextlib import contextmanager
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+
+class CrawlQueue:
+    """
+    Parameters:
+    - db_path (str): SQLite file holding the queue (see get_db_path). every worker, on every machine, opens the same
+        file, so it has to be on storage they all share, with working file locks
+    - lease_seconds (float): how long a claimed shard is held without a renew before another worker may take it
+        over (its worker is assumed dead). workers renew well before it runs out (see CrawlWorker.keep_lease)
+    - max_attempts (int): claims per shard before it's given up on and marked failed
+
+    Shared work queue for crawling several states at once (see CrawlOrchestrator). Each state goes through three
+    kinds of shard: 'discovery' (find its therapist URLs), 'profiles' (crawl a slice of those URLs) and 'merge'
+    (clean every slice into the state's directory). Finishing a discovery shard adds its profile shards, and the
+    last discovery / profile shard of a state to finish (or fail for good) adds the merge, in the same transaction,
+    so any worker can pick up where another left off
+
+    rate_budget is a token bucket kept in the same file, so one request budget covers every worker (see
+    SharedTokenBucket). Journal mode is left at the default since WAL doesn't work over a network filesystem
+    """
+    kinds = ['discovery', 'profiles', 'merge']
+
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        self.db_path, self.lease_seconds, self.max_attempts = db_path, lease_seconds, max_attempts
+        # autocommit mode, transactions are opened explicitly (BEGIN IMMEDIATE) so claims never race
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()  # the lease thread and the token bucket share the connection
+        self.create_tables()
+
+    @staticmethod
+    def get_db_path():
+        return '../scraped_data/crawl_queue.sqlite'
+
+    @contextmanager
+    def transaction(self):
+        # write lock up front, so two workers can't both read a shard as pending and claim it
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def create_tables(self):
+        with self.transaction() as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS shards (
+                    shard_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    state TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    error TEXT,
+                    result TEXT,
+                    added_at REAL,
+                    lease_until REAL,
+                    finished_at REAL
+                )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS shards_status ON shards (status)')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS rate_budget (
+                    budget TEXT PRIMARY KEY,
+                    requests_per_second REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )''')
+
+    def add_states(self, states, discovery_settings):
+        # one discovery shard per state not already in the queue (re-running the orchestrator picks up where it
+        # stopped). discovery_settings is handed to the shard, see CrawlWorker.discover. returns the states added
+        with self.transaction() as connection:
+            queued = {row[0] for row in connection.execute('SELECT DISTINCT state FROM shards')}
+            new_states = [state for state in dict.fromkeys(states) if state not in queued]
+            for state in new_states:
+                self.insert_shard(connection, state, 'discovery', discovery_settings)
+        return new_states
+
+    @staticmethod
+    def insert_shard(connection, state, kind, payload):
+        connection.execute('INSERT INTO shards (state, kind, payload, added_at) VALUES (?, ?, ?, ?)',
+                           (state, kind, json.dumps(payload), time.time()))
+
+    def claim(self, worker_id):
+        # next shard for worker_id, or None if there's nothing to do right now. merges go first (they don't use
+        # the request budget), then shards in the order they were added. a claimed shard whose lease ran out is
+        # up for grabs again
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT shard_id, state, kind, payload, attempts FROM shards "
+                "WHERE status = 'pending' OR (status = 'claimed' AND lease_until < ?) "
+                "ORDER BY kind = 'merge' DESC, shard_id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE shards SET status = 'claimed', worker = ?, attempts = attempts + 1, "
+                               "lease_until = ? WHERE shard_id = ?", (worker_id, now + self.lease_seconds, row[0]))
+        return {'shard_id': row[0], 'state': row[1], 'kind': row[2], 'payload': json.loads(row[3]),
+                'attempts': row[4] + 1}
+
+    def renew(self, shard_id, worker_id):
+        # False if the shard isn't ours anymore (lease ran out and another worker took it)
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE shards SET lease_until = ? WHERE shard_id = ? AND worker = ? "
+                                        "AND status = 'claimed'", (time.time() + self.lease_seconds, shard_id,
+                                                                   worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, shard_id, result=None, next_shards=()):
+        """
+        marks a shard done w/ its result (anything JSON serializable). next_shards is (kind, payload) pairs for
+        the same state, added in the same transaction (e.g. the profile shards a discovery shard found)
+        """
+        with self.transaction() as connection:
+            state, kind = connection.execute('SELECT state, kind FROM shards WHERE shard_id = ?',
+                                             (shard_id,)).fetchone()
+            connection.execute("UPDATE shards SET status = 'done', result = ?, error = NULL, finished_at = ? "
+                               "WHERE shard_id = ?", (json.dumps(result), time.time(), shard_id))
+            for next_kind, payload in next_shards:
+                self.insert_shard(connection, state, next_kind, payload)
+            self.add_merge_if_ready(connection, state, kind)
+
+    def fail(self, shard_id, error):
+        # back to pending for another worker, or failed once it's been tried max_attempts times
+        with self.transaction() as connection:
+            state, kind, attempts = connection.execute('SELECT state, kind, attempts FROM shards WHERE shard_id = ?',
+                                                       (shard_id,)).fetchone()
+            status = 'failed' if attempts >= self.max_attempts else 'pending'
+            connection.execute('UPDATE shards SET status = ?, error = ?, worker = NULL, lease_until = NULL '
+                               'WHERE shard_id = ?', (status, error, shard_id))
+            if status == 'failed':
+                self.add_merge_if_ready(connection, state, kind)
+        return status
+
+    @staticmethod
+    def add_merge_if_ready(connection, state, kind):
+        # once no discovery / profile shard of the state is left to run, merge whatever made it (failed shards are
+        # skipped). a discovery that found no URLs, or failed for good, still gets its (empty) merge
+        if kind == 'merge':
+            return
+        remaining = connection.execute("SELECT COUNT(*) FROM shards WHERE state = ? AND kind IN "
+                                       "('discovery', 'profiles') AND status IN ('pending', 'claimed')",
+                                       (state,)).fetchone()[0]
+        merged = connection.execute("SELECT 1 FROM shards WHERE state = ? AND kind = 'merge'", (state,)).fetchone()
+        if not remaining and not merged:
+            CrawlQueue.insert_shard(connection, state, 'merge', {})
+
+    def get_results(self, state, kind):
+        # {shard_id: result} for the state's finished shards of one kind
+        with self.lock:
+            rows = self.connection.execute("SELECT shard_id, result FROM shards WHERE state = ? AND kind = ? AND "
+                                           "status = 'done' ORDER BY shard_id", (state, kind)).fetchall()
+        return {shard_id: json.loads(result) for shard_id, result in rows}
+
+    def get_status_counts(self):
+        # {'profiles done': 12, ...}
+        with self.lock:
+            rows = self.connection.execute('SELECT kind, status, COUNT(*) FROM shards GROUP BY kind, status')
+            return {f'{kind} {status}': count for kind, status, count in rows.fetchall()}
+
+    def is_finished(self):
+        # nothing left to run or running. more shards only ever come from running ones
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM shards WHERE status IN ('pending', 'claimed')"
+                                           ).fetchone()[0] == 0
+
+    def set_rate(self, requests_per_second):
+        # the budget every worker shares. workers on other machines read it from here, so they don't need it passed
+        with self.transaction() as connection:
+            connection.execute('INSERT INTO rate_budget VALUES (?, ?, 1, ?) ON CONFLICT (budget) DO UPDATE SET '
+                               'requests_per_second = excluded.requests_per_second',
+                               ('requests', requests_per_second, time.time()))
+
+    def get_rate(self):
+        # the shared budget set_rate stored, None before it's been set
+        with self.lock:
+            row = self.connection.execute("SELECT requests_per_second FROM rate_budget WHERE budget = 'requests'"
+                                          ).fetchone()
+        return row[0] if row else None
+
+    def take_token(self):
+        # 0 if a request can go out now (the token is taken), otherwise seconds until the next token. same refill
+        # as a token bucket with capacity 1, off the wall clock since the workers can be on different machines
+        with self.transaction() as connection:
+            requests_per_second, tokens, updated_at = connection.execute(
+                "SELECT requests_per_second, tokens, updated_at FROM rate_budget WHERE budget = 'requests'"
+            ).fetchone()
+            now = time.time()
+            tokens = min(1, tokens + max(now - updated_at, 0) * requests_per_second)
+            wait = 0 if tokens >= 1 else (1 - tokens) / requests_per_second
+            connection.execute("UPDATE rate_budget SET tokens = ?, updated_at = ? WHERE budget = 'requests'",
+                               (tokens - 1 if wait == 0 else tokens, now))
+        return wait
+
+    def close(self):
+        self.connection.close()
+
+
+class SharedTokenBucket:
+    """
+    Parameters:
+    - crawl_queue (CrawlQueue): queue whose rate_budget is shared by every worker
+
+    Rate limiter for AsyncFetchEngine(..., rate_limiter=...), on its own or behind a PolitenessController: every
+    fetch engine on every worker takes its tokens from the one budget, so adding workers adds throughput only until
+    the combined rate hits the limit, never past it
+    """
+    def __init__(self, crawl_queue):
+        self.crawl_queue = crawl_queue
+        self.wait_time = 0  # total seconds spent waiting on the bucket
+
+    async def acquire(self):
+        while True:
+            wait = await asyncio.to_thread(self.crawl_queue.take_token)  # SQLite can block, keep it off the loop
+            if wait <= 0:
+                return
+            self.wait_time += wait
+            await asyncio.sleep(wait)
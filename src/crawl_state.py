@@ -0,0 +1,157 @@
+import pandas as pd
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class CrawlStateStore:
+    """
+    Parameters:
+    - db_path (str): SQLite file holding the crawl state, one per state (see get_db_path)
+    - commit_every (int): number of buffered updates that forces a commit
+    - commit_interval (float): seconds after which buffered updates are committed anyway
+
+    Durable frontier for multi-day crawls, keyed by therapist URL. Each URL moves pending -> fetched -> parsed
+    (or failed), with its attempt count and timestamps. A fetched page is kept (compressed) until its record is on
+    disk, so a crash between fetching and writing never means requesting the page again. runs keeps the files
+    each crawl writes to so an unfinished run can be resumed (TherapistDirectory(..., resume=True)), and whether
+    its clean directory was written already
+
+    Status updates are buffered and committed together in one transaction. Fetched pages and records written to
+    disk (mark_written) are committed right away, along with whatever else is buffered at the time
+    """
+    def __init__(self, db_path, commit_every=50, commit_interval=5):
+        self.db_path, self.commit_every, self.commit_interval = db_path, commit_every, commit_interval
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)  # we do our own locking
+        # rollback journal, same as CrawlQueue: shard crawl states sit in scraped_data/, which can be a network
+        # filesystem (see CrawlOrchestrator) where WAL doesn't work. set explicitly, older files are still in WAL mode
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.lock = threading.Lock()
+        self.pending_updates, self.last_commit = [], time.monotonic()
+        self.create_tables()
+
+    @staticmethod
+    def get_db_path(state, shard=None):
+        # a shard of a multi-state crawl (see CrawlOrchestrator) has its own frontier
+        if shard is not None:
+            return f'../scraped_data/{state}_shard{shard}_crawl_state.sqlite'
+        return f'../scraped_data/{state}_crawl_state.sqlite'
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS frontier (
+                    therapist_url TEXT PRIMARY KEY,
+                    therapist_gender TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    page_html BLOB,
+                    added_at REAL,
+                    fetched_at REAL,
+                    finished_at REAL
+                )''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS frontier_status ON frontier (status)')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    unique_id TEXT PRIMARY KEY,
+                    raw_path TEXT,
+                    directory_path TEXT,
+                    started_at REAL,
+                    finished_at REAL,
+                    cleaned_at REAL
+                )''')
+            # crawl states written before the clean was recorded separately
+            if 'cleaned_at' not in {row[1] for row in self.connection.execute('PRAGMA table_info(runs)')}:
+                self.connection.execute('ALTER TABLE runs ADD COLUMN cleaned_at REAL')
+
+    def start_run(self, unique_id, raw_path, directory_path, url_df):
+        # a new run replaces the frontier; url_df has columns ['Gender', 'URL']
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM frontier')
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO frontier (therapist_url, therapist_gender, added_at) VALUES (?, ?, ?)',
+                [(url, gender, now) for url, gender in zip(url_df['URL'], url_df['Gender'])])
+            self.connection.execute('INSERT OR REPLACE INTO runs (unique_id, raw_path, directory_path, started_at) '
+                                    'VALUES (?, ?, ?, ?)', (unique_id, raw_path, directory_path, now))
+
+    def get_unfinished_run(self):
+        # latest run that never finished, or None. cleaned is True if its clean directory was written (only the
+        # files made from the directory can be missing then)
+        row = self.connection.execute('SELECT unique_id, raw_path, directory_path, cleaned_at IS NOT NULL FROM runs '
+                                      'WHERE finished_at IS NULL ORDER BY started_at DESC LIMIT 1').fetchone()
+        return dict(zip(['unique_id', 'raw_path', 'directory_path', 'cleaned'], row)) if row else None
+
+    def mark_cleaned(self, unique_id):
+        # the clean directory is on disk, the raw records file can go
+        self.commit()
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE runs SET cleaned_at = ? WHERE unique_id = ?', (time.time(), unique_id))
+
+    def finish_run(self, unique_id):
+        self.commit()
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE runs SET finished_at = ? WHERE unique_id = ?', (time.time(), unique_id))
+
+    def get_urls(self, status=None):
+        # DataFrame w/ columns ['Gender', 'URL'] (same as the url scraper output), optionally for one status
+        query = 'SELECT therapist_gender AS Gender, therapist_url AS URL FROM frontier'
+        params = ()
+        if status:
+            query, params = query + ' WHERE status = ?', (status,)
+        return pd.read_sql_query(query + ' ORDER BY rowid', self.connection, params=params)
+
+    def get_fetched_pages(self):
+        # (url, gender, html) for pages fetched but not written out yet - parse these instead of fetching again
+        rows = self.connection.execute("SELECT therapist_url, therapist_gender, page_html FROM frontier "
+                                       "WHERE status = 'fetched' ORDER BY rowid")
+        for therapist_url, therapist_gender, page_html in rows.fetchall():
+            yield therapist_url, therapist_gender, zlib.decompress(page_html).decode('utf-8')
+
+    def get_status_counts(self):
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM frontier GROUP BY status').fetchall())
+
+    def mark_fetched(self, therapist_url, page_html, attempts=1):
+        # attempts is the number of requests it took (retries included)
+        self.queue_update("UPDATE frontier SET status = 'fetched', attempts = attempts + ?, error = NULL, "
+                          "page_html = ?, fetched_at = ? WHERE therapist_url = ?",
+                          (attempts, zlib.compress(page_html.encode('utf-8')), time.time(), therapist_url))
+        self.commit()  # a request we've paid for is never lost, whatever else is buffered goes out with it
+
+    def mark_fetch_error(self, therapist_url, error, attempts=1):
+        # stays pending until its program failure record is on disk (see mark_written)
+        self.queue_update('UPDATE frontier SET attempts = attempts + ?, error = ? WHERE therapist_url = ?',
+                          (attempts, error, therapist_url))
+
+    def mark_written(self, records):
+        # records made it to the raw records file: parsed, or failed for program failures. the page can go
+        now = time.time()
+        for record in records:
+            status = 'failed' if record['therapist_name'] == 'program failure' else 'parsed'
+            self.queue_update('UPDATE frontier SET status = ?, page_html = NULL, finished_at = ? '
+                              'WHERE therapist_url = ?', (status, now, record['therapist_url']))
+        self.commit()  # the records are durable now, so their status should be too
+
+    def queue_update(self, sql, params):
+        with self.lock:
+            self.pending_updates.append((sql, params))
+            due = (len(self.pending_updates) >= self.commit_every or
+                   time.monotonic() - self.last_commit >= self.commit_interval)
+        if due:
+            self.commit()
+
+    def commit(self):
+        # everything buffered goes out in one transaction
+        with self.lock:
+            if self.pending_updates:
+                with self.connection:
+                    for sql, params in self.pending_updates:
+                        self.connection.execute(sql, params)
+                self.pending_updates = []
+            self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
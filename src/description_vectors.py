@@ -0,0 +1,234 @@
+from pipeline_metrics import PipelineMetrics
+from record_sink import RecordSink
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import re
+import zlib
+
+
+class DescriptionEncoder:
+    """
+    Parameters:
+    - dimensions (int): length of each description vector (power of 2). every therapist costs dimensions * 4 bytes
+        on disk, 512 == 2KB
+    - feature_bits (int): size of the hashed term space the TF-IDF weights live in (2^feature_bits terms). only
+        the document frequencies / idf are kept at that size, never a vector
+    - idf (ndarray): float32 idf per hashed term (see set_idf / DescriptionVectors.build). None until then
+
+    Model-free text encoder for therapist descriptions: hashed TF-IDF over words and word pairs, folded down to
+    dimensions w/ a signed hash (terms that land in the same slot mostly cancel out instead of adding up), then
+    L2 normalized so a dot product is the cosine similarity. No vocabulary is kept, so it needs nothing but the
+    idf to encode new text the same way, offline
+
+    Works in batches: words are hashed once per distinct word in the batch, then word pairs, term counts and the
+    folding are NumPy ops over the whole batch
+    """
+    token_pattern = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+    missing_descriptions = {'', 'N/A', 'failed scrape', 'program failure', 'nan', 'None'}  # encoded as all zeros
+
+    def __init__(self, dimensions=512, feature_bits=20, idf=None):
+        if dimensions & (dimensions - 1) or dimensions > 2 ** feature_bits:
+            raise ValueError(f'dimensions has to be a power of 2 no bigger than 2^feature_bits: {dimensions}')
+        self.dimensions, self.feature_bits, self.idf = dimensions, feature_bits, idf
+        features = np.arange(2 ** feature_bits, dtype=np.uint64)
+        # +1 / -1 per hashed term, from a different part of the hash than the slot it folds into (feature % dimensions)
+        self.signs = np.where((features * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(63), -1, 1).astype(np.float32)
+
+    def get_terms(self, descriptions):
+        """
+        returns (row, feature) for every term occurrence in a batch of descriptions: each word, and each pair of
+        neighbouring words (so 'eating disorders' isn't just 'eating' + 'disorders'). row is the description's index
+        in the batch, feature the term's hashed id
+        """
+        words, word_counts = [], []
+        for description in descriptions:
+            description_words = ([] if description in self.missing_descriptions else
+                                 self.token_pattern.findall(description.lower()))
+            words.extend(description_words)
+            word_counts.append(len(description_words))
+        rows = np.repeat(np.arange(len(descriptions), dtype=np.int64), word_counts)
+        # a batch only has a few thousand distinct words, so each one is hashed once
+        word_codes, distinct_words = pd.factorize(np.array(words, dtype=object))
+        word_hashes = np.array([zlib.crc32(word.encode('utf-8')) for word in distinct_words], dtype=np.uint64)
+        word_hashes = word_hashes[word_codes] if len(words) else np.empty(0, dtype=np.uint64)
+
+        # pairs only within a description. mixed so ('a', 'b') and ('b', 'a') don't hash the same
+        same_row = rows[:-1] == rows[1:]
+        pair_hashes = (word_hashes[:-1][same_row] * np.uint64(0x100000001B3)) ^ word_hashes[1:][same_row]
+        pair_hashes = (pair_hashes ^ (pair_hashes >> np.uint64(29))) * np.uint64(0xBF58476D1CE4E5B9)
+        term_hashes = np.concatenate([word_hashes, pair_hashes >> np.uint64(32)])
+        term_rows = np.concatenate([rows, rows[:-1][same_row]])
+        return term_rows, (term_hashes & np.uint64(2 ** self.feature_bits - 1)).astype(np.int64)
+
+    def get_term_counts(self, descriptions):
+        # (row, feature, count) per distinct term of each description
+        term_rows, features = self.get_terms(descriptions)
+        keys, counts = np.unique(term_rows * 2 ** self.feature_bits + features, return_counts=True)
+        return keys >> self.feature_bits, keys & (2 ** self.feature_bits - 1), counts
+
+    def get_document_frequencies(self, descriptions):
+        # number of descriptions in the batch each hashed term is in. summed over batches by DescriptionVectors.build
+        _, features, _ = self.get_term_counts(descriptions)
+        return np.bincount(features, minlength=2 ** self.feature_bits)
+
+    def set_idf(self, document_frequencies, documents):
+        # smoothed idf, same formula as scikit-learn's TfidfVectorizer
+        self.idf = (np.log((1 + documents) / (1 + document_frequencies)) + 1).astype(np.float32)
+
+    def encode(self, descriptions):
+        # batch of descriptions -> (len(descriptions), dimensions) float32, unit length (all zeros if missing)
+        rows, features, counts = self.get_term_counts(descriptions)
+        weights = (1 + np.log(counts)).astype(np.float32) * self.idf[features] * self.signs[features]
+        vectors = np.bincount(rows * self.dimensions + (features & (self.dimensions - 1)), weights=weights,
+                              minlength=len(descriptions) * self.dimensions)
+        vectors = vectors.reshape(len(descriptions), self.dimensions).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+
+class DescriptionVectors:
+    """
+    Parameters:
+    - vectors_dir (str): directory written by build (see get_vectors_dir)
+
+    Every therapist's description as a vector (DescriptionEncoder), stored as a memory-mapped float32 matrix whose
+    rows line up w/ urls, so "therapists similar to this one" is a top-k cosine similarity over the matrix.
+    Nothing is loaded up front: similar reads the matrix chunk_rows at a time and keeps only the best k so far,
+    so memory stays flat however many states are in it
+
+    The directory holds vectors.npy (rows x dimensions, float32), urls.npy (fixed width bytes, same row order),
+    idf.npy (to encode query text the same way) and settings.json
+    """
+    chunk_rows = 16384  # rows scored at a time, 32MB at 512 dimensions
+
+    def __init__(self, vectors_dir):
+        self.vectors_dir = vectors_dir
+        with open(os.path.join(vectors_dir, 'settings.json'), encoding='utf-8') as settings_file:
+            settings = json.load(settings_file)
+        self.encoder = DescriptionEncoder(settings['dimensions'], settings['feature_bits'],
+                                          np.load(os.path.join(vectors_dir, 'idf.npy')))
+        self.vectors = np.load(os.path.join(vectors_dir, 'vectors.npy'), mmap_mode='r')
+        self.urls = np.load(os.path.join(vectors_dir, 'urls.npy'), mmap_mode='r')
+
+    @staticmethod
+    def get_vectors_dir(directory_path):
+        # next to the directory CSV / Parquet it was built from
+        return os.path.splitext(directory_path)[0] + '_description_vectors'
+
+    @classmethod
+    def build(cls, directory_path, vectors_dir=None, dimensions=512, feature_bits=20, batch_size=5000):
+        """
+        Parameters:
+        - directory_path (str): clean directory, .csv or .parquet
+        - vectors_dir (str): where to write it. defaults to get_vectors_dir(directory_path)
+        - dimensions (int), feature_bits (int): see DescriptionEncoder
+        - batch_size (int): descriptions read and encoded at a time
+
+        Two passes over the directory, batch_size rows at a time: document frequencies (-> idf), then the vectors,
+        written straight into the memory-mapped matrix. Returns the loaded DescriptionVectors
+        """
+        metrics = PipelineMetrics.get_metrics()
+        vectors_dir = vectors_dir or cls.get_vectors_dir(directory_path)
+        os.makedirs(vectors_dir, exist_ok=True)
+        encoder = DescriptionEncoder(dimensions, feature_bits)
+        columns = ['therapist_url', 'description']
+
+        document_frequencies, row_count, url_width = np.zeros(2 ** feature_bits, dtype=np.int64), 0, 1
+        with metrics.time('description_idf'):
+            for chunk in RecordSink.read_chunks(directory_path, batch_size, columns):
+                document_frequencies += encoder.get_document_frequencies(chunk['description'].astype(str).tolist())
+                row_count += chunk.shape[0]
+                url_width = max([url_width, *chunk['therapist_url'].astype(str).str.len()])
+        encoder.set_idf(document_frequencies, row_count)
+
+        vectors = np.lib.format.open_memmap(os.path.join(vectors_dir, 'vectors.npy'), mode='w+', dtype=np.float32,
+                                            shape=(row_count, dimensions))
+        urls = np.lib.format.open_memmap(os.path.join(vectors_dir, 'urls.npy'), mode='w+', dtype=f'S{url_width}',
+                                         shape=(row_count,))
+        start = 0
+        with metrics.time('description_vectors'):
+            for chunk in RecordSink.read_chunks(directory_path, batch_size, columns):
+                end = start + chunk.shape[0]
+                vectors[start:end] = encoder.encode(chunk['description'].astype(str).tolist())
+                urls[start:end] = chunk['therapist_url'].astype(str).str.encode('utf-8').to_numpy()
+                start = end
+        vectors.flush()
+        urls.flush()
+        np.save(os.path.join(vectors_dir, 'idf.npy'), encoder.idf)
+        with open(os.path.join(vectors_dir, 'settings.json'), 'w', encoding='utf-8') as settings_file:
+            json.dump({'dimensions': dimensions, 'feature_bits': feature_bits, 'rows': row_count,
+                       'directory_path': directory_path}, settings_file)
+
+        logging.info(f'$|$ Function: Description Vectors | Rows: {row_count} | Dimensions: {dimensions} | '
+                     f'Vectors: {vectors_dir}')
+        return cls(vectors_dir)
+
+    def get_row(self, therapist_url):
+        # row of a therapist's vector, None if they aren't in it. a scan over urls, same chunking as similar
+        encoded_url = therapist_url.encode('utf-8')
+        for start in range(0, self.urls.shape[0], self.chunk_rows):
+            matches = np.flatnonzero(self.urls[start:start + self.chunk_rows] == encoded_url)
+            if matches.size:
+                return start + int(matches[0])
+        return None
+
+    def similar(self, therapist_url=None, text=None, k=10):
+        """
+        top k (therapist_url, cosine similarity) pairs, most similar first, for either a therapist in the matrix
+        (therapist_url, left out of its own results) or any text (text). therapists w/o a description never match
+        """
+        if therapist_url is not None:
+            row = self.get_row(therapist_url)
+            if row is None:
+                raise KeyError(f'{therapist_url} has no description vector')
+            query = np.array(self.vectors[row])
+        else:
+            query, row = self.encoder.encode([text])[0], None
+        if not query.any():
+            return []
+
+        best_rows, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        for start in range(0, self.vectors.shape[0], self.chunk_rows):
+            scores = self.vectors[start:start + self.chunk_rows] @ query
+            if row is not None and start <= row < start + scores.shape[0]:
+                scores[row - start] = -np.inf
+            top = np.argpartition(scores, -k)[-k:] if scores.shape[0] > k else np.arange(scores.shape[0])
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            if best_rows.shape[0] > k:  # only the best k so far are kept
+                keep = np.argpartition(best_scores, -k)[-k:]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores, kind='stable')
+        return [(self.urls[best_rows[i]].decode('utf-8'), float(best_scores[i])) for i in order
+                if best_scores[i] > 0]
+
+
+# build / query description vectors from the command line. run from src/ (same as main.py), e.g.
+#   python description_vectors.py build ../scraped_data/north-carolina_therapist_directory_<date>_<id>.csv
+#   python description_vectors.py similar <vectors dir> --url https://www.psychologytoday.com/us/therapists/...
+#   python description_vectors.py similar <vectors dir> --text "grief and loss, EMDR for trauma" --k 20
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or search therapist description vectors')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='vectorize a clean directory (.csv or .parquet)')
+    build_parser.add_argument('directory_path')
+    build_parser.add_argument('vectors_dir', nargs='?')
+    build_parser.add_argument('--dimensions', type=int, default=512)
+    similar_parser = subparsers.add_parser('similar', help='therapists w/ the most similar descriptions')
+    similar_parser.add_argument('vectors_dir')
+    query = similar_parser.add_mutually_exclusive_group(required=True)
+    query.add_argument('--url', help='therapist to find similar therapists to')
+    query.add_argument('--text', help='free text to match descriptions against')
+    similar_parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        DescriptionVectors.build(args.directory_path, args.vectors_dir, args.dimensions)
+    else:
+        for therapist_url, similarity in DescriptionVectors(args.vectors_dir).similar(args.url, args.text, args.k):
+            print(f'{similarity:.3f}  {therapist_url}')
@@ -0,0 +1,167 @@
+from compact_directory import CompactDirectory
+import argparse
+import json
+import numpy as np
+import pandas as pd
+
+
+# bits set in each byte value, for counting matches without unpacking a bitmap
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint16)
+
+
+class DirectoryIndex:
+    """
+    Parameters:
+    - terms (list): (field, value) for each row of bitmaps, e.g. ('insurance', 'Aetna'), ('zipcode', '27')
+    - bitmaps (ndarray): one packed bitmap (np.packbits) per term over the directory's rows; bit i is set when
+        therapist i has the term
+    - documents (DataFrame): the columns shown for a match (url, name, phone, address, zipcode), in row order
+
+    Inverted index over a clean directory, so conjunctive questions ("female therapists in 27xxx who take Aetna,
+    treat ADHD and see clients online") are a few bitmap ANDs instead of string matching every column of the CSV.
+    There's a bitmap per value of every multi-valued field (see CompactDirectory), per gender, per availability flag
+    and per zipcode prefix (2, 3 and 5 digits; other lengths are ORed together from the next longer one)
+
+    Build it with from_directory (CSV or Parquet), query it with query / count, keep it with save / load
+    """
+    flag_cols = ['available', 'in_person', 'online', 'lgbtq_status', 'veteran_status']  # 'Y' == has it
+    zipcode_prefix_lengths = [2, 3, 5]
+    document_cols = ['therapist_url', 'therapist_name', 'phone_number', 'address', 'zipcode']
+
+    def __init__(self, terms, bitmaps, documents, vocabularies):
+        self.terms, self.bitmaps, self.documents, self.vocabularies = terms, bitmaps, documents, vocabularies
+        self.term_rows = {term: i for i, term in enumerate(terms)}
+        self.row_count = documents.shape[0]
+
+    @classmethod
+    def from_directory(cls, directory_path):
+        # clean directory CSV, or the Parquet copy written next to it (faster, nothing to re-parse)
+        if directory_path.endswith('.parquet'):
+            return cls.from_compact(CompactDirectory.load(directory_path))
+        return cls.from_compact(CompactDirectory.from_csv(directory_path))
+
+    @classmethod
+    def from_compact(cls, compact):
+        directory_df = compact.directory_df
+        row_count = directory_df.shape[0]
+        terms, row_masks = [], []  # row_masks: terms x rows boolean blocks, packed into bitmaps at the end
+
+        for field, vocabulary in compact.vocabularies.items():
+            terms.extend((field, val) for val in vocabulary)
+            row_masks.append(compact.get_value_matrix(field).T)
+        for field in cls.flag_cols:
+            terms.append((field, 'Y'))
+            row_masks.append((directory_df[field] == 'Y').to_numpy()[np.newaxis])
+        prefix_cols = [('therapist_gender', directory_df['therapist_gender'].astype(object))]
+        zipcodes = directory_df['zipcode'].astype(str)
+        prefix_cols += [('zipcode', zipcodes.str[:length].where(zipcodes.str.len() >= length))
+                        for length in cls.zipcode_prefix_lengths]
+        for field, column in prefix_cols:  # one bitmap per distinct value, in a single pass over the column
+            codes, uniques = pd.factorize(column)
+            value_masks = np.zeros((len(uniques), row_count), dtype=bool)
+            value_masks[codes[codes >= 0], np.flatnonzero(codes >= 0)] = True
+            terms.extend((field, val) for val in uniques)
+            row_masks.append(value_masks)
+
+        bitmaps = np.packbits(np.vstack(row_masks), axis=1)
+        documents = directory_df[cls.document_cols].astype(str).reset_index(drop=True)
+        return cls(terms, bitmaps, documents, compact.vocabularies)
+
+    def get_bitmap(self, field, val):
+        if field == 'zipcode':
+            return self.get_zipcode_bitmap(str(val))
+        if field in self.flag_cols:
+            if val not in (True, 'Y'):
+                raise ValueError(f'{field} can only be filtered on being set (True)')
+            val = 'Y'
+        elif field in self.vocabularies and val not in self.vocabularies[field]:
+            raise ValueError(f'{val!r} is not in the {field} vocabulary')
+        elif field not in self.vocabularies and field != 'therapist_gender':
+            raise KeyError(f'{field} is not indexed')
+        row = self.term_rows.get((field, val))
+        return self.bitmaps[row] if row is not None else np.zeros(self.bitmaps.shape[1], dtype=np.uint8)
+
+    def get_zipcode_bitmap(self, prefix):
+        if ('zipcode', prefix) in self.term_rows:
+            return self.bitmaps[self.term_rows[('zipcode', prefix)]]
+        # not a stored length: OR together the stored prefixes one length up that start w/ it
+        longer = min([length for length in self.zipcode_prefix_lengths if length > len(prefix)], default=None)
+        rows = [row for (field, val), row in self.term_rows.items()
+                if field == 'zipcode' and len(val) == longer and val.startswith(prefix)]
+        if not rows:
+            return np.zeros(self.bitmaps.shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bitmaps[rows], axis=0)
+
+    def match(self, **filters):
+        """
+        filters are field=value, or field=[values] for all of several values, e.g.
+        match(therapist_gender='female', zipcode='27', insurance='Aetna', issues_covered=['ADHD'], online=True).
+        returns the packed bitmap of the rows that match every filter
+        """
+        bitmap = None
+        for field, vals in filters.items():
+            for val in (vals if isinstance(vals, (list, tuple, set)) else [vals]):
+                field_bitmap = self.get_bitmap(field, val)
+                bitmap = field_bitmap.copy() if bitmap is None else np.bitwise_and(bitmap, field_bitmap, out=bitmap)
+        if bitmap is None:  # no filters == everyone
+            return np.packbits(np.ones(self.row_count, dtype=bool))
+        return bitmap
+
+    def count(self, **filters):
+        return int(POPCOUNT[self.match(**filters)].sum())
+
+    def query(self, limit=None, **filters):
+        # matching therapists (document_cols), in directory order
+        row_ids = np.flatnonzero(np.unpackbits(self.match(**filters), count=self.row_count))
+        return self.documents.iloc[row_ids[:limit]]
+
+    def save(self, path):
+        # one .npz, nothing pickled: bitmaps as-is, terms / vocabularies as JSON, documents as fixed width strings
+        documents = {f'document_{col}': self.documents[col].to_numpy(dtype=str) for col in self.document_cols}
+        np.savez_compressed(path, bitmaps=self.bitmaps, terms=np.array(json.dumps(self.terms)),
+                            vocabularies=np.array(json.dumps(self.vocabularies)), **documents)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index_file:
+            terms = [tuple(term) for term in json.loads(str(index_file['terms']))]
+            documents = pd.DataFrame({col: index_file[f'document_{col}'].astype(object) for col in cls.document_cols})
+            return cls(terms, index_file['bitmaps'], documents, json.loads(str(index_file['vocabularies'])))
+
+
+# build / query an index from the command line. run from src/ (same as main.py), e.g.
+#   python directory_index.py build ../scraped_data/north-carolina_therapist_directory_<date>_<id>.parquet nc_index.npz
+#   python directory_index.py query nc_index.npz --gender female --zipcode 27 --insurance Aetna --issue ADHD --online
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query a therapist directory index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index a clean directory (.csv or .parquet)')
+    build_parser.add_argument('directory_path')
+    build_parser.add_argument('index_path')
+    query_parser = subparsers.add_parser('query', help='therapists matching every filter')
+    query_parser.add_argument('index_path')
+    query_parser.add_argument('--gender', dest='therapist_gender')
+    query_parser.add_argument('--zipcode', help='zipcode or prefix (27 == 27xxx)')
+    query_parser.add_argument('--insurance', action='append')
+    query_parser.add_argument('--issue', dest='issues_covered', action='append')
+    query_parser.add_argument('--therapy-type', dest='therapy_types', action='append')
+    query_parser.add_argument('--language', dest='languages_spoken', action='append')
+    query_parser.add_argument('--age', dest='ages_covered', action='append')
+    for flag in DirectoryIndex.flag_cols:
+        query_parser.add_argument(f'--{flag.replace("_", "-")}', dest=flag, action='store_true')
+    query_parser.add_argument('--limit', type=int, default=20)
+    args = vars(parser.parse_args())
+
+    if args.pop('command') == 'build':
+        DirectoryIndex.from_directory(args['directory_path']).save(args['index_path'])
+    else:
+        directory_index, limit = DirectoryIndex.load(args.pop('index_path')), args.pop('limit')
+        filters = {field: val for field, val in args.items() if val not in (None, False)}
+        for field, vals in filters.items():  # unknown values are a usage error, not a traceback from get_bitmap
+            unknown = [val for val in vals if val not in directory_index.vocabularies[field]] \
+                if field in directory_index.vocabularies else []
+            if unknown:
+                parser.error(f'unknown {field} value(s) {", ".join(map(repr, unknown))}, valid values are: '
+                             f'{", ".join(map(repr, directory_index.vocabularies[field]))}')
+        print(f'{directory_index.count(**filters)} therapists match')
+        print(directory_index.query(limit=limit, **filters).to_string(index=False))
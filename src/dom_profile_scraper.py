@@ -0,0 +1,213 @@
+from get_therapist_profile import TherapistPageScraper
+from pipeline_metrics import PipelineMetrics
+from page_cache import PageCache
+from utility import KeywordMatcher, VocabularyMatcher
+import argparse
+import collections
+import html2text
+import itertools
+import json
+import logging
+import lxml.etree
+import lxml.html
+import os
+import re
+import sys
+
+
+def has_class(name):
+    # XPath test for one class token (contains(@class, 'location') would also hit 'profile-location')
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class DomPageScraper(TherapistPageScraper):
+    """
+    Extraction backend that reads each field straight from its DOM node instead of from the html2text version of
+    the whole page. The page is parsed once with lxml and every field comes from the node(s) selectors points at,
+    so there's no html -> markdown conversion of the full page, no [0:-540] trim and no regexes to find where a
+    field starts and ends. Meant to produce the same record as TherapistPageScraper (same vocabularies, same 'N/A' /
+    'failed scrape' values). The selectors were written against the synthetic fixture pages, so
+    benchmarks.benchmark_dom_extraction only shows they agree there; check_pages (python dom_profile_scraper.py
+    check <state>) compares the two backends on the real pages in a state's page cache
+
+    A required field (required_fields) whose node isn't on the page is 'failed scrape', not 'N/A', and is logged:
+    every profile has them, so a miss means the selector no longer fits the page, and the profile is dropped by the
+    cleaner instead of going into the directory w/ a blank name / address / description
+
+    Pick it per run w/ TherapistDirectory(..., extraction_backend='dom') or main.py --extraction dom. Only the
+    personal statement still goes through html2text (on its own section), so descriptions keep the same markdown
+    """
+    # field -> XPath of its node(s). a field whose node is missing is 'N/A', same as a regex that doesn't match
+    selectors = {
+        'name': f"//div[{has_class('profile-heading')}]/div[{has_class('profile-title')}]",
+        'credentials': f"//div[{has_class('profile-heading')}]/div[{has_class('profile-suffix-heading')}]",
+        'description': f"//section[{has_class('profile-personal-statement')}]",
+        'availability': f"//section[{has_class('at-a-glance')}]//p[{has_class('availability')}]",
+        'address': f"//section[{has_class('location')}]//div[{has_class('address')}]/p",
+        'phone_number': f"//section[{has_class('location')}]//p[{has_class('phone')}]",
+        'session_cost': f"//ul[{has_class('fees')}]/li",
+        'insurance': f"//ul[{has_class('insurance')}]/li",
+        'therapy_types': f"//ul[{has_class('therapy-types')}]/li",
+        'ethnicities': "//h3[normalize-space() = 'Ethnicity']/following-sibling::p[1]",
+        'faith': "//h3[normalize-space() = 'Religion']/following-sibling::p[1]",
+        'languages': "//p[normalize-space() = 'I also speak']/following-sibling::p[1]"
+    }
+    required_fields = ['name', 'address', 'description']
+    compiled_selectors = {}  # field -> lxml XPath, compiled once per process
+    markdown_converter = None  # html2text, set up the same way as Html2TextTransformer
+
+    @classmethod
+    def parse(cls, page_html, url, gender):
+        """pure entry point: page html in, record dict out (TherapistPageScraper.parse takes the page text)"""
+        scraper = cls.__new__(cls)
+        scraper.therapist_url, scraper.therapist_gender, scraper.page_html = url, gender, page_html
+        scraper.scrape_fields()
+        return scraper.compile_data()
+
+    @classmethod
+    def get_nodes(cls, tree, field):
+        if field not in cls.compiled_selectors:
+            cls.compiled_selectors[field] = lxml.etree.XPath(cls.selectors[field])
+        return cls.compiled_selectors[field](tree)
+
+    @staticmethod
+    def get_text(node):
+        return node.text_content().strip()
+
+    def scrape_fields(self):
+        metrics = PipelineMetrics.get_metrics()
+        with metrics.time('parse_html'):
+            self.tree = lxml.html.fromstring(self.page_html)
+            lxml.etree.strip_elements(self.tree, 'script', 'style', with_tail=False)
+        with metrics.time('keyword_scan'):  # issues, ages, lgbtq, veteran can be anywhere, same as the text backend
+            self.keyword_hits = KeywordMatcher.get_matcher().scan('\n'.join(self.tree.itertext()))
+        self.available, self.in_person, self.online = self.read_field('availability', self.read_availability, 3)
+        self.street_city, self.zipcode = self.read_field('address', self.read_address, 2)
+        self.credentials = self.read_field('credentials', self.read_text)
+        self.description = self.read_field('description', self.read_markdown)
+        self.ethnicities_served = self.read_field('ethnicities', self.read_lines)
+        self.faiths_served = self.read_field('faith', self.read_comma_list)
+        self.insurance = self.read_field('insurance', self.read_list_items)
+        self.ages_covered = self.get_age('age')
+        self.issues_covered = self.get_issues('issues')
+        self.languages_spoken = self.read_field('languages', self.read_comma_list)
+        self.lgbtq_status = self.get_direct_match_field('lgbtq_status')
+        self.name = self.read_field('name', self.read_text)
+        self.phone_number = self.read_field('phone_number', self.read_phone_number)
+        self.session_cost = self.read_field('session_cost', self.read_session_cost)
+        self.therapy_types = self.read_field('therapy_types', self.read_list_items)
+        self.veteran_status = self.get_direct_match_field('veteran_status')
+
+    def read_field(self, field, reader, values=1):
+        # reader(field, nodes) -> value(s). 'N/A' when the node isn't on the page, 'failed scrape' if reader blows up
+        # or a required node is missing
+        with PipelineMetrics.get_metrics().time(f'extract {field}'):
+            try:
+                nodes = self.get_nodes(self.tree, field)
+                if not nodes and field in self.required_fields:
+                    logging.info(f'$|$ Function: DOM Page Scraper | URL: {self.therapist_url} | Field: {field} | '
+                                 f'Error: required node not found, the selector may no longer fit the page')
+                    raise LookupError(field)
+                result = reader(field, nodes) if nodes else None
+            except:  # catch all
+                result = ('failed scrape',) * values if values > 1 else 'failed scrape'
+        if result is None:
+            return ('N/A',) * values if values > 1 else 'N/A'
+        return result
+
+    def read_text(self, field, nodes):
+        return self.get_text(nodes[0]) or None
+
+    def read_markdown(self, field, nodes):
+        if DomPageScraper.markdown_converter is None:
+            DomPageScraper.markdown_converter = html2text.HTML2Text()
+            DomPageScraper.markdown_converter.ignore_links = True
+            DomPageScraper.markdown_converter.ignore_images = True
+        return self.markdown_converter.handle(lxml.html.tostring(nodes[0], encoding='unicode')).strip() or None
+
+    def read_availability(self, field, nodes):
+        return self.get_availability_flags(self.get_text(nodes[0]))
+
+    def read_address(self, field, nodes):
+        # one <p> per address line, the last one ends w/ the zipcode
+        joined_address = ', '.join(self.get_text(node) for node in nodes)
+        if not re.search(r' \d{5}$', joined_address):
+            return None
+        return joined_address[:-6].strip(), joined_address[-5:].strip()
+
+    def read_phone_number(self, field, nodes):
+        phone_number = self.get_text(nodes[0])
+        return phone_number if phone_number.startswith('(') else None  # sometimes the phone number is missing
+
+    def read_session_cost(self, field, nodes):
+        for val in (self.get_text(node) for node in nodes):
+            if val.startswith('Individual Sessions') and '$' in val:
+                return val[val.index('$'):].strip()
+        return None
+
+    def read_lines(self, field, nodes):
+        # <br> separated values in one <p>
+        return self.match_vocabulary(field, [line.strip().strip(',').strip() for line in nodes[0].itertext()])
+
+    def read_comma_list(self, field, nodes):
+        return self.match_vocabulary(field, self.get_text(nodes[0]).replace('\n', '').split(','))
+
+    def read_list_items(self, field, nodes):
+        return self.match_vocabulary(field, [self.get_text(node) for node in nodes])
+
+    @staticmethod
+    def match_vocabulary(field, vals):
+        # same fuzzy matching against the reference file as TherapistPageScraper.get_fuzz_fields
+        vals = [val.strip() for val in vals if val.strip()]
+        val_matches = {ref for ref in VocabularyMatcher.for_field(field).match_all(vals) if ref}
+        return val_matches or None
+
+    @classmethod
+    def check_pages(cls, pages, examples=3):
+        """
+        Parameters:
+        - pages (iterable): (therapist_url, therapist_gender, page_html, page_text) tuples, e.g. PageCache.iter_pages.
+            page_text can be None, it's made from the html then
+        - examples (int): mismatching (url, html2text value, dom value) kept per field
+
+        How well the selectors fit real pages: per selector, the pages it found a node on, and per record field,
+        the pages where both backends gave the same value. returns {'pages', 'nodes_found', 'agreeing', 'mismatches'}
+        """
+        nodes_found, agreeing, mismatches = collections.Counter(), collections.Counter(), collections.defaultdict(list)
+        page_count = 0
+        for therapist_url, therapist_gender, page_html, page_text in pages:
+            page_count += 1
+            tree = lxml.html.fromstring(page_html)
+            nodes_found.update(field for field in cls.selectors if cls.get_nodes(tree, field))
+            text_record = TherapistPageScraper.parse(page_text or TherapistPageScraper.html_to_text(page_html),
+                                                     therapist_url, therapist_gender)
+            dom_record = cls.parse(page_html, therapist_url, therapist_gender)
+            for field, val in text_record.items():
+                if dom_record[field] == val:
+                    agreeing[field] += 1
+                elif len(mismatches[field]) < examples:
+                    mismatches[field].append((therapist_url, str(val)[:100], str(dom_record[field])[:100]))
+        return {'pages': page_count, 'nodes_found': {field: nodes_found[field] for field in cls.selectors},
+                'agreeing': dict(agreeing), 'mismatches': dict(mismatches)}
+
+
+# check the selectors against the pages a crawl cached. run from src/ (same as main.py) after a crawl w/ the default
+# html2text backend, e.g.
+#   python dom_profile_scraper.py check north-carolina --limit 500
+# exits w/ 1 if any page's records differ, so it can gate switching a state to --extraction dom
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the DOM and html2text backends on cached pages')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    check_parser = subparsers.add_parser('check', help="both backends on a state's page cache")
+    check_parser.add_argument('state')
+    check_parser.add_argument('--limit', type=int, help='only check the first LIMIT pages (oldest stored first)')
+    args = parser.parse_args()
+
+    cache_dir = PageCache.get_cache_dir(args.state)
+    if not os.path.exists(os.path.join(cache_dir, 'index.sqlite')):  # don't leave an empty cache behind
+        parser.error(f'no page cache for {args.state} in {cache_dir}')
+    page_cache = PageCache(cache_dir)
+    summary = DomPageScraper.check_pages(itertools.islice(page_cache.iter_pages(), args.limit))
+    page_cache.close()
+    print(json.dumps(summary, indent=2))
+    sys.exit(1 if summary['mismatches'] else 0)
@@ -0,0 +1,117 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dom_profile_scraper import DomPageScraper
+from get_therapist_profile import TherapistPageScraper
+from pipeline_metrics import PipelineMetrics
+from utility import DirectoryBuilder
+import os
+
+
+# extraction_backend -> what reads the record off a page. 'html2text': regexes over the html2text page text
+# (TherapistPageScraper), 'dom': selectors over the parsed html (DomPageScraper)
+EXTRACTION_BACKENDS = ['html2text', 'dom']
+
+
+def extract_page(therapist_url, therapist_gender, page_html, page_text=None, backend='html2text'):
+    """
+    runs in a worker process: html -> text -> record. never raises, a page that blows up is a program failure.
+    returns (record, page text (for the page cache), the page's stage timings). pass page_text to skip html2text.
+    the timings are drained from the worker's PipelineMetrics, for the crawl's process to merge. the 'dom' backend
+    reads the html directly, so there's no page text (None)
+    """
+    metrics = PipelineMetrics.get_metrics()
+    try:
+        if backend == 'dom':
+            record, page_text = DomPageScraper.parse(page_html, therapist_url, therapist_gender), None
+        else:
+            if page_text is None:
+                with metrics.time('html_to_text'):
+                    page_text = TherapistPageScraper.html_to_text(page_html)
+            record = TherapistPageScraper.parse(page_text, therapist_url, therapist_gender)
+    except:
+        record = DirectoryBuilder.failed_scrape_record(therapist_url)
+    return record, page_text, metrics.drain()
+
+
+class ExtractionPool:
+    """
+    Parameters:
+    - max_workers (int): number of worker processes. defaults to every core
+    - batch_size (int): number of records handed back at a time by map_batches. at most 2 * batch_size pages are
+        held in memory waiting to be parsed, so memory stays flat no matter how many pages go through
+    - extraction_backend (str): 'html2text' or 'dom' (see EXTRACTION_BACKENDS). same record either way, 'dom' skips
+        the whole-page html2text conversion
+
+    html2text + the regex/fuzzy extractors are CPU bound and hold the GIL, so they get their own processes instead
+    of sharing a core with the fetch loop. Use as a context manager
+
+    Each page's stage timings come back with it and are merged into this process' PipelineMetrics
+    """
+    def __init__(self, max_workers=None, batch_size=100, extraction_backend='html2text'):
+        if extraction_backend not in EXTRACTION_BACKENDS:
+            raise ValueError(f'unsupported extraction backend: {extraction_backend}')
+        self.max_workers = max_workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.extraction_backend = extraction_backend
+        self.executor = None
+        self.metrics = PipelineMetrics.get_metrics()
+
+    def __enter__(self):
+        # workers start from empty metrics, not a (forked) copy of ours, or they'd be counted twice
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=PipelineMetrics.reset_metrics)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+        self.executor = None
+
+    def extract(self, therapist_url, therapist_gender, page_html):
+        # parse a single page on the pool, blocking until it's done. safe to call from several threads at once
+        return self.extract_page(therapist_url, therapist_gender, page_html)[0]
+
+    def extract_page(self, therapist_url, therapist_gender, page_html):
+        # same as extract, but returns (record, page text). page text is None w/ the 'dom' backend
+        with self.metrics.time('extract_page'):  # queueing for a worker + pickling included
+            record, page_text, stage_metrics = self.submit((therapist_url, therapist_gender, page_html)).result()
+        self.metrics.merge(stage_metrics)
+        TherapistPageScraper.log_failed_scrape(record)
+        return record, page_text
+
+    def map_batches(self, pages):
+        """
+        Parameters:
+        - pages (iterable): (therapist_url, therapist_gender, page_html) tuples, optionally with the page text as a
+            4th item to skip html2text (ignored by the 'dom' backend). can be a generator, it's only read as fast
+            as the workers keep up
+
+        Yields lists of up to batch_size records, in the same order as pages
+        """
+        pending, batch = deque(), []
+        for page in pages:
+            pending.append(self.submit(page))
+            if len(pending) >= 2 * self.batch_size:  # keep the workers busy, but don't read ahead any further
+                batch.append(self.get_record(pending.popleft()))
+            if len(batch) == self.batch_size:
+                yield self.log_batch(batch)
+                batch = []
+        while pending:
+            batch.append(self.get_record(pending.popleft()))
+            if len(batch) == self.batch_size:
+                yield self.log_batch(batch)
+                batch = []
+        if batch:
+            yield self.log_batch(batch)
+
+    def submit(self, page):
+        return self.executor.submit(extract_page, *page, backend=self.extraction_backend)
+
+    def get_record(self, future):
+        record, _, stage_metrics = future.result()
+        self.metrics.merge(stage_metrics)
+        return record
+
+    @staticmethod
+    def log_batch(batch):
+        for record in batch:
+            TherapistPageScraper.log_failed_scrape(record)
+        return batch
@@ -0,0 +1,413 @@
+from email.utils import parsedate_to_datetime
+from pipeline_metrics import PipelineMetrics
+import aiohttp
+import asyncio
+import datetime
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# same header template AsyncHtmlLoader sends, so the server sees the same client as before
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/124.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Referer': 'https://www.google.com/',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+
+class PolitenessController:
+    """
+    Parameters:
+    - requests_per_second (float): rate to start at. 0.1 == one request every 10 seconds (psychology today's limit)
+    - max_requests_per_second (float): never faster than this, however healthy the server looks. defaults to
+        requests_per_second, so the controller only ever slows down from the configured budget and climbs back
+    - min_requests_per_second (float): never slower than this between responses (Retry-After and an open breaker
+        still stop requests altogether)
+    - increase_step (float): requests/sec added after each healthy response (additive increase). defaults to 5% of
+        max_requests_per_second
+    - decrease_factor (float): rate is multiplied by this on a throttle, server error or slow response
+        (multiplicative decrease). at most once per request interval, so a burst of bad answers counts once
+    - slow_response (float): seconds; a response slower than this means the server is struggling. None == 4x the
+        typical response time so far
+    - failure_threshold (int): transient failures in a row (see classify) that open the circuit breaker
+    - cooldown (float): seconds the breaker stays open before a single probe request goes out. doubles every time
+        the probe fails too, up to max_cooldown
+    - max_cooldown (float): longest the breaker stays open
+    - rate_limiter: budget every request also has to get through after this one, e.g. a SharedTokenBucket so
+        several workers stay under one combined rate
+
+    Paces requests like a token bucket of capacity 1 (scheduled off the clock, so parse time isn't added on top of
+    the wait), but the rate follows the server: AIMD on every answer the fetch engine records (record), a pause
+    for as long as a Retry-After asks, and a circuit breaker that stops sending altogether once the server keeps
+    failing, instead of spending every URL's retries on it
+
+    Nothing in it is tied to an event loop, so one controller can be shared by URL discovery and the profile
+    crawl (pass it as rate_limiter to both), which then share what it has learned about the server
+    """
+    def __init__(self, requests_per_second=0.1, max_requests_per_second=None, min_requests_per_second=None,
+                 increase_step=None, decrease_factor=0.5, slow_response=None, failure_threshold=5, cooldown=60,
+                 max_cooldown=900, rate_limiter=None):
+        self.max_rate = max_requests_per_second or requests_per_second
+        self.min_rate = min_requests_per_second or self.max_rate / 20
+        self.rate = min(requests_per_second, self.max_rate)
+        self.increase_step = increase_step or self.max_rate / 20
+        self.decrease_factor, self.slow_response = decrease_factor, slow_response
+        self.failure_threshold, self.base_cooldown, self.max_cooldown = failure_threshold, cooldown, max_cooldown
+        self.rate_limiter = rate_limiter
+
+        self.next_request_at, self.paused_until, self.last_decrease = 0, 0, 0  # time.monotonic()
+        self.consecutive_failures, self.typical_latency = 0, None
+        # circuit breaker: 'closed' (normal), 'open' (nothing goes out until open_until), 'half-open' (one probe)
+        self.breaker, self.open_until, self.cooldown, self.probe_in_flight = 'closed', 0, cooldown, False
+        self.wait_time = 0  # total seconds requests spent waiting in acquire
+        self.rate_decreases, self.breaker_opens = 0, 0
+        self.metrics = PipelineMetrics.get_metrics()
+
+    async def acquire(self):
+        start = time.monotonic()
+        while (wait := self.reserve()) > 0:
+            await asyncio.sleep(wait)
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
+        self.wait_time += time.monotonic() - start
+
+    def reserve(self):
+        # 0 if a request can go out now (its slot is taken), otherwise seconds to wait before asking again. never
+        # awaits, so callers on the same event loop can't take the same slot
+        now = time.monotonic()
+        if self.breaker == 'open':
+            if now < self.open_until:
+                return self.open_until - now
+            self.breaker, self.probe_in_flight = 'half-open', False
+        ready_at = max(self.next_request_at, self.paused_until)
+        if now < ready_at:
+            return ready_at - now
+        if self.breaker == 'half-open':
+            if self.probe_in_flight:  # wait on the probe's answer
+                return 1 / self.rate
+            self.probe_in_flight = True
+        self.next_request_at = now + 1 / self.rate
+        return 0
+
+    @staticmethod
+    def classify(status, exception=None):
+        """
+        None for a good answer, 'transient' when the same request could work later (connection trouble, timeouts,
+        throttling, server errors), 'permanent' when it won't (a removed profile's 404 / 410, a malformed URL,
+        other 4xx). 403 counts as transient since it's how a site usually says it's blocking us
+        """
+        if exception is not None:
+            return 'permanent' if isinstance(exception, ValueError) else 'transient'  # aiohttp.InvalidURL et al.
+        if status in (200, 304):
+            return None
+        if status in (403, 408, 425, 429) or status >= 500:
+            return 'transient'
+        return 'permanent'
+
+    @staticmethod
+    def parse_retry_after(retry_after):
+        # Retry-After is either seconds or an HTTP date. None if missing / unreadable
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)
+                             ).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def record(self, result, latency):
+        # feedback from one fetch result (see AsyncFetchEngine.fetch): result['failure'] is classify's verdict
+        now = time.monotonic()
+        if result['failure'] == 'transient':
+            self.consecutive_failures += 1
+            retry_after = self.parse_retry_after(result.get('retry_after'))
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            self.slow_down(now, result['error'])
+            if self.breaker == 'half-open' or self.consecutive_failures >= self.failure_threshold:
+                self.open_breaker(now)
+            return
+
+        # the server answered (a removed profile's 404 is a healthy answer too)
+        self.consecutive_failures = 0
+        if self.breaker == 'half-open':
+            self.breaker, self.cooldown = 'closed', self.base_cooldown
+            logging.info(f'$|$ Function: Politeness Controller | Circuit Breaker: closed | Rate: {self.rate:.4f}/s')
+        slow_response = self.slow_response or (4 * self.typical_latency if self.typical_latency else None)
+        if slow_response and latency > slow_response:
+            self.slow_down(now, f'slow response ({latency:.1f}s)')
+        else:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+        self.typical_latency = latency if self.typical_latency is None else \
+            0.9 * self.typical_latency + 0.1 * latency
+
+    def slow_down(self, now, reason):
+        if now - self.last_decrease < 1 / self.rate:  # already backed off for this round of requests
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.rate_decreases += 1
+        self.metrics.increment('rate_decreases')
+        logging.info(f'$|$ Function: Politeness Controller | Reason: {reason} | Rate: {self.rate:.4f}/s')
+
+    def open_breaker(self, now):
+        self.breaker, self.open_until = 'open', now + self.cooldown
+        self.breaker_opens += 1
+        self.metrics.increment('circuit_breaker_opens')
+        logging.info(f'$|$ Function: Politeness Controller | Circuit Breaker: open | Failures In A Row: '
+                     f'{self.consecutive_failures} | Cooldown: {self.cooldown:.0f}s')
+        self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+
+
+class AsyncFetchEngine:
+    """
+    Parameters:
+    - requests_per_second (float): request budget, the most the engine's PolitenessController will send. default is
+        1 request / 10 seconds
+    - max_in_flight (int): cap on requests waiting on the server at once. a slow response never delays the next
+        scheduled request, but we don't want to stack up dozens of open requests either
+    - timeout (int): seconds before a single request is abandoned
+    - report_every (int): log throughput / queue depth every n requests
+    - parse_workers (int): number of pages handed to handle_page at once. keep at 1 unless handle_page is
+        thread-safe (e.g. it just hands the page off to an ExtractionPool)
+    - get_request_headers (callable): url -> extra headers for that request, e.g. PageCache.get_validators for
+        conditional requests. a 304 comes back with status 304 and no html
+    - max_attempts (int): tries per URL before a transient failure (connection error, 429, 5xx, see
+        PolitenessController.classify) is handed to handle_page as a failure. a permanent one (404, other 4xx) is
+        handed over right away
+    - retry_backoff (float): seconds before the first retry. doubles with every attempt, up to max_backoff, and
+        is jittered so retries don't line up. never shorter than the response's Retry-After
+    - max_backoff (float): longest wait before a retry
+    - rate_limiter: a PolitenessController to pace requests with instead of the engine's own, e.g. one shared by
+        URL discovery and the profile crawl. anything else w/ an async acquire (a SharedTokenBucket, so several
+        engines on several processes / machines share one request budget) is put behind the engine's own
+    - wait_for_handled (boolean): don't take the next url from urls until every page fetched so far has been
+        through handle_page. for a urls generator that decides what to request next from the pages it has seen
+        (URL discovery), so it never decides one page late. retries still go out while it waits
+
+    One pooled keep-alive session is shared by every request (AsyncHtmlLoader opened a new event loop and session
+    per URL). Fetched pages go onto a queue and are handed to parse worker threads, so parsing overlaps with waiting
+    on the next request instead of adding to it
+
+    Failed requests go back on the same schedule once their backoff is up, instead of being rescraped in a second
+    pass. The rest of the crawl keeps going while they wait, and a retry goes through the rate limit like any
+    other request
+
+    Every answer (or connection error) is fed back to the PolitenessController, which slows requests down when the
+    server throttles, errors or slows down, speeds back up when it's healthy, and stops them for a while when it
+    keeps failing
+
+    Request time ('fetch'), time spent waiting on the rate limit / in-flight cap, retry backoff and the time
+    handle_page takes are all recorded in the process' PipelineMetrics
+    """
+    def __init__(self, requests_per_second=0.1, max_in_flight=4, timeout=30, report_every=50, headers=None,
+                 parse_workers=1, get_request_headers=None, max_attempts=3, retry_backoff=30, max_backoff=600,
+                 rate_limiter=None, wait_for_handled=False):
+        self.requests_per_second, self.max_in_flight = requests_per_second, max_in_flight
+        self.timeout, self.report_every, self.parse_workers = timeout, report_every, parse_workers
+        self.headers = headers or DEFAULT_HEADERS
+        self.get_request_headers = get_request_headers
+        self.max_attempts, self.retry_backoff, self.max_backoff = max_attempts, retry_backoff, max_backoff
+
+        # retries: url -> attempts so far, urls whose backoff is up, retries still backing off
+        self.attempts, self.retry_queue, self.retries_waiting = {}, None, 0
+
+        # urls taken from urls whose page hasn't been through handle_page yet, set when that's none of them
+        self.wait_for_handled, self.unhandled, self.all_handled = wait_for_handled, 0, None
+
+        # throughput stats
+        self.requests_sent, self.pages_parsed, self.not_modified, self.retries = 0, 0, 0, 0
+        self.start_time = None
+        self.queue = None
+        self.politeness = rate_limiter if isinstance(rate_limiter, PolitenessController) else \
+            PolitenessController(requests_per_second, rate_limiter=rate_limiter)
+        self.metrics = PipelineMetrics.get_metrics()
+
+    def run(self, urls, handle_page):
+        """
+        Parameters:
+        - urls (iterable): URLs to fetch, in order
+        - handle_page (callable): called with each fetch result dict (see fetch) from a parse worker thread
+        """
+        return asyncio.run(self.crawl(urls, handle_page))
+
+    async def crawl(self, urls, handle_page):
+        self.queue, self.retry_queue, self.all_handled = asyncio.Queue(), asyncio.Queue(), asyncio.Event()
+        self.all_handled.set()
+        self.start_time = time.monotonic()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        parse_worker = ThreadPoolExecutor(max_workers=self.parse_workers)
+
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session:
+            consumer = asyncio.create_task(self.consume(handle_page, parse_worker))
+            fetches, urls = [], iter(urls)
+            while (url := await self.get_next_url(urls, fetches)) is not None:
+                with self.metrics.time('rate_limit_wait'):
+                    await self.politeness.acquire()
+                with self.metrics.time('in_flight_wait'):
+                    await in_flight.acquire()
+                fetches.append(asyncio.create_task(self.fetch_and_enqueue(session, url, in_flight)))
+            await asyncio.gather(*fetches)
+            await self.queue.put(None)  # tell the consumer we're done
+            await consumer
+        parse_worker.shutdown()
+
+        self.log_stats()
+        return self
+
+    async def get_next_url(self, urls, fetches):
+        # retries whose backoff is up go first, then new urls. once those run out, wait on the retries (and on
+        # requests still out, which can turn into retries). None when there's nothing left to request
+        while True:
+            if not self.retry_queue.empty():
+                return self.retry_queue.get_nowait()
+            if self.wait_for_handled and self.unhandled:  # urls reads the pages out so far, let it see them all
+                retry = asyncio.ensure_future(self.retry_queue.get())
+                handled = asyncio.ensure_future(self.all_handled.wait())
+                done, _ = await asyncio.wait([retry, handled], return_when=asyncio.FIRST_COMPLETED)
+                handled.cancel()
+                if retry in done:
+                    return retry.result()
+                retry.cancel()
+                continue
+            url = next(urls, None)
+            if url is not None:
+                self.unhandled += 1
+                self.all_handled.clear()
+                return url
+            in_flight = [fetch for fetch in fetches if not fetch.done()]
+            if not in_flight and not self.retries_waiting:
+                return None
+            retry = asyncio.ensure_future(self.retry_queue.get())
+            done, _ = await asyncio.wait([retry, *in_flight], return_when=asyncio.FIRST_COMPLETED)
+            if retry in done:
+                return retry.result()
+            retry.cancel()
+
+    async def fetch_and_enqueue(self, session, url, in_flight):
+        try:
+            result = await self.fetch(session, url)
+        finally:
+            in_flight.release()
+        self.attempts[url] = result['attempts'] = self.attempts.get(url, 0) + 1
+        if self.is_transient(result) and result['attempts'] < self.max_attempts:
+            self.schedule_retry(url, result)
+            return
+        await self.queue.put(result)
+
+    @staticmethod
+    def is_transient(result):
+        # worth another try: the request never got an answer, or the server was overloaded / rate limiting us
+        return result['failure'] == 'transient'
+
+    def get_backoff(self, attempt):
+        # exponential backoff w/ jitter: between half and all of retry_backoff * 2^(attempt - 1), capped
+        backoff = min(self.max_backoff, self.retry_backoff * 2 ** (attempt - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def schedule_retry(self, url, result):
+        backoff = max(self.get_backoff(result['attempts']),
+                      PolitenessController.parse_retry_after(result.get('retry_after')) or 0)
+        self.retries += 1
+        self.metrics.increment('retries')
+        self.metrics.observe('retry_backoff', backoff)
+        self.retries_waiting += 1
+        logging.info(f'$|$ URL: {url} | Failure Type: Retry {result["attempts"]} | Error: {result["error"]} | '
+                     f'Backoff: {backoff:.1f}s')
+        asyncio.get_running_loop().call_later(backoff, self.release_retry, url)
+
+    def release_retry(self, url):
+        self.retries_waiting -= 1
+        self.retry_queue.put_nowait(url)
+
+    async def fetch(self, session, url):
+        # never raises; failures come back with the error filled in so the caller can log a program failure
+        self.requests_sent += 1
+        self.metrics.increment('requests')
+        if self.requests_sent % self.report_every == 0:
+            self.log_stats()
+        request_start = time.perf_counter()
+        result = await self.request(session, url)
+        latency = time.perf_counter() - request_start
+        self.metrics.observe('fetch', latency)
+        self.politeness.record(result, latency)
+        return result
+
+    async def request(self, session, url):
+        try:
+            request_headers = self.get_request_headers(url) if self.get_request_headers else None
+            async with session.get(url, headers=request_headers) as response:
+                if response.status == 304:  # unchanged since the validators we sent, nothing to download
+                    self.not_modified += 1
+                    html, error = None, None
+                else:
+                    html = await response.text()
+                    error = None if response.status == 200 else f'HTTP {response.status}'
+                self.metrics.increment(f'status {response.status}')
+                return {'url': url, 'status': response.status, 'html': html, 'error': error,
+                        'failure': PolitenessController.classify(response.status),
+                        'retry_after': response.headers.get('Retry-After'), 'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}
+        except Exception as e:  # usually a web request handshake issue
+            self.metrics.increment('connection_errors')
+            return {'url': url, 'status': None, 'html': None, 'error': repr(e),
+                    'failure': PolitenessController.classify(None, e)}
+
+    async def consume(self, handle_page, parse_worker):
+        loop = asyncio.get_running_loop()
+        parse_slots = asyncio.Semaphore(self.parse_workers)  # pages stay on the queue until a worker is free
+        parsing = set()
+        while True:
+            result = await self.queue.get()
+            if result is None:
+                break
+            await parse_slots.acquire()
+            task = asyncio.create_task(self.parse(loop, parse_worker, handle_page, result, parse_slots))
+            parsing.add(task)
+            task.add_done_callback(parsing.discard)
+        await asyncio.gather(*parsing)
+
+    async def parse(self, loop, parse_worker, handle_page, result, parse_slots):
+        try:
+            with self.metrics.time('handle_page'):
+                await loop.run_in_executor(parse_worker, handle_page, result)
+        except Exception as e:  # one bad page shouldn't take the crawl down
+            logging.info(f'$|$ URL: {result["url"]} | Failure Type: Parse Handler | Error: {e!r}')
+        finally:
+            parse_slots.release()
+            self.unhandled -= 1
+            if not self.unhandled:
+                self.all_handled.set()
+        self.pages_parsed += 1
+
+    def get_requests_per_second(self):
+        if not self.start_time:
+            return 0
+        elapsed = time.monotonic() - self.start_time
+        return self.requests_sent / elapsed if elapsed else 0
+
+    def get_queue_depth(self):
+        # pages fetched but not parsed yet
+        return self.queue.qsize() if self.queue else 0
+
+    def log_stats(self):
+        logging.info(f'$|$ Function: Fetch Engine | Requests Sent: {self.requests_sent} | '
+                     f'Requests/sec: {self.get_requests_per_second():.4f} | Not Modified: {self.not_modified} | '
+                     f'Retries: {self.retries} | '
+                     f'Queue Depth: {self.get_queue_depth()} | '
+                     f'Pages Parsed: {self.pages_parsed} | '
+                     f'Rate: {self.politeness.rate:.4f}/s | Circuit Breaker: {self.politeness.breaker} | '
+                     f'Rate Limit Wait: {self.politeness.wait_time:.1f}s')
@@ -1,87 +1,275 @@
 import logging
-import pandas as pd
+import os
 import time
 import datetime
-import hashlib
+import shutil
+import uuid
+from contextlib import nullcontext
 from utility import DirectoryBuilder
-from get_therapist_profile import TherapistPageScraper
-
-
-# log results / performance across different levels of the program
-logging.basicConfig(filename='../check_performance.log', filemode='w', encoding='utf-8', level=logging.INFO,
-                    format='%(asctime)s - %(name)s- %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+from compact_directory import CompactDirectory
+from crawl_state import CrawlStateStore
+from description_vectors import DescriptionVectors
+from extraction_pool import ExtractionPool
+from fetch_engine import AsyncFetchEngine
+from page_cache import PageCache
+from pipeline_metrics import MetricsExporter, PipelineMetrics
+from record_sink import RecordSink
 
 
 class TherapistDirectory:
-    def __init__(self, state, url_df, rescrape=True):
+    def __init__(self, state, url_df=None, requests_per_second=0.1, parse_processes=None, resume=False,
+                 incremental=False, max_attempts=3, retry_backoff=30, shard=None, rate_limiter=None,
+                 metrics_format='jsonl', metrics_interval=60, extraction_backend='html2text'):
         """
         Parameters:
-        - url_df (DataFrame): DataFrame w/ therapist URLs; columns should be ['Gender', 'URLs]
-        - rescrape (boolean): used to determine if the re-scraping is needed. set to False in rescrape method to
-            avoid infinite loop
+        - url_df (DataFrame): DataFrame w/ therapist URLs; columns should be ['Gender', 'URLs]. not needed when
+            resuming, the URLs come from the crawl state
+        - requests_per_second (float): request budget for the fetch engine. default 0.1 == psychology today's
+            10 second limit
+        - parse_processes (int): worker processes used to parse pages. defaults to every core
+        - resume (boolean): pick up the last unfinished run for the state instead of starting a new one. profiles
+            already fetched are never requested again, and a run that died after writing its clean directory only
+            gets its Parquet copy and description vectors redone
+        - incremental (boolean): send conditional requests (ETag / Last-Modified from the page cache) and reuse the
+            last record for any profile that hasn't changed, so only new or changed profiles are downloaded and parsed
+        - max_attempts (int): tries per profile before a connection error / 429 / 5xx is written as a program
+            failure. retries are backed off and put back on the crawl's own schedule
+        - retry_backoff (float): seconds before the first retry, doubling after that (see AsyncFetchEngine)
+        - shard (int): set when this is one slice of a multi-state crawl (see CrawlOrchestrator). the shard gets
+            its own crawl state and raw records file, and is left raw: every shard of the state is cleaned together
+            by merge_shards, since duplicates can be in different shards
+        - rate_limiter (PolitenessController / SharedTokenBucket): pacing shared w/ URL discovery (main.py), or the
+            request budget shared w/ the other workers of a multi-state crawl. None == its own PolitenessController
+            at requests_per_second, which backs off on 429s / 5xx / slow responses (see AsyncFetchEngine)
+        - metrics_format (str): 'jsonl' or 'prometheus': how the per-stage timings (fetch, waiting on the rate limit,
+            html2text, each field extractor, ...) and counters (requests, retries, ...) are exported while the crawl
+            runs (see PipelineMetrics). None == only the summary in the log at the end
+        - metrics_interval (float): seconds between metrics exports
+        - extraction_backend (str): 'html2text' (regexes over the page text) or 'dom' (selectors over the parsed
+            html, see DomPageScraper). same record either way, 'dom' is faster but keeps no page text in the cache
+
+        Profiles are streamed to a raw records file (raw_path) as they're scraped, then cleaned in chunks into
+        directory_path, so the directory is never held in memory all at once. Progress is tracked per URL in a
+        CrawlStateStore so a crash, reboot or network blip doesn't lose days of crawling, and every fetched page is
+        kept in the state's PageCache so a parser fix only needs reparse, not a new crawl. The clean directory gets
+        description vectors next to it for "therapists similar to this one" (see DescriptionVectors)
         """
-        self.unique_id = hashlib.sha256(datetime.datetime.now().strftime("%Y%m%d%H%M%S").encode()).hexdigest()[:10]
+        self.unique_id = self.get_unique_id()
+        if shard is not None:  # easier to tell a state's shards apart
+            self.unique_id = f'{self.unique_id}_shard{shard}'
 
-        # use the url_df to get therapist pages, scrape them, and store in therapist_profiles_df
+        # use the url_df to get therapist pages, scrape them, and stream them to the raw records file
         self.state = state  # for sake of passing as parameter when rescraping
         self.url_df = url_df
-        self.therapist_profiles_df = pd.DataFrame(columns=DirectoryBuilder.get_therapist_profile_cols())
-        self.populate_therapist_df(rescrape)
-
-        # clean the therapist profiles dataframe
-        self.therapist_profiles_df = DirectoryBuilder.clean_therapist_profile_dataframe(self.therapist_profiles_df,
-                                                                                        self.state)
-        # save the clean therapist profile df
-        if rescrape:
-            self.therapist_profiles_df.to_csv(f'../scraped_data/{state}_therapist_directory_'
-                                              f'{datetime.datetime.now().date()}_{self.unique_id}.csv',
-                                              index=False, header=True)
-
-    def populate_therapist_df(self, rescrape):
-        # let's go row by row and get therapist profile data to add to the master dataframe (therapist_profiles_df)
-        program_start = time.time()
+        self.requests_per_second, self.parse_processes = requests_per_second, parse_processes
+        self.raw_path = (f'../scraped_data/{state}_therapist_directory_raw_{datetime.datetime.now().date()}_'
+                         f'{self.unique_id}.csv')
+        self.directory_path = (f'../scraped_data/{state}_therapist_directory_'
+                               f'{datetime.datetime.now().date()}_{self.unique_id}.csv')
+        self.max_attempts, self.retry_backoff = max_attempts, retry_backoff
+        self.page_cache = PageCache(PageCache.get_cache_dir(state))
+        self.incremental = incremental
+        self.unchanged_profiles = 0  # profiles whose last record was reused (304 or same content hash)
+        self.rate_limiter = rate_limiter
+        self.metrics_format, self.metrics_interval = metrics_format, metrics_interval
+        self.extraction_backend = extraction_backend
 
-        for index, row in self.url_df.iterrows():
-            try:
-                current_therapist = TherapistPageScraper(row)  # a row contains row['Gender'] and row['URL']
-                self.therapist_profiles_df = pd.concat([self.therapist_profiles_df,
-                                                        current_therapist.therapist_data], ignore_index=True)
-            except:
-                self.therapist_profiles_df = pd.concat([self.therapist_profiles_df,
-                                                        DirectoryBuilder.failed_scrape_output(row['URL'])],
-                                                       ignore_index=True)
-            time.sleep(10)  # avoid overloading psychology today's server
+        self.crawl_state = CrawlStateStore(CrawlStateStore.get_db_path(state, shard))
+        self.cleaned = False  # resuming a run that died after writing its clean directory
+        if resume:
+            self.load_unfinished_run()
+        else:
+            self.crawl_state.start_run(self.unique_id, self.raw_path, self.directory_path, self.url_df)
 
-        if rescrape:
-            self.rescrape_program_failures()
+        if not self.cleaned:
+            self.populate_therapist_df(resume)
+        self.page_cache.close()
 
-        self.therapist_profiles_df.fillna('N/A', inplace=True)
+        # clean the raw therapist profiles chunk by chunk, save the clean directory. a shard stays raw for the merge
+        if shard is None:
+            if not self.cleaned:
+                DirectoryBuilder.clean_therapist_profile_file(self.raw_path, self.state, self.directory_path)
+                self.crawl_state.mark_cleaned(self.unique_id)  # before the raw file goes, so it's never cleaned again
+                os.remove(self.raw_path)
+            # made from the clean directory, so a run resumed after the clean only redoes these
+            self.save_compact_directory(self.directory_path)
+            DescriptionVectors.build(self.directory_path)
+        self.crawl_state.finish_run(self.unique_id)
+        self.crawl_state.close()
+
+    @staticmethod
+    def get_unique_id():
+        # id in a run's file names. random, so runs started in the same second (reparses, merges, shards, crawls on
+        # other machines) never write to each other's files
+        return uuid.uuid4().hex[:10]
+
+    def load_unfinished_run(self):
+        run = self.crawl_state.get_unfinished_run()
+        if run is None:
+            raise ValueError(f'no unfinished crawl to resume for {self.state}')
+        self.unique_id, self.raw_path, self.directory_path = run['unique_id'], run['raw_path'], run['directory_path']
+        self.url_df = self.crawl_state.get_urls()
+        # runs from before the clean was recorded: a directory w/o its raw file can only mean it was cleaned
+        self.cleaned = run['cleaned'] or (not os.path.exists(self.raw_path) and os.path.exists(self.directory_path))
+        logging.info(f'$|$ Function: Resume Crawl | Run: {self.unique_id} | Cleaned: {self.cleaned} | '
+                     f'Status Counts: {self.crawl_state.get_status_counts()}')
+
+    def populate_therapist_df(self, resume=False):
+        # let's go row by row and get therapist profile data to add to the raw records file
+        program_start = time.time()
+
+        # when resuming, only pending URLs still need a request
+        pending_urls = self.crawl_state.get_urls('pending') if resume else self.url_df
+
+        # pages are fetched at a fixed rate by the engine and parsed on the process pool while the next request waits
+        genders = dict(zip(self.url_df['URL'], self.url_df['Gender']))
+        extraction_pool = ExtractionPool(max_workers=self.parse_processes, extraction_backend=self.extraction_backend)
+        with self.get_metrics_exporter(), extraction_pool, \
+                RecordSink(self.raw_path, DirectoryBuilder.get_therapist_profile_cols(), append=resume,
+                           on_flush=self.crawl_state.mark_written) as record_sink:
+            handle_page = self.add_therapist_profile(genders, extraction_pool, record_sink)
+            if resume:  # pages fetched before the crash but never written out - parse them, no request needed
+                for therapist_url, therapist_gender, page_html in self.crawl_state.get_fetched_pages():
+                    handle_page({'url': therapist_url, 'html': page_html, 'error': None}, fetched_before=True)
+            fetch_engine = AsyncFetchEngine(requests_per_second=self.requests_per_second,
+                                            parse_workers=extraction_pool.max_workers,
+                                            get_request_headers=self.page_cache.get_validators if self.incremental
+                                            else None, max_attempts=self.max_attempts,
+                                            retry_backoff=self.retry_backoff, rate_limiter=self.rate_limiter)
+            fetch_engine.run(pending_urls['URL'].tolist(), handle_page)
 
         program_end = time.time()
 
         logging.info(f'$|$ Function: Program Efficiency / Time | Time: {program_end - program_start} | '
-                     f'Therapists Scraped: {self.url_df.shape[0]}')
-
-    def rescrape_program_failures(self):
-        # normally a web request handshake issue or the therapist profile was removed
-        failed_scrapes = self.therapist_profiles_df[self.therapist_profiles_df['therapist_name'].str.contains(
-            'program failure', case=False, na=False, regex=True)][['therapist_url', 'therapist_gender']].copy()
-        failed_scrapes = failed_scrapes.rename(columns={'therapist_url': 'URL', 'therapist_gender': 'Gender'})
-        if failed_scrapes.empty:
-            return
-
-        # try rescraping the affected profiles
-        rescrape = TherapistDirectory(self.state, url_df=failed_scrapes, rescrape=False)
-        rescraped_profiles = rescrape.therapist_profiles_df
-
-        # overwrite the successful rescrape...otherwise will redundantly overwrite program failure again
-        if not rescraped_profiles.empty:
-            for index, row in self.therapist_profiles_df.iterrows():
-                therapist_url = row['therapist_url']
-                if therapist_url in set(rescraped_profiles['therapist_url']):
-                    try:
-                        rescraped_row = rescraped_profiles[rescraped_profiles['therapist_url'] == therapist_url].iloc[0]
-                        for col in self.therapist_profiles_df.columns:
-                            self.therapist_profiles_df.at[index, col] = rescraped_row[col]
-                    except IndexError:  # profile removed from website since scraping URL
-                        pass
+                     f'Therapists Scraped: {pending_urls.shape[0]} | Unchanged Profiles: {self.unchanged_profiles}')
+        PipelineMetrics.get_metrics().log_summary()
+
+    def get_metrics_exporter(self):
+        if self.metrics_format is None:
+            return nullcontext()
+        return MetricsExporter(MetricsExporter.get_metrics_path(self.state, self.unique_id, self.metrics_format),
+                               self.metrics_format, self.metrics_interval,
+                               labels={'state': self.state, 'run': self.unique_id})
+
+    def add_therapist_profile(self, genders, extraction_pool, record_sink):
+        def handle_page(page, fetched_before=False):
+            # a 304 means the page hasn't changed since the last crawl, it comes from the cache instead
+            cached_page = self.page_cache.get(page['url']) if page.get('status') == 304 else None
+            if page['error']:  # the therapist profile was removed, or still failing after max_attempts
+                self.crawl_state.mark_fetch_error(page['url'], page['error'], page.get('attempts', 1))
+                therapist_data = DirectoryBuilder.failed_scrape_record(page['url'])
+            elif page.get('status') == 304 and cached_page is None:  # evicted since the request went out
+                self.crawl_state.mark_fetch_error(page['url'], 'HTTP 304 without a cached page',
+                                                  page.get('attempts', 1))
+                therapist_data = DirectoryBuilder.failed_scrape_record(page['url'])
+            else:
+                validators = {'etag': page.get('etag'), 'last_modified': page.get('last_modified')}
+                if cached_page:
+                    page['html'] = cached_page['html']
+                    validators = {key: validators[key] or cached_page[key] for key in validators}
+                if not fetched_before:
+                    self.crawl_state.mark_fetched(page['url'], page['html'], page.get('attempts', 1))
+                therapist_data = self.get_unchanged_record(page['url'], genders[page['url']], page['html'])
+                page_text = None  # already in the cache if the record is reused
+                if therapist_data is None:
+                    therapist_data, page_text = extraction_pool.extract_page(page['url'], genders[page['url']],
+                                                                             page['html'])
+                with PipelineMetrics.get_metrics().time('page_cache_store'):
+                    self.page_cache.store(page['url'], genders[page['url']], page['html'], page_text,
+                                          record=therapist_data, **validators)
+            record_sink.add(therapist_data)
+        return handle_page
+
+    def get_unchanged_record(self, therapist_url, therapist_gender, page_html):
+        # last crawl's record for this page if the page is byte for byte the same, otherwise None (parse it)
+        if not self.incremental:
+            return None
+        therapist_data = self.page_cache.get_record(therapist_url, PageCache.get_content_hash(page_html))
+        if therapist_data is None:
+            return None
+        self.unchanged_profiles += 1
+        PipelineMetrics.get_metrics().increment('unchanged_profiles')
+        return dict(therapist_data, therapist_gender=therapist_gender)
+
+    @staticmethod
+    def save_compact_directory(directory_path):
+        # typed Parquet copy of the clean directory next to the CSV (see CompactDirectory.load). the CSV is already
+        # written, so a problem w/ the copy is logged instead of losing the end of the crawl
+        try:
+            CompactDirectory.from_csv(directory_path).save(CompactDirectory.get_parquet_path(directory_path))
+        except Exception as e:
+            logging.info(f'$|$ Function: Save Compact Directory | Directory: {directory_path} | Error: {e!r}')
+
+    @staticmethod
+    def merge_shards(state, raw_paths):
+        """
+        Parameters:
+        - state (str): state the shards were crawled for
+        - raw_paths (list): raw records files of the state's shards (TherapistDirectory(..., shard=...).raw_path)
+
+        Joins the shards' raw records into one file and cleans it into the state's directory CSV (+ Parquet copy),
+        same as the end of a single process crawl. The shard files are left for the caller to remove. Returns the
+        path of the directory CSV
+        """
+        unique_id = TherapistDirectory.get_unique_id()
+        raw_path = f'../scraped_data/{state}_therapist_directory_raw_{datetime.datetime.now().date()}_{unique_id}.csv'
+        directory_path = f'../scraped_data/{state}_therapist_directory_{datetime.datetime.now().date()}_{unique_id}.csv'
+
+        # every shard file has the same header (RecordSink), so keep the first one and append the rest's rows as-is
+        header_written = False
+        with open(raw_path, 'wb') as raw_file:
+            for shard_path in raw_paths:
+                with open(shard_path, 'rb') as shard_file:
+                    header = shard_file.readline()
+                    if not header_written:
+                        raw_file.write(header)
+                        header_written = True
+                    shutil.copyfileobj(shard_file, raw_file)
+            if not header_written:  # no shard made it, still leave a readable (empty) directory
+                raw_file.write((','.join(DirectoryBuilder.get_therapist_profile_cols()) + '\n').encode('utf-8'))
+
+        DirectoryBuilder.clean_therapist_profile_file(raw_path, state, directory_path)
+        os.remove(raw_path)
+        TherapistDirectory.save_compact_directory(directory_path)
+        DescriptionVectors.build(directory_path)
+        logging.info(f'$|$ Function: Merge Shards | State: {state} | Shards: {len(raw_paths)} | '
+                     f'Directory: {directory_path}')
+        return directory_path
+
+    @staticmethod
+    def reparse(state, parse_processes=None, from_html=False, extraction_backend='html2text'):
+        """
+        Parameters:
+        - state (str): state whose page cache gets re-parsed
+        - parse_processes (int): worker processes used to parse pages. defaults to every core
+        - from_html (boolean): redo the html2text conversion too. only needed when the fix is in get_page_data /
+            html_to_text; otherwise the cached page text is parsed directly
+        - extraction_backend (str): 'html2text' or 'dom'. 'dom' always reads the cached html
+
+        Rebuilds the directory CSV from the state's PageCache with the current extraction code, without making a
+        single request. Returns the path of the new directory CSV
+        """
+        unique_id = TherapistDirectory.get_unique_id()
+        raw_path = f'../scraped_data/{state}_therapist_directory_raw_{datetime.datetime.now().date()}_{unique_id}.csv'
+        directory_path = f'../scraped_data/{state}_therapist_directory_{datetime.datetime.now().date()}_{unique_id}.csv'
+        program_start = time.time()
+
+        page_cache = PageCache(PageCache.get_cache_dir(state))
+        pages = ((therapist_url, therapist_gender, page_html, None if from_html else page_text)
+                 for therapist_url, therapist_gender, page_html, page_text in page_cache.iter_pages())
+        with ExtractionPool(max_workers=parse_processes, extraction_backend=extraction_backend) as extraction_pool, \
+                RecordSink(raw_path, DirectoryBuilder.get_therapist_profile_cols()) as record_sink:
+            for batch in extraction_pool.map_batches(pages):
+                for therapist_data in batch:
+                    record_sink.add(therapist_data)
+        page_cache.close()
+
+        DirectoryBuilder.clean_therapist_profile_file(raw_path, state, directory_path)
+        os.remove(raw_path)
+        TherapistDirectory.save_compact_directory(directory_path)
+        DescriptionVectors.build(directory_path)
+
+        logging.info(f'$|$ Function: Reparse Page Cache | Time: {time.time() - program_start} | '
+                     f'Therapists Parsed: {record_sink.records_written}')
+        PipelineMetrics.get_metrics().log_summary()
+        return directory_path
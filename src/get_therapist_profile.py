@@ -1,10 +1,12 @@
-from fuzzywuzzy import fuzz
 from langchain_community.document_loaders import AsyncHtmlLoader
 from langchain_community.document_transformers import Html2TextTransformer
-from utility import TextProcessing
+from langchain_core.documents import Document
+from pipeline_metrics import PipelineMetrics
+from utility import KeywordMatcher, TextProcessing, VocabularyMatcher
 import logging
 import pandas as pd
 import re
+import time
 
 
 class TherapistPageScraper:
@@ -14,8 +16,10 @@ class TherapistPageScraper:
     - show_text is used to show the literal page text whenever I need to debug a failed scrape. Usually this leads
         to me fixing the regex text mining pattern or field extraction logic for the corresponding field in the
         utility file methods
+    - page_html (str): raw page HTML if it was already fetched (e.g. by AsyncFetchEngine). when left as None the
+        page is loaded here
     """
-    def __init__(self, therapist_gender_and_url, show_text=False):
+    def __init__(self, therapist_gender_and_url, show_text=False, page_html=None):
         # initialize url and gender
         try:  # if going E2E from url_scraper csv->df
             self.therapist_url = therapist_gender_and_url['URL']
@@ -25,9 +29,32 @@ class TherapistPageScraper:
             self.therapist_gender = therapist_gender_and_url[1]
 
         # get page data
-        self.page_text = self.get_page_data(show_text)
+        self.page_text = self.get_page_data(show_text, page_html)
 
         # scrape fields
+        self.scrape_fields()
+
+        # compile into a dataframe, which will be added as a row to the therapist directory
+        scraped_data_dict = self.compile_data()
+        self.therapist_data = pd.DataFrame([scraped_data_dict])
+
+        # log profiles that had any failed field scrapes
+        self.log_failed_scrape(scraped_data_dict)
+
+    @classmethod
+    def parse(cls, page_text, url, gender):
+        """pure entry point: page text in, record dict out. no network calls or pandas, so it can run in a worker
+        process (see ExtractionPool)"""
+        scraper = cls.__new__(cls)  # skip __init__, which would go fetch the page
+        scraper.therapist_url, scraper.therapist_gender, scraper.page_text = url, gender, page_text
+        scraper.scrape_fields()
+        return scraper.compile_data()
+
+    def scrape_fields(self):
+        metrics = PipelineMetrics.get_metrics()
+        self.matches = {}  # regex pattern -> its match in this page, see processor
+        with metrics.time('keyword_scan'):  # issues, ages, lgbtq, veteran
+            self.keyword_hits = KeywordMatcher.get_matcher().scan(self.page_text)
         self.available, self.in_person, self.online = self.get_availability('availability')
         self.street_city, self.zipcode = self.get_address('address')
         self.credentials = self.get_simple_field('credentials')
@@ -45,13 +72,11 @@ class TherapistPageScraper:
         self.therapy_types = self.get_fuzz_fields('therapy_types')
         self.veteran_status = self.get_direct_match_field('veteran_status')
 
-        # compile into a dataframe, which will be added as a row to the therapist directory
-        scraped_data_dict = self.compile_data()
-        self.therapist_data = pd.DataFrame([scraped_data_dict])
-
+    @staticmethod
+    def log_failed_scrape(scraped_data_dict):
         # log profiles that had any failed field scrapes
-        if (self.therapist_data == 'failed scrape').any().any():
-            logging.info(f'$|$ URL: {self.therapist_url} | Failure Type: Failed Scrape \n'
+        if any(isinstance(val, str) and val == 'failed scrape' for val in scraped_data_dict.values()):
+            logging.info(f'$|$ URL: {scraped_data_dict["therapist_url"]} | Failure Type: Failed Scrape \n'
                          f'Data: ({ {k: v for k, v in scraped_data_dict.items() if k != "description"} }) \n ________')
 
     def compile_data(self):
@@ -82,23 +107,30 @@ class TherapistPageScraper:
 
     """all data scraper methods down under"""
 
-    def get_page_data(self, show_page_text=False):
+    def get_page_data(self, show_page_text=False, page_html=None):
         # HTMl2Text Transformer is used to get ALL the page text, which we then initialize to scrape
-        page_transformed = Html2TextTransformer().transform_documents(AsyncHtmlLoader(self.therapist_url).load())
-        page_text = page_transformed[0].page_content[0:-540]  # get rid of stuff at the end
+        if page_html is None:
+            page_html = AsyncHtmlLoader(self.therapist_url).load()[0].page_content
+        page_text = self.html_to_text(page_html)
         if show_page_text:
             print(f'ALL TEXT: \n\n\n {page_text} \n\n\n _________DONE___________\n\n\n')
         return page_text
 
-    @staticmethod  # wrapper function around scraper methods (below). helpful to log performance
+    @staticmethod
+    def html_to_text(page_html):
+        page_transformed = Html2TextTransformer().transform_documents([Document(page_content=page_html)])
+        return page_transformed[0].page_content[0:-540]  # get rid of stuff at the end
+
+    @staticmethod  # wrapper function around scraper methods (below). times each field (see PipelineMetrics)
     def processor(func):
         def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
             pattern = TextProcessing.get_field_regex_pattern(*args)  # get regex pattern to find match in text
-            if 'age' in args:
-                match = re.findall(pattern, self.page_text)
-            else:
-                match = re.search(pattern, self.page_text, re.DOTALL)  # see if there is a match
+            if pattern not in self.matches:  # name / credentials and insurance / session_cost share one, search once
+                self.matches[pattern] = re.search(pattern, self.page_text, re.DOTALL)
+            match = self.matches[pattern]  # see if there is a match
             data = func(self, *args, match, **kwargs)  # call the original function to try to scrape data
+            PipelineMetrics.get_metrics().observe(f'extract {args[0]}', time.perf_counter() - start)
             return data  # return scraping results to og function, which routes to scrape_data_fields method/initializer
         return wrapper
 
@@ -116,22 +148,15 @@ class TherapistPageScraper:
                 return 'failed scrape', 'failed scrape'
         return 'N/A', 'N/A'
 
-    @processor
-    def get_age(self, field, match=None):
-        # use a different regex pattern. just look for exact matches from small list. convert to set
-        if match:
-            try:
-                if len(set(match)) != 0:
-                    return set(match)
-            except:
-                return 'failed scrape'
+    def get_age(self, field):
+        # exact matches from a small list, picked up by the keyword scan
+        if self.keyword_hits[field]:
+            return self.keyword_hits[field]
         return 'N/A'
 
-
-    @processor
-    def get_direct_match_field(self, field, match=None):
-        # we are looking for an exact match on text (LGBTQ, LGBTQ+, Veteran)
-        if match:
+    def get_direct_match_field(self, field):
+        # we are looking for an exact match on text (LGBTQ, LGBTQ+, Veteran), picked up by the keyword scan
+        if self.keyword_hits[field]:
             return 'Y'
         return 'N/A'
 
@@ -140,31 +165,34 @@ class TherapistPageScraper:
         if match:
             try:  # in order: availability, in-person accessibility, online accessibility
                 relevant_vals = TextProcessing.process_regex_match_text(match, field)()
-                if relevant_vals.startswith('Waitlist') or relevant_vals.startswith('Currently unable'):
-                    return 'N', 'N', 'N'
-                elif relevant_vals.startswith('Available both'):
-                    return 'Y', 'Y', 'Y'
-                elif relevant_vals.startswith('Available online only'):
-                    return 'Y', 'N', 'Y'
-                elif relevant_vals.startswith('Available in-person'):
-                    return 'Y', 'Y', 'N'
+                return self.get_availability_flags(relevant_vals)
             except:  # catch all
                 return 'failed scrape', 'failed scrape', 'failed scrape'
         return 'N/A', 'N/A', 'N/A'  # could not find pertinent info
 
+    @staticmethod
+    def get_availability_flags(availability_text):
+        # 'Available online only' -> ('Y', 'N', 'Y'). shared w/ the DOM backend (DomPageScraper)
+        if availability_text.startswith('Waitlist') or availability_text.startswith('Currently unable'):
+            return 'N', 'N', 'N'
+        elif availability_text.startswith('Available both'):
+            return 'Y', 'Y', 'Y'
+        elif availability_text.startswith('Available online only'):
+            return 'Y', 'N', 'Y'
+        elif availability_text.startswith('Available in-person'):
+            return 'Y', 'Y', 'N'
+        return 'N/A', 'N/A', 'N/A'
+
     @processor
     def get_fuzz_fields(self, field, match=None):
         # a couple fields require fuzzy string matching with a reference file
-        ref_file = TextProcessing.get_reference_data(f'../reference_data/{field}.txt')
+        vocabulary = VocabularyMatcher.for_field(field)
         val_matches = set()
         if match:
             try:
                 relevant_vals = TextProcessing.process_regex_match_text(match, field)()
-                for val in relevant_vals:  # fuzzy string matching - find top ratio for vals matching ref val above 85
-                    matches = [ref for ref in ref_file if fuzz.partial_ratio(val, ref) >= 85]
-                    highest_ratio = max(matches, key=lambda ref: fuzz.partial_ratio(val, ref), default=None)
-                    if highest_ratio:
-                        val_matches.add(highest_ratio)
+                # fuzzy string matching - find top ratio for vals matching ref val above 85
+                val_matches = {ref for ref in vocabulary.match_all(relevant_vals) if ref}
             except:  # catch all
                 return 'failed scrape'
         if not val_matches:
@@ -184,18 +212,9 @@ class TherapistPageScraper:
         return 'N/A'
 
     def get_issues(self, field):
-        """we treat this value differently. since issues can appear in many places, we do all the mining
-        and manipulation directly here to pull the key values"""
-        ref_file = TextProcessing.get_reference_data(f'../reference_data/{field}.txt')
-        issues = set()
-        for val in ref_file:
-            try:
-                match = re.search(rf'\b{val}\b', self.page_text, re.DOTALL)
-                if match:
-                    issues.add(val)
-            except:  # catch all
-                return 'failed scrape'
-        return issues
+        """we treat this value differently. since issues can appear in many places, they come from the keyword scan
+        over the whole page text rather than one regex match"""
+        return set(self.keyword_hits[field])
 
     @processor
     def get_simple_field(self, field, match=None):
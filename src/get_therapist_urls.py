@@ -1,8 +1,9 @@
-from selenium import webdriver
 from bs4 import BeautifulSoup
+from fetch_engine import AsyncFetchEngine
+from urllib.parse import urljoin
 import datetime
+import logging
 import pandas as pd
-import time
 
 
 class TherapistURLScraper:
@@ -10,43 +11,47 @@ class TherapistURLScraper:
     Parameters:
     - state (str): State for which therapists' URLs need to be scraped.
         - if state is two words, use a dash to separate (north-carolina); keep lowercase
-    - binary_pages (list): List of binary pages.
-        - number of pages to pull for male and female therapists (20 therapists per page). this will iterate
-                binary_pages * 2 times
-    - non_binary_pages (list): List of non-binary pages.
-        - number of pages to pull for non-binary therapists. default setting is 100, given there are significantly
-            less non-binary therapists than male and female therapists
+    - binary_pages (int): max number of result pages to walk for male and female therapists (20 therapists per
+        page). discovery normally stops well before this, once the pages stop turning up new therapists
+    - non_binary_pages (int): max number of result pages for non-binary therapists. default setting is 20, given
+        there are significantly less non-binary therapists than male and female therapists
+    - requests_per_second (float): request budget, same as the profile crawl. default 0.1 == 10 seconds per page
+    - min_new_rate (float): a gender stops once fewer than this share of the URLs on its last `window` pages were
+        new (coverage has saturated)
+    - window (int): number of recent pages the new URL rate is measured over
+    - base_url (str): site to discover from. only changed to point discovery at a StandInServer
+    - rate_limiter (PolitenessController / SharedTokenBucket): pacing shared w/ the profile crawl or w/ other crawls
+        (see AsyncFetchEngine, CrawlOrchestrator). None == its own PolitenessController at requests_per_second
 
-    Takes a while to run if trying to get a BIG list. 3-second timer between API call to avoid request overload
+    Walks the real result pages (?page=1, 2, ...) for each gender over one pooled HTTP session (the fetch engine),
+    instead of starting a new browser for every request and re-reading the first page. Genders are interleaved, and
+    every page is parsed before the next results page is picked, so a gender that's done never gets another
+    request. A gender is done when a page has no results, or when its recent pages are nearly all therapists we've
+    already seen
     """
-    def __init__(self, state, binary_pages, non_binary_pages=20):
+    def __init__(self, state, binary_pages, non_binary_pages=20, requests_per_second=0.1, min_new_rate=0.05,
+                 window=5, base_url='https://www.psychologytoday.com', rate_limiter=None):
         # usually a lot less non-binary therapists
         self.state, self.binary_pages, self.non_binary_pages = state, binary_pages, non_binary_pages
+        self.requests_per_second, self.min_new_rate, self.window = requests_per_second, min_new_rate, window
+        self.base_url, self.rate_limiter = base_url, rate_limiter
+        self.discovery_stats = {}  # gender -> pages / urls found / new url rate history, see log_discovery_stats
         self.url_df = self.get_therapist_page_urls()  # save urls as CSV and return df
 
     def get_therapist_page_urls(self):
         # get therapist URLs by gender (male, female, non-binary)
-        # we scrape first pages only b/c each webpage instance generates a new random unsorted list of therapists
-        all_urls = []
-        for page in range(1, self.binary_pages+1):
-            try:
-                self.get_urls('male', all_urls)
-                time.sleep(10)  # api server limit
-            except:  # usually an API request / handshake failure issue...not sure why
-                pass
+        max_pages = {'male': self.binary_pages, 'female': self.binary_pages, 'non-binary': self.non_binary_pages}
+        self.discovery_stats = {gender: {'pages': 0, 'urls': 0, 'new_urls': [], 'done': False} for gender in max_pages}
+        all_urls, seen_urls = [], set()
+        page_genders = {}  # results page URL -> gender
 
-            try:
-                self.get_urls('female', all_urls)
-                time.sleep(10)  # api server limit
-            except:
-                pass
+        def handle_page(page):
+            self.add_page_urls(page, page_genders[page['url']], all_urls, seen_urls)
 
-        for page in range(1, self.non_binary_pages+1):
-            try:
-                self.get_urls('non-binary', all_urls)
-                time.sleep(10)  # api server limit
-            except:
-                pass
+        fetch_engine = AsyncFetchEngine(requests_per_second=self.requests_per_second, max_in_flight=1,
+                                        rate_limiter=self.rate_limiter, wait_for_handled=True)
+        fetch_engine.run(self.get_page_urls(max_pages, page_genders), handle_page)
+        self.log_discovery_stats(fetch_engine.requests_sent)
 
         # save as df, convert to csv, return df
         url_df = pd.DataFrame(all_urls, columns=['Gender', 'URL']).drop_duplicates(subset=['URL'])
@@ -54,26 +59,66 @@ class TherapistURLScraper:
                       index=False, header=True)
         return url_df
 
-    def get_urls(self, gender, url_list):
-        urls = self.return_urls(f"https://www.psychologytoday.com/us/therapists/{self.state}?category={gender}")
-        for url in urls:
-            url_list.append((gender, url))
+    def get_page_urls(self, max_pages, page_genders):
+        # results pages round robin over the genders still going. read lazily by the fetch engine, so whether a
+        # gender gets another page is decided as late as possible
+        page = 1
+        while True:
+            genders = [gender for gender, stats in self.discovery_stats.items()
+                       if not stats['done'] and page <= max_pages[gender]]
+            if not genders:
+                return
+            for gender in genders:
+                if self.discovery_stats[gender]['done']:  # stopped while the other genders were being requested
+                    continue
+                page_url = self.get_results_page_url(gender, page)
+                page_genders[page_url] = gender
+                yield page_url
+            page += 1
+
+    def get_results_page_url(self, gender, page):
+        return f'{self.base_url}/us/therapists/{self.state}?category={gender}&page={page}'
+
+    def add_page_urls(self, page, gender, url_list, seen_urls):
+        stats = self.discovery_stats[gender]
+        stats['pages'] += 1
+        if page['error']:  # past the last results page, or a web request handshake issue
+            logging.info(f'$|$ Function: URL Discovery | URL: {page["url"]} | Error: {page["error"]}')
+            if page['failure'] == 'permanent':  # 404 / 410, there won't be any more pages
+                stats['done'] = True
+            return url_list
+
+        urls = self.return_urls(page['html'], self.base_url)
+        new_urls = [url for url in urls if url not in seen_urls]
+        seen_urls.update(new_urls)
+        url_list.extend((gender, url) for url in new_urls)
+        stats['urls'] += len(new_urls)
+        stats['new_urls'].append((len(new_urls), len(urls)))
+
+        # no results == past the last page. otherwise stop once the recent pages are (nearly) all repeats
+        if not urls or (len(stats['new_urls']) >= self.window and self.get_new_url_rate(stats) < self.min_new_rate):
+            stats['done'] = True
         return url_list
 
-    @staticmethod
-    def return_urls(url):
-        # use this to get 20 URLs per page
-        driver = webdriver.Chrome()
-        time.sleep(1)
-        driver.get(url)
+    def get_new_url_rate(self, stats):
+        # share of the URLs on the last `window` pages we hadn't seen before
+        recent = stats['new_urls'][-self.window:]
+        return sum(new for new, _ in recent) / max(sum(found for _, found in recent), 1)
 
+    @staticmethod
+    def return_urls(page_html, base_url='https://www.psychologytoday.com'):
+        # use this to get the 20 profile URLs on a results page
         urls = []
-        all_data = BeautifulSoup(driver.page_source, 'html.parser')
+        all_data = BeautifulSoup(page_html, 'lxml')
         info_divs = all_data.find_all("div", class_="results-row-info")
         for divs in info_divs:
             link = divs.find("a", class_="profile-title")  # get the actual URLs from the tags
-            if link:
-                href = link.get("href")
-                urls.append(href)
-        print(urls)
+            if link and link.get("href"):
+                urls.append(urljoin(base_url, link.get("href")))
         return urls
+
+    def log_discovery_stats(self, requests_sent):
+        for gender, stats in self.discovery_stats.items():
+            logging.info(f'$|$ Function: URL Discovery | Gender: {gender} | Pages: {stats["pages"]} | '
+                         f'URLs: {stats["urls"]} | Recent New URL Rate: {self.get_new_url_rate(stats):.3f}')
+        logging.info(f'$|$ Function: URL Discovery | Requests Sent: {requests_sent}')
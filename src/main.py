@@ -1,8 +1,46 @@
+from fetch_engine import PolitenessController
 from get_therapist_directory import TherapistDirectory
 from get_therapist_urls import TherapistURLScraper
+from orchestrator import CrawlOrchestrator
+import argparse
+import logging
 
 # get URLs, build Therapist Directory
 if __name__ == "__main__":
-    therapist_urls = TherapistURLScraper('north-carolina', 250, 100)
-    url_df = therapist_urls.url_df
-    TherapistDirectory('north-carolina', url_df)
+    # log results / performance across different levels of the program. set here, not on import, so importing the
+    # scraper (benchmarks.py, a worker joining a crawl) never truncates the log of a crawl that's running
+    logging.basicConfig(filename='../check_performance.log', filemode='w', encoding='utf-8', level=logging.INFO,
+                        format='%(asctime)s - %(name)s- %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    parser = argparse.ArgumentParser(description="Scrape a state's therapist directory from Psychology Today")
+    parser.add_argument('--state', default='north-carolina', help='lowercase, dash separated (north-carolina)')
+    parser.add_argument('--resume', action='store_true',
+                        help='pick up the last unfinished crawl for the state instead of starting over')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only download and parse profiles that changed since the last crawl')
+    parser.add_argument('--reparse', action='store_true',
+                        help='rebuild the directory from the saved page cache with the current parser, no requests')
+    parser.add_argument('--metrics', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help='format of the per-stage timing export written to scraped_data/ while crawling')
+    parser.add_argument('--extraction', choices=['html2text', 'dom'], default='html2text',
+                        help='read profiles from the html2text page text or straight from the parsed html (faster)')
+    parser.add_argument('--states', nargs='+',
+                        help='crawl several states at once w/ sharded workers sharing one request budget')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes for --states')
+    parser.add_argument('--shard-size', type=int, default=500, help='therapist URLs per shard for --states')
+    args = parser.parse_args()
+
+    if args.states:  # finished shards in the queue aren't redone, so this resumes too
+        CrawlOrchestrator(args.states, args.workers, shard_size=args.shard_size, incremental=args.incremental,
+                          metrics_format=args.metrics, extraction_backend=args.extraction).run()
+    elif args.reparse:
+        TherapistDirectory.reparse(args.state, extraction_backend=args.extraction)
+    elif args.resume:  # URLs come from the saved crawl state, no need to scrape them again
+        TherapistDirectory(args.state, resume=True, incremental=args.incremental, metrics_format=args.metrics,
+                           extraction_backend=args.extraction)
+    else:  # discovery and the profile crawl share one controller, so the crawl starts from what discovery learned
+        politeness = PolitenessController(0.1)
+        therapist_urls = TherapistURLScraper(args.state, 250, 100, rate_limiter=politeness)
+        url_df = therapist_urls.url_df
+        TherapistDirectory(args.state, url_df, incremental=args.incremental, metrics_format=args.metrics,
+                           extraction_backend=args.extraction, rate_limiter=politeness)
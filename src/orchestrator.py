@@ -0,0 +1,214 @@
+from crawl_queue import CrawlQueue, SharedTokenBucket
+from crawl_state import CrawlStateStore
+from fetch_engine import PolitenessController
+from get_therapist_directory import TherapistDirectory
+from get_therapist_urls import TherapistURLScraper
+from contextlib import contextmanager
+import argparse
+import logging
+import multiprocessing
+import os
+import pandas as pd
+import socket
+import threading
+import time
+
+
+class CrawlOrchestrator:
+    """
+    Parameters:
+    - states (list): states to crawl, same format as TherapistDirectory (north-carolina)
+    - workers (int): crawl worker processes started on this machine. more can join from other machines w/
+        `python orchestrator.py worker` as long as they see the same queue file and scraped_data directory
+    - requests_per_second (float): request budget for all the workers together, wherever they run. default 0.1 ==
+        psychology today's 10 second limit
+    - shard_size (int): therapist URLs per profile shard
+    - binary_pages (int): max result pages per state for male / female therapists (see TherapistURLScraper)
+    - non_binary_pages (int): max result pages per state for non-binary therapists
+    - incremental (boolean): conditional requests + record reuse for every shard (see TherapistDirectory)
+    - metrics_format (str): per-stage timing export for every shard, 'jsonl' / 'prometheus' / None (see
+        TherapistDirectory)
+    - extraction_backend (str): 'html2text' or 'dom' for every shard (see TherapistDirectory)
+    - queue_path (str): the CrawlQueue file. defaults to CrawlQueue.get_db_path()
+    - base_url (str): site to crawl. only changed to point the crawl at a StandInServer
+    - poll_interval (float): seconds a worker waits when every shard is claimed (see CrawlWorker)
+
+    Crawls several states at once instead of one after the other. Each state is split into shards on a shared
+    CrawlQueue: discovery, then its URLs in slices of shard_size, then a merge that cleans the slices into the
+    state's directory. Workers take whichever shard is next, so while one state is still being discovered another
+    is being crawled, and every worker takes its requests from the same SharedTokenBucket. Throughput goes up with
+    workers until the combined rate reaches requests_per_second, which is never exceeded
+
+    Re-running with the same queue picks up where it left off: finished shards aren't redone, and a shard whose
+    worker died is resumed from its own crawl state by the next worker to claim it
+    """
+    def __init__(self, states, workers=4, requests_per_second=0.1, shard_size=500, binary_pages=250,
+                 non_binary_pages=100, incremental=False, metrics_format='jsonl', extraction_backend='html2text',
+                 queue_path=None, base_url='https://www.psychologytoday.com', poll_interval=30):
+        self.states, self.workers, self.requests_per_second = states, workers, requests_per_second
+        self.discovery_settings = {'binary_pages': binary_pages, 'non_binary_pages': non_binary_pages,
+                                   'shard_size': shard_size, 'incremental': incremental,
+                                   'metrics_format': metrics_format, 'extraction_backend': extraction_backend,
+                                   'base_url': base_url}
+        self.queue_path, self.poll_interval = queue_path or CrawlQueue.get_db_path(), poll_interval
+
+    def run(self):
+        # returns {state: clean directory CSV path} for every state that got merged
+        program_start = time.time()
+        crawl_queue = CrawlQueue(self.queue_path)
+        crawl_queue.set_rate(self.requests_per_second)
+        new_states = crawl_queue.add_states(self.states, self.discovery_settings)
+        logging.info(f'$|$ Function: Crawl Orchestrator | States: {len(self.states)} | New States: {len(new_states)} '
+                     f'| Workers: {self.workers} | Requests/sec: {self.requests_per_second}')
+
+        host = socket.gethostname()
+        processes = [multiprocessing.Process(target=CrawlWorker.run_worker,
+                                             args=(self.queue_path, f'{host}-{i}', self.poll_interval))
+                     for i in range(self.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        directory_paths = {}
+        for state in self.states:
+            merges = crawl_queue.get_results(state, 'merge')
+            if merges:
+                directory_paths[state] = list(merges.values())[-1]['directory_path']
+        logging.info(f'$|$ Function: Crawl Orchestrator | Time: {time.time() - program_start} | '
+                     f'Shards: {crawl_queue.get_status_counts()} | States Merged: {len(directory_paths)}')
+        crawl_queue.close()
+        return directory_paths
+
+
+class CrawlWorker:
+    """
+    Parameters:
+    - queue_path (str): the CrawlQueue file shared by every worker
+    - worker_id (str): name the worker's claims are recorded under. defaults to host-pid
+    - parse_processes (int): extraction processes per profile shard. keep it low, every worker has its own pool
+    - poll_interval (float): seconds to wait when every shard is claimed but some are still running (they can
+        add more shards)
+
+    Claims shards from the queue until none are left, holding each one's lease while it works on it (see
+    keep_lease). A shard that raises goes back on the queue for another try (CrawlQueue.fail)
+    """
+    def __init__(self, queue_path, worker_id=None, parse_processes=1, poll_interval=30):
+        self.queue_path, self.parse_processes, self.poll_interval = queue_path, parse_processes, poll_interval
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.crawl_queue = CrawlQueue(queue_path)
+        # the worker backs off on its own when the site pushes back, and stays under the shared budget either way
+        self.rate_limiter = PolitenessController(self.crawl_queue.get_rate() or 0.1,
+                                                 rate_limiter=SharedTokenBucket(self.crawl_queue))
+
+    @staticmethod
+    def run_worker(queue_path, worker_id=None, poll_interval=30):
+        # process target for CrawlOrchestrator
+        CrawlWorker(queue_path, worker_id, poll_interval=poll_interval).run()
+
+    def run(self):
+        shards_done = 0
+        while True:
+            shard = self.crawl_queue.claim(self.worker_id)
+            if shard is None:
+                if self.crawl_queue.is_finished():
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            logging.info(f'$|$ Function: Crawl Worker | Worker: {self.worker_id} | Shard: {shard["shard_id"]} | '
+                         f'State: {shard["state"]} | Kind: {shard["kind"]} | Attempt: {shard["attempts"]}')
+            try:
+                with self.keep_lease(shard):
+                    self.process_shard(shard)
+                shards_done += 1
+            except Exception as e:  # someone else can try it, the rest of the states keep going
+                status = self.crawl_queue.fail(shard['shard_id'], repr(e))
+                logging.info(f'$|$ Function: Crawl Worker | Worker: {self.worker_id} | Shard: {shard["shard_id"]} | '
+                             f'Error: {e!r} | Status: {status}')
+        logging.info(f'$|$ Function: Crawl Worker | Worker: {self.worker_id} | Shards Done: {shards_done} | '
+                     f'Rate Limit Wait: {self.rate_limiter.wait_time:.1f}s')
+        self.crawl_queue.close()
+
+    @contextmanager
+    def keep_lease(self, shard):
+        # renew the shard's lease in the background while it runs, so it's only taken over if this worker dies
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.crawl_queue.lease_seconds / 3):
+                self.crawl_queue.renew(shard['shard_id'], self.worker_id)
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+
+    def process_shard(self, shard):
+        if shard['kind'] == 'discovery':
+            self.discover(shard)
+        elif shard['kind'] == 'profiles':
+            self.crawl_profiles(shard)
+        else:
+            self.merge(shard)
+
+    def discover(self, shard):
+        # state's therapist URLs -> profile shards of shard_size URLs
+        settings = shard['payload']
+        url_df = TherapistURLScraper(shard['state'], settings['binary_pages'], settings['non_binary_pages'],
+                                     base_url=settings.get('base_url', 'https://www.psychologytoday.com'),
+                                     rate_limiter=self.rate_limiter).url_df
+        urls = url_df[['Gender', 'URL']].values.tolist()
+        profile_shards = [('profiles', {'urls': urls[start:start + settings['shard_size']],
+                                        'incremental': settings['incremental'],
+                                        'metrics_format': settings.get('metrics_format', 'jsonl'),
+                                        'extraction_backend': settings.get('extraction_backend', 'html2text')})
+                          for start in range(0, len(urls), settings['shard_size'])]
+        self.crawl_queue.complete(shard['shard_id'], {'urls': len(urls)}, profile_shards)
+
+    def crawl_profiles(self, shard):
+        # a shard that was already started (its worker died) resumes from its own crawl state
+        crawl_state = CrawlStateStore(CrawlStateStore.get_db_path(shard['state'], shard['shard_id']))
+        resume = crawl_state.get_unfinished_run() is not None
+        crawl_state.close()
+        url_df = None if resume else pd.DataFrame(shard['payload']['urls'], columns=['Gender', 'URL'])
+        therapist_directory = TherapistDirectory(shard['state'], url_df, parse_processes=self.parse_processes,
+                                                 resume=resume, incremental=shard['payload']['incremental'],
+                                                 shard=shard['shard_id'], rate_limiter=self.rate_limiter,
+                                                 metrics_format=shard['payload'].get('metrics_format', 'jsonl'),
+                                                 extraction_backend=shard['payload'].get('extraction_backend',
+                                                                                         'html2text'))
+        self.crawl_queue.complete(shard['shard_id'], {'raw_path': therapist_directory.raw_path})
+
+    def merge(self, shard):
+        profile_shards = self.crawl_queue.get_results(shard['state'], 'profiles')
+        raw_paths = [result['raw_path'] for result in profile_shards.values() if os.path.exists(result['raw_path'])]
+        directory_path = TherapistDirectory.merge_shards(shard['state'], raw_paths)
+        self.crawl_queue.complete(shard['shard_id'], {'directory_path': directory_path})
+
+        # the shards are in the directory now
+        for raw_path in raw_paths:
+            os.remove(raw_path)
+        for shard_id in profile_shards:
+            db_path = CrawlStateStore.get_db_path(shard['state'], shard_id)
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+
+# join a running multi-state crawl from another machine. run from src/ (same as main.py), w/ scraped_data shared:
+#   python orchestrator.py worker --queue ../scraped_data/crawl_queue.sqlite
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a crawl worker against a shared crawl queue')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='claim shards until the queue is finished')
+    worker_parser.add_argument('--queue', default=CrawlQueue.get_db_path())
+    worker_parser.add_argument('--worker-id')
+    worker_parser.add_argument('--parse-processes', type=int, default=1)
+    args = parser.parse_args()
+
+    # same log as main.py, appended to: the crawl this worker joins can be writing to it too
+    logging.basicConfig(filename='../check_performance.log', filemode='a', encoding='utf-8', level=logging.INFO,
+                        format='%(asctime)s - %(name)s- %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    CrawlWorker(args.queue, args.worker_id, args.parse_processes).run()
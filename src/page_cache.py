@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class PageCache:
+    """
+    Parameters:
+    - cache_dir (str): directory for the cache, one per state (see get_cache_dir)
+    - max_bytes (int): size limit for the compressed pages. once it's passed, the pages stored longest ago are
+        evicted first. the size is re-read from index.sqlite on every store, so it counts what every process
+        sharing the cache has stored
+
+    Every fetched page is kept on disk so a parser fix can be applied by re-parsing (TherapistDirectory.reparse)
+    instead of re-crawling for days. Pages are content-addressed: the gzipped raw HTML and its html2text output
+    are stored under the SHA-256 of the HTML (objects/ab/abcd....html.gz / .txt.gz), so identical pages are only
+    stored once. index.sqlite maps each therapist URL to its current page, along with the ETag / Last-Modified the
+    server sent for it and the record it parsed to, so an incremental crawl can send conditional requests and reuse
+    the record when the page hasn't changed (TherapistDirectory(..., incremental=True))
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir, self.max_bytes = cache_dir, max_bytes
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        # several crawl workers can share a state's cache (see CrawlOrchestrator), so wait out their writes
+        self.connection = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    therapist_url TEXT PRIMARY KEY,
+                    therapist_gender TEXT,
+                    content_hash TEXT NOT NULL,
+                    stored_at REAL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    record BLOB
+                )''')
+            # caches written before validators / records were kept
+            columns = {row[1] for row in self.connection.execute('PRAGMA table_info(pages)')}
+            for column, column_type in [('etag', 'TEXT'), ('last_modified', 'TEXT'), ('record', 'BLOB')]:
+                if column not in columns:
+                    self.connection.execute(f'ALTER TABLE pages ADD COLUMN {column} {column_type}')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pages_stored_at ON pages (stored_at)')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    content_hash TEXT PRIMARY KEY,
+                    size_bytes INTEGER NOT NULL
+                )''')
+        self.total_bytes = self.get_total_bytes()
+
+    def get_total_bytes(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM objects').fetchone()[0]
+
+    @staticmethod
+    def get_cache_dir(state):
+        return f'../scraped_data/{state}_page_cache'
+
+    @staticmethod
+    def get_content_hash(page_html):
+        return hashlib.sha256(page_html.encode('utf-8')).hexdigest()
+
+    def get_object_path(self, content_hash, kind):
+        # kind is 'html' or 'txt'
+        return os.path.join(self.cache_dir, 'objects', content_hash[:2], f'{content_hash}.{kind}.gz')
+
+    def store(self, therapist_url, therapist_gender, page_html, page_text=None, etag=None, last_modified=None,
+              record=None):
+        # record is the parsed therapist record, only kept if it's a real one (program failures get parsed again)
+        content_hash = self.get_content_hash(page_html)
+        if record is not None and record['therapist_name'] != 'program failure':
+            record = pickle.dumps(record)  # keeps sets as sets, so a reused record is written out exactly the same
+        else:
+            record = None
+        with self.lock:
+            size_bytes = self.write_object(content_hash, 'html', page_html)
+            if page_text is not None:
+                size_bytes += self.write_object(content_hash, 'txt', page_text)
+            with self.connection:
+                old_hash = self.connection.execute('SELECT content_hash FROM pages WHERE therapist_url = ?',
+                                                   (therapist_url,)).fetchone()
+                self.connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (therapist_url, therapist_gender, content_hash, time.time(), etag,
+                                         last_modified, record))
+                if size_bytes:
+                    self.connection.execute('INSERT INTO objects VALUES (?, ?) ON CONFLICT (content_hash) DO UPDATE '
+                                            'SET size_bytes = size_bytes + excluded.size_bytes',
+                                            (content_hash, size_bytes))
+                if old_hash and old_hash[0] != content_hash:  # the profile changed, drop the old page if unused
+                    self.delete_unreferenced(old_hash[0])
+                # other processes store to / evict from the same cache, so their pages count too. read while this
+                # transaction still holds the write lock
+                self.total_bytes = self.get_total_bytes()
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+        return content_hash
+
+    def write_object(self, content_hash, kind, content):
+        # returns the bytes written, 0 if the object is already there (same page stored before)
+        object_path = self.get_object_path(content_hash, kind)
+        if os.path.exists(object_path):
+            return 0
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        compressed = gzip.compress(content.encode('utf-8'))
+        temp_path = f'{object_path}.{os.getpid()}.tmp'  # another process can be writing the same page
+        with open(temp_path, 'wb') as file:
+            file.write(compressed)
+        os.replace(temp_path, object_path)  # a crash mid-write never leaves a truncated object behind
+        return len(compressed)
+
+    def read_object(self, content_hash, kind):
+        object_path = self.get_object_path(content_hash, kind)
+        if not os.path.exists(object_path):
+            return None
+        with open(object_path, 'rb') as file:
+            return gzip.decompress(file.read()).decode('utf-8')
+
+    def get(self, therapist_url):
+        # {'gender', 'html', 'text', 'etag', 'last_modified'} for a cached page (text / validators can be None), or
+        # None if the page isn't cached
+        with self.lock:
+            row = self.connection.execute('SELECT therapist_gender, content_hash, etag, last_modified FROM pages '
+                                          'WHERE therapist_url = ?', (therapist_url,)).fetchone()
+        if row is None:
+            return None
+        return {'gender': row[0], 'html': self.read_object(row[1], 'html'), 'text': self.read_object(row[1], 'txt'),
+                'etag': row[2], 'last_modified': row[3]}
+
+    def get_record(self, therapist_url, content_hash):
+        # the record parsed from this exact page last time, or None if the page is new / changed
+        with self.lock:
+            row = self.connection.execute('SELECT record FROM pages WHERE therapist_url = ? AND content_hash = ?',
+                                          (therapist_url, content_hash)).fetchone()
+        return pickle.loads(row[0]) if row and row[0] is not None else None
+
+    def get_validators(self, therapist_url):
+        # conditional request headers for a page we have a record for. {} means fetch it normally
+        with self.lock:
+            row = self.connection.execute('SELECT etag, last_modified FROM pages '
+                                          'WHERE therapist_url = ? AND record IS NOT NULL', (therapist_url,)).fetchone()
+            if row is None:
+                return {}
+            with self.connection:  # newest page now, so it isn't evicted before a 304 for it comes back
+                self.connection.execute('UPDATE pages SET stored_at = ? WHERE therapist_url = ?',
+                                        (time.time(), therapist_url))
+        headers = {'If-None-Match': row[0], 'If-Modified-Since': row[1]}
+        return {header: val for header, val in headers.items() if val}
+
+    def iter_pages(self):
+        # (url, gender, html, text) for every cached page. reads one page at a time
+        rows = self.connection.execute('SELECT therapist_url, therapist_gender, content_hash FROM pages '
+                                       'ORDER BY stored_at').fetchall()
+        for therapist_url, therapist_gender, content_hash in rows:
+            page_html = self.read_object(content_hash, 'html')
+            if page_html is not None:
+                yield therapist_url, therapist_gender, page_html, self.read_object(content_hash, 'txt')
+
+    def get_page_count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def evict(self):
+        # oldest pages go first until the cache is back under 90% of max_bytes, so we don't evict on every store
+        target_bytes = self.max_bytes * 0.9
+        oldest = self.connection.execute('SELECT therapist_url, content_hash FROM pages ORDER BY stored_at').fetchall()
+        with self.connection:
+            for therapist_url, content_hash in oldest:
+                if self.total_bytes <= target_bytes:
+                    break
+                self.connection.execute('DELETE FROM pages WHERE therapist_url = ?', (therapist_url,))
+                self.delete_unreferenced(content_hash)
+
+    def delete_unreferenced(self, content_hash):
+        if self.connection.execute('SELECT 1 FROM pages WHERE content_hash = ? LIMIT 1', (content_hash,)).fetchone():
+            return
+        row = self.connection.execute('SELECT size_bytes FROM objects WHERE content_hash = ?',
+                                      (content_hash,)).fetchone()
+        self.connection.execute('DELETE FROM objects WHERE content_hash = ?', (content_hash,))
+        self.total_bytes -= row[0] if row else 0
+        for kind in ('html', 'txt'):
+            object_path = self.get_object_path(content_hash, kind)
+            if os.path.exists(object_path):
+                os.remove(object_path)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,193 @@
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+
+class PipelineMetrics:
+    """
+    Parameters:
+    - bucket_bounds (list): upper bounds (seconds) of the histogram buckets, ascending. anything longer than the
+        last one goes in a final +Inf bucket
+
+    Where a crawl's time goes, by stage: each stage ('fetch', 'rate_limit_wait', 'html_to_text',
+    'extract address', ...) has a fixed bucket histogram of how long it took (count, sum and a count per bucket,
+    so recording is a bisect and two adds, nothing is kept per observation). Counters are for events (requests,
+    retries, 304s). One instance per process (get_metrics); stages that run in ExtractionPool workers are sent back
+    with each page (drain / merge), so the crawl's own instance sees every stage
+
+    MetricsExporter writes it out periodically as JSON lines or a Prometheus textfile
+    """
+    # 100us to ~14 min, doubling
+    default_bucket_bounds = [0.0001 * 2 ** i for i in range(24)]
+    metrics = None  # the process' instance, see get_metrics
+
+    def __init__(self, bucket_bounds=None):
+        self.bucket_bounds = bucket_bounds or self.default_bucket_bounds
+        self.histograms, self.counters = {}, Counter()  # stage -> {'count', 'sum', 'buckets'}
+        self.lock = threading.Lock()  # parse threads, the fetch loop and the exporter all touch it
+
+    @classmethod
+    def get_metrics(cls):
+        if cls.metrics is None:
+            cls.metrics = cls()
+        return cls.metrics
+
+    @classmethod
+    def reset_metrics(cls):
+        # fresh instance for a new (forked) process
+        cls.metrics = None
+
+    def observe(self, stage, seconds):
+        bucket = bisect_left(self.bucket_bounds, seconds)
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = {'count': 0, 'sum': 0.0,
+                                                      'buckets': [0] * (len(self.bucket_bounds) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['buckets'][bucket] += 1
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        # plain dict copy: {'histograms': {stage: {'count', 'sum', 'buckets'}}, 'counters': {counter: n}}
+        with self.lock:
+            return {'histograms': {stage: dict(histogram, buckets=list(histogram['buckets']))
+                                   for stage, histogram in self.histograms.items()},
+                    'counters': dict(self.counters)}
+
+    def drain(self):
+        # snapshot + reset in one step. what a worker process hands back with each page (see merge)
+        with self.lock:
+            drained = {'histograms': self.histograms, 'counters': dict(self.counters)}
+            self.histograms, self.counters = {}, Counter()
+        return drained
+
+    def merge(self, other):
+        # add another instance's snapshot / drain (same bucket_bounds) into this one
+        with self.lock:
+            for stage, other_histogram in other['histograms'].items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    self.histograms[stage] = dict(other_histogram, buckets=list(other_histogram['buckets']))
+                    continue
+                histogram['count'] += other_histogram['count']
+                histogram['sum'] += other_histogram['sum']
+                histogram['buckets'] = [count + other_count for count, other_count
+                                        in zip(histogram['buckets'], other_histogram['buckets'])]
+            self.counters.update(other['counters'])
+
+    def get_quantile(self, stage, quantile):
+        # upper bound of the bucket the quantile falls in (so within 2x), None if the stage never ran
+        histogram = self.histograms.get(stage)
+        if not histogram or not histogram['count']:
+            return None
+        rank, seen = quantile * histogram['count'], 0
+        for bound, count in zip(self.bucket_bounds + [float('inf')], histogram['buckets']):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def log_summary(self):
+        # one line per stage, slowest total first
+        snapshot = self.snapshot()
+        for stage, histogram in sorted(snapshot['histograms'].items(), key=lambda item: -item[1]['sum']):
+            logging.info(f'$|$ Function: Pipeline Metrics | Stage: {stage} | Count: {histogram["count"]} | '
+                         f'Total: {histogram["sum"]:.2f}s | Mean: {histogram["sum"] / histogram["count"]:.4f}s | '
+                         f'p95: <= {self.get_quantile(stage, 0.95):.4f}s')
+        logging.info(f'$|$ Function: Pipeline Metrics | Counters: {snapshot["counters"]}')
+
+    def to_json_line(self, labels=None):
+        return json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'), **(labels or {}),
+                           'bucket_bounds': self.bucket_bounds, **self.snapshot()})
+
+    def to_prometheus(self, labels=None):
+        # text exposition format: one histogram metric labelled by stage, one counter labelled by event
+        snapshot = self.snapshot()
+        base_labels = ''.join(f'{key}="{val}",' for key, val in (labels or {}).items())
+        lines = ['# HELP therapist_scraper_stage_seconds Time spent in each pipeline stage',
+                 '# TYPE therapist_scraper_stage_seconds histogram']
+        for stage, histogram in sorted(snapshot['histograms'].items()):
+            stage_labels = f'{base_labels}stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(self.bucket_bounds + [float('inf')], histogram['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'therapist_scraper_stage_seconds_bucket{{{stage_labels},le="{le}"}} {cumulative}')
+            lines.append(f'therapist_scraper_stage_seconds_sum{{{stage_labels}}} {histogram["sum"]}')
+            lines.append(f'therapist_scraper_stage_seconds_count{{{stage_labels}}} {histogram["count"]}')
+        lines += ['# HELP therapist_scraper_events_total Pipeline events (requests, retries, 304s, ...)',
+                  '# TYPE therapist_scraper_events_total counter']
+        for counter, count in sorted(snapshot['counters'].items()):
+            lines.append(f'therapist_scraper_events_total{{{base_labels}event="{counter}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Parameters:
+    - path (str): file to export to. JSON lines are appended, a Prometheus textfile is replaced each time (point
+        node_exporter's textfile collector at its directory, name it *.prom)
+    - file_format (str): 'jsonl' or 'prometheus'
+    - interval (float): seconds between exports
+    - labels (dict): added to every export, e.g. {'state': 'north-carolina'}
+    - metrics (PipelineMetrics): defaults to the process' instance
+
+    Exports the metrics every interval seconds from a background thread while a crawl runs, and once more on the
+    way out. Use as a context manager
+    """
+    def __init__(self, path, file_format='jsonl', interval=60, labels=None, metrics=None):
+        if file_format not in ('jsonl', 'prometheus'):
+            raise ValueError(f'unsupported metrics format: {file_format}')
+        self.path, self.file_format, self.interval, self.labels = path, file_format, interval, labels
+        self.metrics = metrics or PipelineMetrics.get_metrics()
+        self.stop_event, self.thread = threading.Event(), None
+
+    @staticmethod
+    def get_metrics_path(state, unique_id, file_format):
+        # one file per run (shards of a multi-state crawl each have their own)
+        extension = 'prom' if file_format == 'prometheus' else 'jsonl'
+        return f'../scraped_data/{state}_metrics_{datetime.datetime.now().date()}_{unique_id}.{extension}'
+
+    def __enter__(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+        self.export()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.export()
+
+    def export(self):
+        if self.file_format == 'jsonl':
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(self.metrics.to_json_line(self.labels) + '\n')
+        else:  # written whole then swapped in, so the collector never reads half a file
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                file.write(self.metrics.to_prometheus(self.labels))
+            os.replace(temp_path, self.path)
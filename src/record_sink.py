@@ -0,0 +1,96 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import threading
+
+
+class RecordSink:
+    """
+    Parameters:
+    - path (str): file the records are written to. it's replaced if it already exists
+    - columns (list): column order, normally DirectoryBuilder.get_therapist_profile_cols()
+    - batch_size (int): records buffered in memory before they're flushed to disk
+    - file_format (str): 'csv' or 'parquet'
+    - append (boolean): keep what's already in the file and add to it (csv only). used when resuming a crawl
+    - on_flush (callable): called with each batch of records once it's on disk (e.g. to mark them done in the
+        CrawlStateStore)
+
+    Append-only sink for therapist records (plain dicts). Records are buffered and written out batch_size at a time
+    while the crawl runs, so memory stays flat and progress is on disk instead of only at the end. Values are
+    written the same way DataFrame.to_csv always wrote them (sets become "{'a', 'b'}"). Use as a context manager;
+    add() is safe to call from several threads
+    """
+    def __init__(self, path, columns, batch_size=500, file_format='csv', append=False, on_flush=None):
+        if file_format not in ('csv', 'parquet'):
+            raise ValueError(f'unsupported file format: {file_format}')
+        if append and file_format != 'csv':
+            raise ValueError('only csv record files can be appended to')
+        self.path, self.columns, self.batch_size, self.file_format = path, columns, batch_size, file_format
+        self.on_flush = on_flush
+        self.buffer, self.records_written = [], 0
+        self.lock = threading.Lock()
+        self.parquet_writer = None
+        self.header_written = append and os.path.exists(path)
+        if os.path.exists(path) and not append:
+            os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, record):
+        with self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch_df = pd.DataFrame(self.buffer, columns=self.columns)
+        if self.file_format == 'csv':
+            batch_df.to_csv(self.path, mode='a', index=False, header=not self.header_written)
+        else:
+            self.write_parquet_batch(batch_df)
+        self.header_written = True
+        self.records_written += len(self.buffer)
+        batch, self.buffer = self.buffer, []
+        if self.on_flush:
+            self.on_flush(batch)
+
+    def write_parquet_batch(self, batch_df):
+        # every column as a string, same as the CSV, so each batch has the same schema
+        table = pa.Table.from_pandas(batch_df.fillna('N/A').astype(str), preserve_index=False,
+                                     schema=pa.schema([(col, pa.string()) for col in self.columns]))
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        with self.lock:
+            if not self.header_written and not self.buffer:  # nothing came through, still leave a readable file
+                self.write_header_only()
+            self.flush()
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+                self.parquet_writer = None
+
+    def write_header_only(self):
+        empty_df = pd.DataFrame(columns=self.columns)
+        if self.file_format == 'csv':
+            empty_df.to_csv(self.path, index=False, header=True)
+        else:
+            self.write_parquet_batch(empty_df)
+        self.header_written = True
+
+    @staticmethod
+    def read_chunks(path, chunksize=10000, columns=None):
+        # read a sink file back chunksize rows at a time. everything comes back as strings ('N/A' stays 'N/A')
+        if path.endswith('.parquet'):
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(path, chunksize=chunksize, usecols=columns, dtype=str, keep_default_na=False)
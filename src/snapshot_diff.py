@@ -0,0 +1,256 @@
+from compact_directory import CompactDirectory
+from record_sink import RecordSink
+import argparse
+import ast
+import gzip
+import json
+import logging
+import math
+import os
+import pandas as pd
+import tempfile
+import time
+
+
+class SnapshotDiff:
+    """
+    Parameters:
+    - key (str): column rows are matched on. None == 'therapist_url' for a directory CSV, 'URL' for a URL list
+    - chunksize (int): rows read at a time
+    - partition_bytes (int): roughly how much of each snapshot is held in memory at once (see diff)
+
+    Changelog between two dated snapshots of the same file in scraped_data/ (a state's therapist URL list or
+    directory CSV): which therapists were added, removed, and for the ones in both, which fields changed. Rows are
+    matched on key and compared by a hash of the rest of the row; the multi-valued fields ("{'a', 'b'}" strings
+    whose order changes from run to run) are hashed in sorted order, so a reshuffled set isn't a change
+
+    apply rebuilds the newer snapshot from the older one + the changelog, so only the first snapshot and a
+    changelog per crawl need to be kept instead of a full copy per day
+
+    Changelog format, JSON lines (gzipped if the path ends in .gz):
+    - {"type": "header", "key": ..., "columns": [...], "base": ..., "new": ...}
+    - {"op": "add", "key": ..., "hash": ..., "row": {column: value}}
+    - {"op": "remove", "key": ..., "base_hash": ...}
+    - {"op": "change", "key": ..., "base_hash": ..., "hash": ..., "fields": {column: new value}}
+    - {"type": "summary", "base_rows": ..., "new_rows": ..., "added": ..., "removed": ..., "changed": ...,
+      "unchanged": ...}
+    """
+    key_cols = ['therapist_url', 'URL']  # directory, URL list
+
+    def __init__(self, key=None, chunksize=10000, partition_bytes=64 * 2 ** 20):
+        self.key, self.chunksize, self.partition_bytes = key, chunksize, partition_bytes
+
+    def get_key(self, columns):
+        if self.key:
+            return self.key
+        for key in self.key_cols:
+            if key in columns:
+                return key
+        raise ValueError(f'no key column (one of {self.key_cols}) in {list(columns)}, pass key')
+
+    @staticmethod
+    def get_columns(path):
+        return list(pd.read_csv(path, nrows=0).columns)
+
+    @staticmethod
+    def open_changelog(path, mode):
+        return gzip.open(path, f'{mode}t', encoding='utf-8') if path.endswith('.gz') else \
+            open(path, mode, encoding='utf-8')
+
+    @staticmethod
+    def get_row_hashes(snapshot_df, key):
+        # hex hash of each row's values (everything but key). set fields are put in sorted order first
+        value_df = snapshot_df.drop(columns=[key])
+        for col in set(CompactDirectory.multi_valued_cols) & set(value_df.columns):
+            codes, uniques = pd.factorize(value_df[col])
+            canonical = pd.Index([SnapshotDiff.sort_set(val) for val in uniques], dtype=object)
+            value_df[col] = canonical.take(codes) if len(codes) else value_df[col]
+        return pd.util.hash_pandas_object(value_df, index=False).map('{:016x}'.format)
+
+    @staticmethod
+    def sort_set(val):
+        # "{'b', 'a'}" -> "{'a', 'b'}". anything else ('N/A') is left alone
+        if not val.startswith('{'):
+            return val
+        return '{' + ', '.join(repr(item) for item in sorted(ast.literal_eval(val))) + '}'
+
+    def diff(self, base_path, new_path, changelog_path):
+        """
+        Parameters:
+        - base_path (str): older snapshot CSV
+        - new_path (str): newer snapshot CSV, same columns
+        - changelog_path (str): where the changelog goes (.jsonl, or .jsonl.gz to compress it)
+
+        Both snapshots are split into partitions by a hash of the key (streamed, chunksize rows at a time, into
+        temp files next to the changelog), so a therapist lands in the same partition of both. Each pair of
+        partitions is then small enough to compare in memory, one pair at a time. Returns the summary counts
+        """
+        program_start = time.time()
+        columns = self.get_columns(base_path)
+        if self.get_columns(new_path) != columns:
+            raise ValueError(f'{base_path} and {new_path} have different columns, nothing to diff them on')
+        key = self.get_key(columns)
+        partitions = max(1, math.ceil(max(os.path.getsize(base_path), os.path.getsize(new_path)) /
+                                      self.partition_bytes))
+
+        summary = {'type': 'summary', 'base_rows': 0, 'new_rows': 0, 'added': 0, 'removed': 0, 'changed': 0,
+                   'unchanged': 0}
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(changelog_path))) as temp_dir, \
+                self.open_changelog(changelog_path, 'w') as changelog:
+            summary['base_rows'] = self.partition(base_path, key, partitions, os.path.join(temp_dir, 'base'))
+            summary['new_rows'] = self.partition(new_path, key, partitions, os.path.join(temp_dir, 'new'))
+            changelog.write(json.dumps({'type': 'header', 'key': key, 'columns': columns,
+                                        'base': os.path.basename(base_path), 'new': os.path.basename(new_path)}) + '\n')
+            for partition in range(partitions):
+                base_df = self.read_partition(os.path.join(temp_dir, 'base'), partition, columns, key)
+                new_df = self.read_partition(os.path.join(temp_dir, 'new'), partition, columns, key)
+                for change in self.diff_partition(base_df, new_df, key):
+                    summary[{'add': 'added', 'remove': 'removed', 'change': 'changed'}[change['op']]] += 1
+                    changelog.write(json.dumps(change) + '\n')
+            summary['unchanged'] = summary['base_rows'] - summary['removed'] - summary['changed']
+            changelog.write(json.dumps(summary) + '\n')
+
+        logging.info(f'$|$ Function: Snapshot Diff | Base: {base_path} | New: {new_path} | '
+                     f'Time: {time.time() - program_start} | '
+                     f'Added: {summary["added"]} | Removed: {summary["removed"]} | Changed: {summary["changed"]} | '
+                     f'Unchanged: {summary["unchanged"]}')
+        return summary
+
+    def partition(self, path, key, partitions, prefix):
+        # path -> {prefix}_{n}.csv by key hash. returns the number of rows
+        rows = 0
+        for chunk in RecordSink.read_chunks(path, self.chunksize):
+            rows += chunk.shape[0]
+            chunk_partitions = pd.util.hash_pandas_object(chunk[key], index=False) % partitions
+            for partition, partition_df in chunk.groupby(chunk_partitions.to_numpy()):
+                partition_path = f'{prefix}_{partition}.csv'
+                partition_df.to_csv(partition_path, mode='a', index=False, header=not os.path.exists(partition_path))
+        return rows
+
+    @staticmethod
+    def read_partition(prefix, partition, columns, key):
+        partition_path = f'{prefix}_{partition}.csv'
+        if not os.path.exists(partition_path):
+            return pd.DataFrame(columns=columns, dtype=str).set_index(key, drop=False)
+        partition_df = pd.read_csv(partition_path, dtype=str, keep_default_na=False)
+        duplicated = partition_df[key].duplicated()
+        if duplicated.any():  # every copy of a key is in the same partition, so this catches all of them
+            raise ValueError(f'{key} {partition_df[key][duplicated].iloc[0]!r} is in a snapshot more than once')
+        return partition_df.set_index(key, drop=False)
+
+    def diff_partition(self, base_df, new_df, key):
+        # changelog entries for one partition: adds (in new's order), removes, then changes
+        base_hashes, new_hashes = self.get_row_hashes(base_df, key), self.get_row_hashes(new_df, key)
+        added = new_df.index.difference(base_df.index, sort=False)
+        removed = base_df.index.difference(new_df.index, sort=False)
+        both = base_df.index.intersection(new_df.index, sort=False)
+        changed = both[base_hashes[both].to_numpy() != new_hashes[both].to_numpy()]
+
+        for url in added:
+            yield {'op': 'add', 'key': url, 'hash': new_hashes[url], 'row': new_df.loc[url].to_dict()}
+        for url in removed:
+            yield {'op': 'remove', 'key': url, 'base_hash': base_hashes[url]}
+        if len(changed):
+            base_changed, new_changed = base_df.loc[changed], new_df.loc[changed]
+            value_cols = [col for col in base_df.columns if col != key]
+            differs = base_changed[value_cols].to_numpy() != new_changed[value_cols].to_numpy()
+            for i, url in enumerate(changed):
+                # the hash ignores set order but the fields don't, so a real change carries the reshuffles w/ it
+                yield {'op': 'change', 'key': url, 'base_hash': base_hashes[url], 'hash': new_hashes[url],
+                       'fields': {col: new_changed[col].iloc[i] for col, col_differs in zip(value_cols, differs[i])
+                                  if col_differs}}
+
+    def apply(self, base_path, changelog_path, output_path):
+        """
+        Parameters:
+        - base_path (str): the snapshot the changelog was made from (its base)
+        - changelog_path (str): changelog from diff
+        - output_path (str): where the rebuilt snapshot goes
+
+        Streams the base through chunksize rows at a time: removed rows are dropped, changed rows get their new
+        fields, then the added rows go at the end. Only the changelog is held in memory. Every removed / changed row
+        has to hash the same as it did when the changelog was made and come out w/ the hash the newer snapshot had,
+        or this raises ValueError (wrong base, or the base was edited since). Returns output_path
+        """
+        header, summary, removes, changes, adds = None, None, {}, {}, []
+        with self.open_changelog(changelog_path, 'r') as changelog:
+            for line in changelog:
+                entry = json.loads(line)
+                if entry.get('type') == 'header':
+                    header = entry
+                elif entry.get('type') == 'summary':
+                    summary = entry
+                elif entry['op'] == 'remove':
+                    removes[entry['key']] = entry
+                elif entry['op'] == 'change':
+                    changes[entry['key']] = entry
+                else:
+                    adds.append(entry)
+        if header is None or summary is None:
+            raise ValueError(f'{changelog_path} is not a complete changelog')
+        key, columns = header['key'], header['columns']
+        if self.get_columns(base_path) != columns:
+            raise ValueError(f'{base_path} does not have the columns {changelog_path} was made from')
+
+        base_rows, found = 0, 0
+        with open(output_path, 'w', encoding='utf-8', newline='') as output:
+            pd.DataFrame(columns=columns).to_csv(output, index=False)
+            for chunk in RecordSink.read_chunks(base_path, self.chunksize):
+                base_rows += chunk.shape[0]
+                touched = chunk[chunk[key].isin(removes) | chunk[key].isin(changes)]
+                if not touched.empty:
+                    found += touched.shape[0]
+                    self.check_hashes(touched, key, {url: (removes.get(url) or changes[url])['base_hash']
+                                                     for url in touched[key]}, base_path)
+                    chunk = chunk[~chunk[key].isin(removes)].set_index(key, drop=False)
+                    changed_urls = [url for url in touched[key] if url in changes]
+                    for url in changed_urls:
+                        for col, val in changes[url]['fields'].items():
+                            chunk.at[url, col] = val
+                    self.check_hashes(chunk.loc[changed_urls], key,
+                                      {url: changes[url]['hash'] for url in changed_urls}, changelog_path)
+                chunk.to_csv(output, index=False, header=False)
+            if adds:
+                added_df = pd.DataFrame([entry['row'] for entry in adds], columns=columns)
+                self.check_hashes(added_df, key, {entry['key']: entry['hash'] for entry in adds}, changelog_path)
+                added_df.to_csv(output, index=False, header=False)
+
+        if base_rows != summary['base_rows'] or found != len(removes) + len(changes):
+            raise ValueError(f'{base_path} is not the base {changelog_path} was made from ({base_rows} rows, '
+                             f'{found} of {len(removes) + len(changes)} removed / changed rows found)')
+        logging.info(f'$|$ Function: Snapshot Apply | Base: {base_path} | Changelog: {changelog_path} | '
+                     f'Added: {len(adds)} | Removed: {len(removes)} | Changed: {len(changes)} | Output: {output_path}')
+        return output_path
+
+    def check_hashes(self, snapshot_df, key, expected_hashes, source):
+        row_hashes = self.get_row_hashes(snapshot_df.reset_index(drop=True), key)
+        for url, row_hash in zip(snapshot_df[key], row_hashes):
+            if expected_hashes[url] != row_hash:
+                raise ValueError(f'{url} in {source} does not match the changelog (hash {row_hash}, changelog has '
+                                 f'{expected_hashes[url]})')
+
+
+# diff two dated snapshots / rebuild one from a changelog. run from src/ (same as main.py), e.g.
+#   python snapshot_diff.py diff ../scraped_data/north-carolina_therapist_urls_2024-02-02.csv
+#       ../scraped_data/north-carolina_therapist_urls_2024-05-17.csv ../scraped_data/nc_urls_2024-05-17.jsonl.gz
+#   python snapshot_diff.py apply ../scraped_data/north-carolina_therapist_urls_2024-02-02.csv
+#       ../scraped_data/nc_urls_2024-05-17.jsonl.gz nc_urls_2024-05-17.csv
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diff two snapshots, or apply a changelog to a snapshot')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    diff_parser = subparsers.add_parser('diff', help='changelog of what changed between two snapshots')
+    diff_parser.add_argument('base_path')
+    diff_parser.add_argument('new_path')
+    diff_parser.add_argument('changelog_path', help='.jsonl, or .jsonl.gz to compress it')
+    apply_parser = subparsers.add_parser('apply', help='rebuild the newer snapshot from the base + a changelog')
+    apply_parser.add_argument('base_path')
+    apply_parser.add_argument('changelog_path')
+    apply_parser.add_argument('output_path')
+    for subparser in (diff_parser, apply_parser):
+        subparser.add_argument('--key', help='column to match rows on (default: therapist_url / URL)')
+    args = parser.parse_args()
+
+    if args.command == 'diff':
+        print(SnapshotDiff(args.key).diff(args.base_path, args.new_path, args.changelog_path))
+    else:
+        SnapshotDiff(args.key).apply(args.base_path, args.changelog_path, args.output_path)
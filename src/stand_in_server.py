@@ -0,0 +1,148 @@
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import hashlib
+import random
+import threading
+import time
+
+
+class StandInServer:
+    """
+    Parameters:
+    - pages (dict): path -> html body served with a 200, e.g. {'/us/therapists/jane-doe-raleigh-nc/123': '<html>...'}
+        anything not in pages gets a 404 (same as a removed profile)
+    - send_validators (boolean): send an ETag / Last-Modified with every 200 and answer matching conditional
+        requests with a 304, so incremental crawls can be checked. pages can be changed between crawls
+    - latency (float): average seconds before each response is sent, jittered between half and 1.5x
+    - error_rate (float): share of requests answered with a 503 instead of the page
+    - throttle_rate (float): share of requests answered with a 429 (+ Retry-After) instead of the page
+    - max_requests_per_second (float): rate limit enforced like the real site's: requests over it get a 429 w/ a
+        Retry-After. a token bucket w/ room for rate_limit_burst requests, so a client spacing requests exactly
+        1/rate apart isn't punished for a few ms of jitter
+    - rate_limit_burst (int): see max_requests_per_second
+    - seed (int): seed for the simulated errors / 429s / latency, so benchmark runs see the same failures
+
+    Local stand-in for psychology today so the fetch pipeline can be exercised without making live requests.
+    Runs on a background thread; use as a context manager and build URLs with url(path).
+    request_log keeps (monotonic time, path) for every request so the request rate can be checked, status_counts
+    the number of responses sent per status code. start_outage makes it answer everything w/ a 503 for a while,
+    like a site that's down
+    """
+    def __init__(self, pages, host='127.0.0.1', port=0, send_validators=False, latency=0, error_rate=0,
+                 throttle_rate=0, max_requests_per_second=None, rate_limit_burst=2, seed=None):
+        self.pages, self.send_validators = pages, send_validators
+        self.latency, self.error_rate, self.throttle_rate = latency, error_rate, throttle_rate
+        self.max_requests_per_second, self.rate_limit_burst = max_requests_per_second, rate_limit_burst
+        self.random, self.lock = random.Random(seed), threading.Lock()  # handler threads share them
+        self.rate_limit_tokens, self.rate_limit_refill = rate_limit_burst, time.monotonic()
+        self.rate_limited = 0  # 429s for going over max_requests_per_second (not the random throttle_rate ones)
+        self.outage_until = 0  # see start_outage
+        self.request_log = []
+        self.status_counts = collections.Counter()
+        self.first_served = {}  # etag -> time that version of a page was first served, for Last-Modified
+        self.server = ThreadingHTTPServer((host, port), self.build_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{path}'
+
+    def build_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so pooled sessions actually reuse connections
+
+            def do_GET(self):
+                stand_in.request_log.append((time.monotonic(), self.path))
+                injected_failure, latency = stand_in.get_injected_failure()
+                if latency:
+                    time.sleep(latency)
+                if injected_failure:
+                    status, body, headers = injected_failure
+                    stand_in.status_counts[status] += 1
+                    self.send_body(status, body, headers)
+                    return
+                status, body = stand_in.respond(self.path)
+                validators = {}
+                if status == 200 and stand_in.send_validators:
+                    validators = stand_in.get_validators(body)
+                    if stand_in.is_not_modified(self.headers, validators):
+                        status, body = 304, ''
+                stand_in.status_counts[status] += 1
+                self.send_body(status, body, validators)
+
+            def send_body(self, status, body, headers=None):
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for header, val in (headers or {}).items():
+                    self.send_header(header, val)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # keep the console quiet
+                pass
+
+        return Handler
+
+    def respond(self, path):
+        if path in self.pages:
+            return 200, self.pages[path]
+        return 404, '<html><body>Page not found</body></html>'
+
+    def start_outage(self, seconds):
+        # every request gets a 503 for the next seconds
+        self.outage_until = time.monotonic() + seconds
+
+    def get_injected_failure(self):
+        # ((status, body, headers) of a simulated failure or None to serve the page, seconds to wait before answering)
+        with self.lock:
+            latency = self.latency * self.random.uniform(0.5, 1.5) if self.latency else 0
+            if time.monotonic() < self.outage_until:
+                return (503, 'Service Unavailable', {}), latency
+            if self.max_requests_per_second:
+                now = time.monotonic()
+                self.rate_limit_tokens = min(self.rate_limit_burst, self.rate_limit_tokens +
+                                             (now - self.rate_limit_refill) * self.max_requests_per_second)
+                self.rate_limit_refill = now
+                if self.rate_limit_tokens < 1:
+                    self.rate_limited += 1
+                    retry_after = (1 - self.rate_limit_tokens) / self.max_requests_per_second
+                    return (429, 'Too Many Requests', {'Retry-After': str(max(1, round(retry_after)))}), latency
+                self.rate_limit_tokens -= 1
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return (429, 'Too Many Requests', {'Retry-After': '1'}), latency
+        if roll < self.throttle_rate + self.error_rate:
+            return (503, 'Service Unavailable', {}), latency
+        return None, latency
+
+    def get_validators(self, body):
+        etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:16]}"'
+        last_modified = self.first_served.setdefault(etag, time.time())
+        return {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True)}
+
+    @staticmethod
+    def is_not_modified(request_headers, validators):
+        # If-None-Match wins over If-Modified-Since when both are sent, same as a real server
+        if request_headers.get('If-None-Match'):
+            return validators['ETag'] in [etag.strip() for etag in request_headers['If-None-Match'].split(',')]
+        if request_headers.get('If-Modified-Since'):
+            try:
+                return (parsedate_to_datetime(validators['Last-Modified']) <=
+                        parsedate_to_datetime(request_headers['If-Modified-Since']))
+            except (TypeError, ValueError):
+                return False
+        return False
@@ -1,5 +1,10 @@
+from collections import OrderedDict
+from rapidfuzz import fuzz, process
+from record_sink import RecordSink
 import datetime
+import numpy as np
 import pandas as pd
+import re
 
 
 class DirectoryBuilder:
@@ -7,29 +12,88 @@ class DirectoryBuilder:
 
     @staticmethod
     def clean_therapist_profile_dataframe(therapist_profile_df, state):
-        therapist_profile_df.fillna('N/A', inplace=True)
-        failures = pd.DataFrame()
+        duplicated_urls = set(therapist_profile_df.loc[therapist_profile_df.duplicated(subset='therapist_url'),
+                                                       'therapist_url'])
+        therapist_profile_df, failures = DirectoryBuilder.split_clean_and_failures(therapist_profile_df,
+                                                                                   duplicated_urls)
+        # save the defect rows / failed scrapes to a CSV file for review
+        failures.to_csv(DirectoryBuilder.get_removed_profiles_path(state), index=False, header=True)
+
+        return therapist_profile_df
+
+    @staticmethod
+    def clean_therapist_profile_file(raw_path, state, output_path, chunksize=10000):
+        """
+        Parameters:
+        - raw_path (str): file written by RecordSink during the crawl
+        - output_path (str): where the clean directory CSV goes
+
+        Same cleaning as clean_therapist_profile_dataframe, chunksize rows at a time, so the whole directory is
+        never in memory. Returns the number of clean rows written
+        """
+        # duplicates can be chunks apart, so find them first from the URL column alone
+        therapist_urls = pd.concat(RecordSink.read_chunks(raw_path, chunksize, columns=['therapist_url']),
+                                   ignore_index=True)['therapist_url']
+        duplicated_urls = set(therapist_urls[therapist_urls.duplicated()])
+
+        removed_path, clean_rows, first_chunk = DirectoryBuilder.get_removed_profiles_path(state), 0, True
+        for chunk in RecordSink.read_chunks(raw_path, chunksize):
+            clean_chunk, failures = DirectoryBuilder.split_clean_and_failures(chunk, duplicated_urls)
+            write_mode = 'w' if first_chunk else 'a'
+            clean_chunk.to_csv(output_path, mode=write_mode, index=False, header=first_chunk)
+            failures.to_csv(removed_path, mode=write_mode, index=False, header=first_chunk)
+            clean_rows += clean_chunk.shape[0]
+            first_chunk = False
+        return clean_rows
+
+    @staticmethod
+    def split_clean_and_failures(therapist_profile_df, duplicated_urls):
+        """
+        clean rows and defect rows for one frame (or one chunk). duplicated_urls is every URL seen more than once.
+        each check is a column-wise mask; a defect row is kept once in failures, w/ every check it failed listed in
+        its failure_reason column (e.g. 'duplicate url; failed scrape')
+        """
+        # 'string' == nothing but strings, which is every column of a raw records file. only the rest can have NaN
+        column_types = {col: pd.api.types.infer_dtype(therapist_profile_df[col], skipna=False)
+                        for col in therapist_profile_df.columns}
+        # before the fillna below. the old check ran after filling every NaN w/ 'N/A', so it never caught anything
+        missing_name = therapist_profile_df['therapist_name'].isna().values
+        other_cols = [col for col, column_type in column_types.items() if column_type != 'string']
+        if other_cols:
+            therapist_profile_df = therapist_profile_df.fillna({col: 'N/A' for col in other_cols})
 
         # check for duplicates, program failure rows/failed scrapes, profiles that don't exist, buggy zipcodes
-        mask1 = therapist_profile_df.duplicated(subset='therapist_url', keep=False)
-        mask2 = ~therapist_profile_df.apply(lambda row: 'program failure' in row.values, axis=1)
-        mask3 = therapist_profile_df['therapist_name'].notna()
-        mask4 = therapist_profile_df['zipcode'].str.isdigit() | therapist_profile_df['zipcode'].isna()
-        mask5 = ~therapist_profile_df.apply(lambda row: 'failed scrape' in row.values, axis=1)
-        # compile list of failures
-        failures = pd.concat([failures, therapist_profile_df[mask1]])
-        failures = pd.concat([failures, therapist_profile_df[~mask2]])
-        failures = pd.concat([failures, therapist_profile_df[~mask3]])
-        failures = pd.concat([failures, therapist_profile_df[~mask4]])
-        failures = pd.concat([failures, therapist_profile_df[~mask5]])
+        values = therapist_profile_df.to_numpy()
+        failure_masks = {
+            'duplicate url': therapist_profile_df['therapist_url'].isin(duplicated_urls).values,
+            'program failure': (values == 'program failure').any(axis=1),
+            'missing name': missing_name,
+            'invalid zipcode': ~therapist_profile_df['zipcode'].astype(str).str.isdigit().values,
+            'failed scrape': (values == 'failed scrape').any(axis=1)
+        }
+        failed = np.logical_or.reduce(list(failure_masks.values()))
+
+        # compile list of failures, one row each
+        failures = therapist_profile_df[failed].copy()
+        failure_reason = pd.Series('', index=failures.index)
+        for reason, mask in failure_masks.items():
+            failure_reason += np.where(mask[failed], f'{reason}; ', '')
+        failures['failure_reason'] = failure_reason.str[:-2]
+
         # filter for clean rows, remove leading/trailing spaces
-        therapist_profile_df = therapist_profile_df[~mask1 & mask2 & mask3 & mask4 & mask5]
-        therapist_profile_df = therapist_profile_df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-        # save the defect rows / failed scrapes to a CSV file for review
-        failures.to_csv(f'../scraped_data/{state}_therapist_directory_removed_'
-                        f'{datetime.datetime.now().date()}.csv', index=False, header=True)
+        therapist_profile_df = therapist_profile_df[~failed].copy()
+        string_cols = [col for col, column_type in column_types.items() if column_type == 'string']
+        if string_cols and therapist_profile_df.shape[0]:  # all strings, so one strip over the whole block
+            therapist_profile_df[string_cols] = np.frompyfunc(str.strip, 1, 1)(
+                therapist_profile_df[string_cols].to_numpy())
+        for col in other_cols:  # strings mixed w/ sets, bools etc. only strip the strings
+            if pd.api.types.infer_dtype(therapist_profile_df[col]) in ('string', 'mixed', 'mixed-integer'):
+                therapist_profile_df[col] = therapist_profile_df[col].str.strip().fillna(therapist_profile_df[col])
+        return therapist_profile_df, failures
 
-        return therapist_profile_df
+    @staticmethod
+    def get_removed_profiles_path(state):
+        return f'../scraped_data/{state}_therapist_directory_removed_{datetime.datetime.now().date()}.csv'
 
     @staticmethod
     def get_therapist_profile_cols():
@@ -60,6 +124,11 @@ class DirectoryBuilder:
     @staticmethod
     def failed_scrape_output(therapist_url):
         # when the whole darn scraper fails...we can investigate later. most the time, the profile was removed
+        return pd.DataFrame([DirectoryBuilder.failed_scrape_record(therapist_url)])
+
+    @staticmethod
+    def failed_scrape_record(therapist_url):
+        # same as failed_scrape_output, as a plain dict (what TherapistPageScraper.parse returns)
         failed_scrape_data = {
             'therapist_url': therapist_url,
             'therapist_name': 'program failure',
@@ -83,7 +152,7 @@ class DirectoryBuilder:
             'lgbtq_status': 'program failure',
             'veteran_status': 'program failure'
         }
-        return pd.DataFrame([failed_scrape_data])
+        return failed_scrape_data
 
 
 class TextProcessing:
@@ -91,19 +160,20 @@ class TextProcessing:
 
     @staticmethod
     def get_field_regex_pattern(field):
-        # get the pertinent regex pattern to extract data from the text
+        # get the pertinent regex pattern to extract data from the text. [^#]* == .*? up to the next '#', just without
+        # the lazy backtracking at every character
         regex_patterns = {
             'address': r'### Primary Location\n(.*? \d{5})',
             'age': r'(?:Toddler|Children \(6 to 10\)|Preteen|Teen|Adults|Elders \(65\+\))',
             'availability': r'Practice at a Glance\n\n(.*?)\n\n#',
-            'credentials': r'Next(.*?)#',
+            'credentials': r'Next([^#]*)#',
             'description': r'Verified by Psychology Today(.*?)##',
-            'ethnicities': r'### Ethnicity(.*?)#',
+            'ethnicities': r'### Ethnicity([^#]*)#',
             'faith': r'Religion\n\n(.*?)\n#',
             'insurance': r'## Finances(.*?)## Qualifications',
             'languages': r'I also speak\n\n(.*?)\n#',
             'lgbtq_status': r'\b[Ll][Gg][Bb][Tt][Qq]\+?\b',
-            'name': r'Next(.*?)#',
+            'name': r'Next([^#]*)#',
             'phone_number': r'### Primary Location\n\n(.*?)\n\n(Email|My web|Website|#)',
             'session_cost': r'## Finances(.*?)## Qualifications',
             'therapy_types': r'Types of Therapy\n\n(.*?)\n\n(Ask|#)',
@@ -119,7 +189,7 @@ class TextProcessing:
             'address': lambda: data.split('\n\n'),
             'availability': lambda: data,
             'credentials': lambda: (data.split('\n\n'))[1],
-            'description': lambda: data[0:],  # TODO: convert to embeddings
+            'description': lambda: data[0:],  # vectorized once the directory is clean, see DescriptionVectors
             'ethnicities': lambda: [val.strip() for val in [val.strip(',') for val in data.split('\n')] if val.strip()],
             'faith': lambda: [val.strip() for val in data.replace('\n', '').split(',') if val.strip()],
             'insurance': lambda: [val.strip('* ').strip() for val in data.split('\n') if val.strip().startswith('*')],
@@ -138,3 +208,124 @@ class TextProcessing:
         # reference tables will help limit the cardinality at the sake of excluding vals not listed by psych today
         with open(ref_file, 'r') as file:
             return {line.strip() for line in file}  # set is faster to search than list, remove duplicates by default
+
+
+class VocabularyMatcher:
+    """
+    Parameters:
+    - field (str): reference file to match against (ethnicities, faith, insurance, languages, therapy_types)
+    - score_cutoff (float): minimum partial ratio for a scraped value to count as a reference value. same >= 85 as
+        the fuzzywuzzy check this replaced, on rapidfuzz's unrounded score (fuzzywuzzy rounded half to even, so its
+        cut was really > 84.5; a score in between is rare enough not to matter)
+    - cache_size (int): number of scraped value -> reference value results remembered
+
+    Fuzzy string matching against one reference file. The file is read once per process (use for_field), and
+    since the same insurance / therapy type strings show up on most profiles, results are memoized in an LRU cache.
+    hits / misses are kept so the hit rate can be checked with cache_stats
+    """
+    matchers = {}  # field -> matcher, shared by every profile parsed in this process
+
+    def __init__(self, field, score_cutoff=85, cache_size=4096):
+        self.field, self.score_cutoff, self.cache_size = field, score_cutoff, cache_size
+        # sorted so ties between reference values always resolve the same way
+        self.reference_vals = sorted(TextProcessing.get_reference_data(f'../reference_data/{field}.txt'))
+        self.cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    @classmethod
+    def for_field(cls, field):
+        if field not in cls.matchers:
+            cls.matchers[field] = cls(field)
+        return cls.matchers[field]
+
+    @classmethod
+    def cache_stats(cls):
+        # hit rate per field for every matcher used in this process
+        return {field: {'hits': matcher.hits, 'misses': matcher.misses, 'hit_rate': matcher.get_hit_rate()}
+                for field, matcher in cls.matchers.items()}
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def match(self, val):
+        # best reference value for val, or None when nothing clears the cutoff
+        return self.match_all([val])[0]
+
+    def match_all(self, vals):
+        # cached vals are answered straight away, the rest are scored against the reference file in one cdist call
+        found, unseen = {}, []
+        for val in vals:
+            if val in found:
+                continue
+            if val in self.cache:
+                self.cache.move_to_end(val)
+                found[val] = self.cache[val]
+                self.hits += 1
+            else:
+                unseen.append(val)
+        self.misses += len(unseen)
+        if unseen:
+            found.update(self.score(unseen))
+        return [found[val] for val in vals]
+
+    def score(self, vals):
+        scores = process.cdist(vals, self.reference_vals, scorer=fuzz.partial_ratio, score_cutoff=self.score_cutoff)
+        best_matches = {}
+        for val, val_scores in zip(vals, scores):
+            best_matches[val] = None
+            top_score = val_scores.max()
+            if top_score >= self.score_cutoff:
+                # 'Family Systems' partially matches 'Internal Family Systems (IFS)' at 100 too, so break ties on
+                # the full ratio instead of whichever reference value happened to come first
+                tied = [self.reference_vals[i] for i in (val_scores == top_score).nonzero()[0]]
+                best_matches[val] = max(tied, key=lambda ref: fuzz.ratio(val, ref))
+            self.cache[val] = best_matches[val]
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return best_matches
+
+
+class KeywordMatcher:
+    """
+    Issues, age brackets, LGBTQ and veteran mentions can show up anywhere on the page, so they're found by scanning
+    the whole page text. Rather than one re.search per line of issues.txt (~60 scans) plus three more for the other
+    fields, everything is compiled once into a single alternation and the page is scanned one time (see scan)
+    """
+    matcher = None  # built once per process
+
+    def __init__(self):
+        issues = TextProcessing.get_reference_data('../reference_data/issues.txt')
+        # longest first so 'Sexual Addiction' wins over 'Addiction' at the same spot. issues are escaped now
+        # ('Borderline Personality (BPD)' used to be read as a regex group and never matched)
+        issue_alternation = '|'.join(re.escape(issue) for issue in sorted(issues, key=len, reverse=True))
+        self.pattern = re.compile(rf'\b(?P<issues>{issue_alternation})(?!\w)'
+                                  rf'|(?P<age>{TextProcessing.get_field_regex_pattern("age")})'
+                                  rf'|(?P<lgbtq_status>{TextProcessing.get_field_regex_pattern("lgbtq_status")})'
+                                  rf'|(?P<veteran_status>{TextProcessing.get_field_regex_pattern("veteran_status")})')
+
+        # matches don't overlap, so 'Sexual Addiction' hides the 'Addiction' inside it. those used to be picked up by
+        # their own scan, so record which issues each issue implies
+        self.implied_issues = {issue: {other for other in issues
+                                       if other != issue and re.search(rf'\b{re.escape(other)}(?!\w)', issue)}
+                               for issue in issues}
+
+    @classmethod
+    def get_matcher(cls):
+        if cls.matcher is None:
+            cls.matcher = cls()
+        return cls.matcher
+
+    def scan(self, page_text):
+        # every issue / age bracket / flag on the page in one pass
+        hits = {'issues': set(), 'age': set(), 'lgbtq_status': False, 'veteran_status': False}
+        for match in self.pattern.finditer(page_text):
+            field = match.lastgroup
+            if field == 'issues':
+                hits['issues'].add(match.group())
+                hits['issues'].update(self.implied_issues[match.group()])
+            elif field == 'age':
+                hits['age'].add(match.group())
+            else:
+                hits[field] = True
+        return hits